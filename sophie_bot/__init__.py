@@ -19,14 +19,17 @@
 import asyncio
 import logging
 import os
+import time
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
+from aiogram.utils.exceptions import TelegramAPIError
 from dotenv import load_dotenv
 
 from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import record_api_call, record_io
 from sophie_bot.versions import SOPHIE_VERSION
 
 dotenv_path = Path('.') / 'data' / 'config.env'
@@ -59,8 +62,24 @@ server = TELEGRAM_PRODUCTION
 if url := os.getenv("BOTAPI_SERVER", None):
     server = TelegramAPIServer.from_base(url)
 
+
+class MeteredBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        error = None
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except TelegramAPIError as err:
+            # RetryAfter is the 429 (flood wait) one
+            error = err
+            raise
+        finally:
+            record_io('bot_api', time.perf_counter() - start)
+            record_api_call(method, error)
+
+
 # AIOGram
-bot = Bot(token=TOKEN, parse_mode=types.ParseMode.HTML, server=server)
+bot = MeteredBot(token=TOKEN, parse_mode=types.ParseMode.HTML, server=server)
 storage = RedisStorage2(
     host=os.getenv("REDIS_URI", "localhost"),
     port=int(os.getenv("REDIS_PORT", 6379)),
@@ -18,6 +18,7 @@
 
 import asyncio
 import os
+import sys
 from importlib import import_module
 
 from aiogram import executor
@@ -25,7 +26,15 @@ from aiogram.contrib.middlewares.logging import LoggingMiddleware
 
 from sophie_bot import dp, TOKEN, bot
 from sophie_bot.modules import ALL_MODULES, LOADED_MODULES
+from sophie_bot.modules.utils.blacklist import blacklist_refresher, load_blacklist
+from sophie_bot.services.mongo import create_indexes, explain_indexes
 from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import MetricsMiddleware, TimedMiddlewareManager, start_metrics_server
+from sophie_bot.utils.watchdog import LoopWatchdog
+
+# Measure all middlewares, the metrics one goes first to see the whole update
+dp.middleware = TimedMiddlewareManager(dp)
+dp.middleware.setup(MetricsMiddleware())
 
 if os.getenv('DEBUG_MODE', False):
     log.debug("Enabling logging middleware.")
@@ -67,6 +76,19 @@ async def before_srv_task(loop):
 
 
 async def start(_):
+    # Migrations started by __before_serving__ rely on unique indexes to not insert duplicates
+    log.debug("Creating MongoDB indexes...")
+    await create_indexes(LOADED_MODULES)
+    if '--explain' in sys.argv:
+        loop.create_task(explain_indexes(LOADED_MODULES))
+
+    LoopWatchdog().start(loop)
+    if port := os.getenv('METRICS_PORT', None):
+        await start_metrics_server(int(port))
+
+    await load_blacklist()
+    loop.create_task(blacklist_refresher())
+
     log.debug("Starting before serving task for all modules...")
     loop.create_task(before_srv_task(loop))
 
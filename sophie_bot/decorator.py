@@ -18,16 +18,16 @@
 
 import os
 import time
+from contextvars import ContextVar
 from importlib import import_module
 
 from aiogram import types
 from aiogram.dispatcher.handler import SkipHandler
-from sentry_sdk import configure_scope
 
 from sophie_bot import BOT_USERNAME, dp
-from sophie_bot.modules.error import parse_update
 from sophie_bot.utils.filters import ALL_FILTERS
 from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import observe_handler
 
 DEBUG_MODE = os.getenv('DEBUG_MODE', False)
 ALLOW_FORWARDS_COMMANDS = os.getenv("ALLOW_FORWARDS_COMMANDS", False)
@@ -37,6 +37,9 @@ CMD_NOT_MONO = os.getenv("DISALLOW_MONO_CMDS", True)
 REGISTRED_COMMANDS = []
 COMMANDS_ALIASES = {}
 
+# Event which is being handled, it's parsed only if the error report is really sent
+current_update = ContextVar('current_update', default=None)
+
 # Import filters
 log.info("Filters to load: %s", str(ALL_FILTERS))
 for module_name in ALL_FILTERS:
@@ -100,6 +103,8 @@ def register(*args, cmds=None, f=None, allow_edited=True, allow_kwargs=False, **
     register_kwargs.update(kwargs)
 
     def decorator(func):
+        handler_name = f'{func.__module__.split(".")[-1]}.{func.__name__}'
+
         async def new_func(*def_args, **def_kwargs):
             message = def_args[0]
 
@@ -109,18 +114,16 @@ def register(*args, cmds=None, f=None, allow_edited=True, allow_kwargs=False, **
             if allow_kwargs is False:
                 def_kwargs = dict()
 
-            with configure_scope() as scope:
-                parsed_update = parse_update(dict(message))
-                scope.set_extra("update", str(parsed_update))
+            current_update.set(message)
 
-            if DEBUG_MODE:
-                # log.debug('[*] Starting {}.'.format(func.__name__))
-                # log.debug('Event: \n' + str(message))
-                start = time.time()
-                await func(*def_args, **def_kwargs)
-                log.debug('[*] {} Time: {} sec.'.format(func.__name__, time.time() - start))
-            else:
+            start = time.perf_counter()
+            try:
                 await func(*def_args, **def_kwargs)
+            finally:
+                took = time.perf_counter() - start
+                observe_handler(handler_name, took)
+                if DEBUG_MODE:
+                    log.debug('[*] {} Time: {} sec.'.format(func.__name__, took))
             raise SkipHandler()
 
         if f == 'cb':
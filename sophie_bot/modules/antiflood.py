@@ -16,8 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from typing import Optional
 
 from aiogram.dispatcher import FSMContext
@@ -30,17 +29,19 @@ from aiogram.types.inline_keyboard import InlineKeyboardButton
 from aiogram.types.message import ContentType, Message
 from aiogram.utils.callback_data import CallbackData
 from babel.dates import format_timedelta
+from pymongo import IndexModel
 
 from sophie_bot import dp
 from sophie_bot.decorator import register
+from sophie_bot.modules.utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from sophie_bot.modules.utils.connections import chat_connection
 from sophie_bot.modules.utils.language import get_strings_dec, get_strings
 from sophie_bot.modules.utils.message import convert_time, get_args, need_args_dec, InvalidTimeUnit
 from sophie_bot.modules.utils.restrictions import ban_user, kick_user, mute_user
 from sophie_bot.modules.utils.user_details import is_user_admin, get_user_link
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import bredis, redis
-from sophie_bot.utils.cached import cached
+from sophie_bot.services.redis import abredis, aredis, get_value, set_value
+from sophie_bot.utils.codec import versioned_key
 from sophie_bot.utils.logger import log
 
 cancel_state = CallbackData('cancel_state', 'user_id')
@@ -63,10 +64,10 @@ class AntifloodEnforcer(BaseMiddleware):
     state_cache_key = "floodstate:{chat_id}"
 
     async def enforcer(self, message: Message, database: dict):
-        if (not (data := self.get_flood(message))) or int(self.get_state(message)) != message.from_user.id:
+        if (not (data := await self.get_flood(message))) or int(await self.get_state(message)) != message.from_user.id:
             to_set = CacheModel(count=1)
-            self.insert_flood(to_set, message, database)
-            self.set_state(message)
+            await self.insert_flood(to_set, message, database)
+            await self.set_state(message)
             return False  # we aint banning anybody
 
         # update count
@@ -75,10 +76,10 @@ class AntifloodEnforcer(BaseMiddleware):
         # check exceeding
         if data.count >= database['count']:
             if await self.do_action(message, database):
-                self.reset_flood(message)
+                await self.reset_flood(message)
                 return True
 
-        self.insert_flood(data, message, database)
+        await self.insert_flood(data, message, database)
         return False
 
     @classmethod
@@ -92,35 +93,34 @@ class AntifloodEnforcer(BaseMiddleware):
             return False
         return True
 
-    def get_flood(self, message) -> Optional[CacheModel]:
-        if data := bredis.get(self.cache_key(message)):
-            data = pickle.loads(data)
-            return data
+    async def get_flood(self, message) -> Optional[CacheModel]:
+        if data := await get_value(self.cache_key(message)):
+            return CacheModel(**data)
         return None
 
-    def insert_flood(self, data: CacheModel, message: Message, database: dict):
+    async def insert_flood(self, data: CacheModel, message: Message, database: dict):
         ex = convert_time(database['time']) if database.get('time', None) is not None else None
-        return bredis.set(self.cache_key(message), pickle.dumps(data), ex=ex)
+        return await set_value(self.cache_key(message), asdict(data), ttl=ex)
 
-    def reset_flood(self, message):
-        return bredis.delete(self.cache_key(message))
+    async def reset_flood(self, message):
+        return await abredis.delete(self.cache_key(message))
 
-    def check_flood(self, message):
-        return bredis.exists(self.cache_key(message))
+    async def check_flood(self, message):
+        return await abredis.exists(self.cache_key(message))
 
-    def set_state(self, message: Message):
-        return bredis.set(
+    async def set_state(self, message: Message):
+        return await abredis.set(
             self.state_cache_key.format(chat_id=message.chat.id), message.from_user.id
         )
 
-    def get_state(self, message: Message):
-        return bredis.get(
+    async def get_state(self, message: Message):
+        return await abredis.get(
             self.state_cache_key.format(chat_id=message.chat.id)
         )
 
     @classmethod
     def cache_key(cls, message: Message):
-        return f"antiflood:{message.chat.id}:{message.from_user.id}"
+        return versioned_key(f"antiflood:{message.chat.id}:{message.from_user.id}")
 
     @classmethod
     async def do_action(cls, message: Message, database: dict):
@@ -146,7 +146,7 @@ class AntifloodEnforcer(BaseMiddleware):
         log.debug(f"Enforcing flood control on {message.from_user.id} in {message.chat.id}")
         if self.is_message_valid(message):
             if await is_user_admin(message.chat.id, message.from_user.id):
-                return self.set_state(message)
+                return await self.set_state(message)
             if (database := await get_data(message.chat.id)) is None:
                 return
 
@@ -175,7 +175,7 @@ async def setflood_command(message: Message, chat: dict, strings: dict):
         return await message.reply(strings['overflowed_count'])
 
     await AntiFloodConfigState.expiration_proc.set()
-    redis.set(f"antiflood_setup:{chat['chat_id']}", args)
+    await aredis.set(f"antiflood_setup:{chat['chat_id']}", args)
     await message.reply(
         strings['config_proc_1'],
         reply_markup=InlineKeyboardMarkup().add(
@@ -196,7 +196,7 @@ async def antiflood_expire_proc(message: Message, chat: dict, strings: dict, sta
     except (TypeError, ValueError):
         await message.reply(strings['invalid_time'])
     else:
-        if not (data := redis.get(f'antiflood_setup:{chat["chat_id"]}')):
+        if not (data := await aredis.get(f'antiflood_setup:{chat["chat_id"]}')):
             await message.reply(strings['setup_corrupted'])
         else:
             await db.antiflood.update_one(
@@ -204,7 +204,7 @@ async def antiflood_expire_proc(message: Message, chat: dict, strings: dict, sta
                 {"$set": {"time": time, "count": int(data)}},
                 upsert=True
             )
-            await get_data.reset_cache(chat['chat_id'])
+            invalidate_chat_settings(chat['chat_id'])
             kw = {'count': data}
             if time is not None:
                 kw.update({'time': format_timedelta(parsed_time, locale=strings['language_info']['babel'])})
@@ -224,7 +224,7 @@ async def antiflood(message: Message, chat: dict, strings: dict):
 
     if message.get_args().lower() in ('off', '0', 'no'):
         await db.antiflood.delete_one({"chat_id": chat['chat_id']})
-        await get_data.reset_cache(chat['chat_id'])
+        invalidate_chat_settings(chat['chat_id'])
         return await message.reply(strings['turned_off'].format(chat_title=chat['chat_title']))
 
     if data['time'] is None:
@@ -256,7 +256,7 @@ async def setfloodaction(message: Message, chat: dict, strings: dict):
 
     if action.startswith('t'):
         await message.reply(strings['send_time'], allow_sending_without_reply=True)
-        redis.set(f"floodactionstate:{chat['chat_id']}", action)
+        await aredis.set(f"floodactionstate:{chat['chat_id']}", action)
         return await AntiFloodActionState.set_time_proc.set()
 
     await db.antiflood.update_one(
@@ -264,7 +264,7 @@ async def setfloodaction(message: Message, chat: dict, strings: dict):
         {"$set": {"action": action}},
         upsert=True
     )
-    await get_data.reset_cache(message.chat.id)
+    invalidate_chat_settings(chat['chat_id'])
     return await message.reply(
         strings['setfloodaction_success'].format(
             action=action
@@ -276,7 +276,7 @@ async def setfloodaction(message: Message, chat: dict, strings: dict):
 @chat_connection(admin=True)
 @get_strings_dec('antiflood')
 async def set_time_config(message: Message, chat: dict, strings: dict, state: FSMContext, **_):
-    if not (action := redis.get(f"floodactionstate:{chat['chat_id']}")):
+    if not (action := await aredis.get(f"floodactionstate:{chat['chat_id']}")):
         await message.reply(strings['setup_corrupted'], allow_sending_without_reply=True)
         return await state.finish()
     try:
@@ -289,7 +289,7 @@ async def set_time_config(message: Message, chat: dict, strings: dict, state: FS
             {"$set": {"action": action, "time": time}},
             upsert=True
         )
-        await get_data.reset_cache(chat['chat_id'])
+        invalidate_chat_settings(chat['chat_id'])
         text = strings['setfloodaction_success'].format(action=action)
         text += f" ({format_timedelta(parsed_time, locale=strings['language_info']['babel'])})"
         await message.reply(text, allow_sending_without_reply=True)
@@ -306,11 +306,8 @@ async def cancel_state_cb(event: CallbackQuery):
     await event.message.delete()
 
 
-@cached()
-async def get_data(chat_id: int):
-    return await db.antiflood.find_one(
-        {'chat_id': chat_id}
-    )
+async def get_data(chat_id: int) -> Optional[dict]:
+    return (await get_chat_settings(chat_id)).antiflood
 
 
 async def __export__(chat_id: int):
@@ -318,6 +315,7 @@ async def __export__(chat_id: int):
     if not data:
         return
 
+    data = dict(data)
     del data['_id'], data['chat_id']
     return data
 
@@ -327,3 +325,9 @@ async def __import__(chat_id: int, data: dict):  # noqa
         {"chat_id": chat_id},
         {"$set": data}
     )
+    invalidate_chat_settings(chat_id)
+
+
+__indexes__ = {
+    'antiflood': [IndexModel('chat_id')]
+}
@@ -25,16 +25,20 @@ from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardBu
 from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.deep_linking import get_start_link
 from aiogram.utils.exceptions import BotBlocked, CantInitiateConversation
+from pymongo import IndexModel
 
 from sophie_bot import bot
 from sophie_bot.decorator import register
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
-from .utils.connections import chat_connection, set_connected_chat, get_connection_data
+from sophie_bot.services.redis import aredis
+from .utils.chat_settings import get_chat_settings, invalidate_chat_settings
+from .utils.connections import (
+    chat_connection, get_connection_data, reset_chat_connections_cache, set_connected_chat
+)
 from .utils.language import get_strings_dec
 from .utils.message import get_arg
 from .utils.notes import BUTTONS
-from .utils.user_details import get_chat_dec, is_user_admin
+from .utils.user_details import add_user_chat, get_chat_dec, is_user_admin
 
 connect_to_chat_cb = CallbackData('connect_to_chat_cb', 'chat_id')
 
@@ -75,7 +79,7 @@ async def connect_to_chat_direct(message, strings):
         await def_connect_chat(message, user_id, chat_id, chat_title)
     except (BotBlocked, CantInitiateConversation):
         await message.reply(strings['connected_pm_to_me'].format(chat_name=chat_title))
-        redis.set('sophie_connected_start_state:' + str(user_id), 1)
+        await aredis.set('sophie_connected_start_state:' + str(user_id), 1)
 
 
 # In pm without args - show last connected chats
@@ -159,8 +163,7 @@ async def allow_users_to_connect(message, strings, chat):
     arg = get_arg(message).lower()
     if not arg:
         status = strings['enabled']
-        data = await db.chat_connection_settings.find_one({'chat_id': chat_id})
-        if data and 'allow_users_connect' in data and data['allow_users_connect'] is False:
+        if not (await get_chat_settings(chat_id)).allow_users_connect:
             status = strings['disabled']
         await message.reply(strings['chat_users_connections_info'].format(
             status=status,
@@ -184,6 +187,8 @@ async def allow_users_to_connect(message, strings, chat):
         {"$set": {'allow_users_connect': r_bool}},
         upsert=True
     )
+    invalidate_chat_settings(chat_id)
+    await reset_chat_connections_cache(chat_id)
     await message.reply(strings['chat_users_connections_cng'].format(
         status=status,
         chat_name=chat['chat_title']
@@ -195,9 +200,9 @@ async def allow_users_to_connect(message, strings, chat):
 @chat_connection()
 async def connected_start_state(message, strings, chat):
     key = 'sophie_connected_start_state:' + str(message.from_user.id)
-    if redis.get(key):
+    if await aredis.get(key):
         await message.reply(strings['pm_connected'].format(chat_name=chat['chat_title']))
-        redis.delete(key)
+        await aredis.delete(key)
 
 
 BUTTONS.update({'connect': 'btn_connect_start'})
@@ -214,7 +219,7 @@ async def connect_start(message, strings, regexp=None, **kwargs):
     if arg.startswith('-') or arg.isdigit():
         chat = await db.chat_list.find_one({'chat_id': int(arg)})
     elif arg.startswith('@'):
-        chat = await db.chat_list.find_one({'chat_nick': arg.lower()})
+        chat = await db.chat_list.find_one({'chat_nick_lc': arg.strip('@').lower()})
     else:
         await message.reply(strings['cant_find_chat_use_id'])
         return
@@ -227,9 +232,16 @@ async def connect_anon_admins(event: CallbackQuery):
     if not await is_user_admin(event.message.chat.id, event.from_user.id):
         return
 
-    if event.message.chat.id not in (data := await db.user_list.find_one({"user_id": event.from_user.id}))['chats']:
-        await db.user_list.update_one(
-            {"_id": data['_id']},
-            {"$addToSet": {"chats": event.message.chat.id}}
-        )
+    await add_user_chat(event.from_user.id, event.message.chat.id)
     return await event.answer(url=await get_start_link(f"btn_connect_start_{event.message.chat.id}"))
+
+
+__indexes__ = {
+    'connections': [IndexModel('user_id')],
+    'chat_connection_settings': [IndexModel('chat_id')]
+}
+
+__queries__ = {
+    # /connect by chat's username
+    'chat_list': [{'chat_nick_lc': ''}]
+}
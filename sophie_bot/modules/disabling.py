@@ -18,9 +18,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardButton
+from pymongo import IndexModel
 
 from sophie_bot.decorator import register, COMMANDS_ALIASES
 from sophie_bot.services.mongo import db
+from .utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from .utils.connections import chat_connection
 from .utils.disable import DISABLABLE_COMMANDS, disableable_dec
 from .utils.language import get_strings_dec
@@ -43,11 +45,10 @@ async def list_disablable(message, strings):
 async def list_disabled(message, chat, strings):
     text = strings['disabled_list'].format(chat_name=chat['chat_title'])
 
-    if not (disabled := await db.disabled.find_one({'chat_id': chat['chat_id']})):
+    if not (commands := (await get_chat_settings(chat['chat_id'])).disabled_cmds):
         await message.reply(strings['no_disabled_cmds'].format(chat_name=chat['chat_title']))
         return
 
-    commands = disabled['cmds']
     for command in commands:
         text += f"* <code>/{command}</code>\n"
     await message.reply(text)
@@ -72,7 +73,7 @@ async def disable_command(message, chat, strings):
         await message.reply(strings["wot_to_disable"])
         return
 
-    if await db.disabled.find_one({'chat_id': chat['chat_id'], 'cmds': {'$in': [cmd]}}):
+    if (await get_chat_settings(chat['chat_id'])).is_disabled(cmd):
         await message.reply(strings['already_disabled'])
         return
 
@@ -81,6 +82,7 @@ async def disable_command(message, chat, strings):
         {"$addToSet": {'cmds': {'$each': [cmd]}}},
         upsert=True
     )
+    invalidate_chat_settings(chat['chat_id'])
 
     await message.reply(strings["disabled"].format(
         cmd=cmd,
@@ -108,7 +110,7 @@ async def enable_command(message, chat, strings):
         await message.reply(strings["wot_to_enable"])
         return
 
-    if not await db.disabled.find_one({'chat_id': chat['chat_id'], 'cmds': {'$in': [cmd]}}):
+    if not (await get_chat_settings(chat_id)).is_disabled(cmd):
         await message.reply(strings["already_enabled"])
         return
 
@@ -116,6 +118,7 @@ async def enable_command(message, chat, strings):
         {'chat_id': chat_id},
         {'$pull': {'cmds': cmd}}
     )
+    invalidate_chat_settings(chat_id)
 
     await message.reply(strings["enabled"].format(
         cmd=cmd, chat_name=chat['chat_title']
@@ -127,7 +130,7 @@ async def enable_command(message, chat, strings):
 @get_strings_dec("disable")
 async def enable_all(message, chat, strings):
     # Ensure that something is disabled
-    if not await db.disabled.find_one({'chat_id': chat['chat_id']}):
+    if not (await get_chat_settings(chat['chat_id'])).disabled_cmds:
         await message.reply(strings['not_disabled_anything'].format(chat_title=chat['chat_title']))
         return
 
@@ -142,17 +145,16 @@ async def enable_all(message, chat, strings):
 @chat_connection(admin=True)
 @get_strings_dec('disable')
 async def enable_all_notes_cb(event, chat, strings):
-    data = await db.disabled.find_one({'chat_id': chat['chat_id']})
-    await db.disabled.delete_one({'_id': data['_id']})
+    commands = (await get_chat_settings(chat['chat_id'])).disabled_cmds
+    await db.disabled.delete_one({'chat_id': chat['chat_id']})
+    invalidate_chat_settings(chat['chat_id'])
 
-    text = strings['enable_all_done'].format(num=len(data['cmds']), chat_name=chat['chat_title'])
+    text = strings['enable_all_done'].format(num=len(commands), chat_name=chat['chat_title'])
     await event.message.edit_text(text)
 
 
 async def __export__(chat_id):
-    disabled = await db.disabled.find_one({'chat_id': chat_id})
-
-    return {'disabling': disabled['cmds'] if disabled else []}
+    return {'disabling': list((await get_chat_settings(chat_id)).disabled_cmds)}
 
 
 async def __import__(chat_id, data):
@@ -168,3 +170,9 @@ async def __import__(chat_id, data):
         {'$set': {'cmds': new}},
         upsert=True
     )
+    invalidate_chat_settings(chat_id)
+
+
+__indexes__ = {
+    'disabled': [IndexModel('chat_id')]
+}
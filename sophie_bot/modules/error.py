@@ -24,7 +24,7 @@ from aiogram.types import Update
 from redis.exceptions import RedisError
 
 from sophie_bot import dp, bot, OWNER_ID
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis
 from sophie_bot.utils.logger import log
 
 SENT = []
@@ -87,7 +87,7 @@ async def all_errors_handler(update: Update, error):
 
     log.warn('Error caused update is: \n' + html.escape(str(parse_update(message)), quote=False))
 
-    if redis.get(chat_id) == str(error):
+    if await aredis.get(chat_id) == str(error):
         # by err_tlt we assume that it is same error
         return True
 
@@ -106,7 +106,7 @@ async def all_errors_handler(update: Update, error):
 
     text = "<b>Sorry, I encountered a error!</b>\n"
     text += f'<code>{html.escape(err_tlt, quote=False)}: {html.escape(err_msg, quote=False)}</code>'
-    redis.set(chat_id, str(error), ex=600)
+    await aredis.set(chat_id, str(error), ex=600)
     await bot.send_message(chat_id, text)
 
 
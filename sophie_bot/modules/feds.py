@@ -39,19 +39,21 @@ from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardBu
 from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import Unauthorized, NeedAdministratorRightsInTheChannel, ChatNotFound
 from babel.dates import format_timedelta
-from pymongo import DeleteMany, InsertOne
+from pymongo import DeleteMany, IndexModel, InsertOne, UpdateOne
 
 from sophie_bot import OWNER_ID, BOT_ID, OPERATORS, decorator, bot
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
-from sophie_bot.services.telethon import tbot
+from sophie_bot.services.redis import aredis, try_lock
+from sophie_bot.utils.logger import log
 from .utils.connections import get_connected_chat, chat_connection
 from .utils.language import get_strings_dec, get_strings, get_string
 from .utils.message import need_args_dec, get_cmd
+from .utils.purge import purge_messages
 from .utils.restrictions import ban_user, unban_user
+from .utils.stats import delete_counter, get_counter, inc_counter
 from .utils.user_details import (
     is_chat_creator, get_user_link, get_user_and_text, check_admin_rights,
-    is_user_admin, get_chat_dec
+    is_user_admin, get_chat_dec, get_user_chats
 )
 from ..utils.cached import cached
 
@@ -73,12 +75,60 @@ async def get_fed_f(message, disable_self_fed_check: bool = False):
             # return fed which user is created
             fed = await get_fed_by_creator(chat['chat_id'])
         else:
-            fed = await db.feds.find_one({'chats': {'$in': [chat['chat_id']]}})
+            fed = await get_fed_by_chat(chat['chat_id'])
         if not fed:
             return False
         return fed
 
 
+async def get_fed_by_chat(chat_id: int) -> Optional[dict]:
+    if not (fed_id := await get_fed_id_by_chat(chat_id)):
+        return None
+    return await get_fed_by_id(fed_id)
+
+
+async def iter_fed_chats(fed: dict, page_size: int = 500):
+    """Yields chat ids of federation in pages"""
+    # Federations which weren't migrated from feds.chats yet, their chats can be in fed_chats too
+    if legacy := set(fed.get('chats') or []):
+        yield list(legacy)
+
+    last_chat_id = None
+    while True:
+        query = {'fed_id': fed['fed_id']}
+        if last_chat_id is not None:
+            query['chat_id'] = {'$gt': last_chat_id}
+
+        cursor = db.fed_chats.find(query, {'chat_id': 1}).sort('chat_id', 1).limit(page_size)
+        if not (page := [x['chat_id'] async for x in cursor]):
+            return
+
+        if chat_ids := [x for x in page if x not in legacy]:
+            yield chat_ids
+        last_chat_id = page[-1]
+
+
+async def count_fed_chats(fed: dict) -> int:
+    query = {'fed_id': fed['fed_id']}
+    if legacy := set(fed.get('chats') or []):
+        query['chat_id'] = {'$nin': list(legacy)}
+    return await db.fed_chats.count_documents(query) + len(legacy)
+
+
+async def set_chat_fed(chat_id: int, fed_id: Optional[str]):
+    if fed_id:
+        await db.fed_chats.update_one({'chat_id': chat_id}, {'$set': {'fed_id': fed_id}}, upsert=True)
+    else:
+        await db.fed_chats.delete_one({'chat_id': chat_id})
+
+    # Legacy
+    async for fed in db.feds.find({'chats': chat_id}, {'fed_id': 1}):
+        await db.feds.update_one({'_id': fed['_id']}, {'$pull': {'chats': chat_id}})
+        await get_fed_by_id.reset_cache(fed['fed_id'])
+
+    await get_fed_id_by_chat.reset_cache(chat_id)
+
+
 async def fed_post_log(fed, text):
     if 'log_chat_id' not in fed:
         return
@@ -272,15 +322,11 @@ async def join_fed(message, chat, strings):
         return
 
     # Assume chat already joined this/other fed
-    if 'chats' in fed and chat_id in fed['chats']:
+    if await get_fed_id_by_chat(chat_id):
         await message.reply(strings['joined_fed_already'])
         return
 
-    await db.feds.update_one(
-        {'_id': fed['_id']},
-        {"$addToSet": {'chats': {'$each': [chat_id]}}}
-    )
-    await get_fed_by_id.reset_cache(fed['fed_id'])
+    await set_chat_fed(chat_id, fed['fed_id'])
     await message.reply(strings['join_fed_success'].format(
         chat=chat['chat_title'], fed=html.escape(fed['fed_name'], False))
     )
@@ -302,11 +348,7 @@ async def leave_fed_comm(message, chat, fed, strings):
         await message.reply(strings['only_creators'])
         return
 
-    await db.feds.update_one(
-        {'_id': fed['_id']},
-        {'$pull': {'chats': chat['chat_id']}}
-    )
-    await get_fed_by_id.reset_cache(fed['fed_id'])
+    await set_chat_fed(chat['chat_id'], None)
     await message.reply(strings['leave_fed_success'].format(
         chat=chat['chat_title'], fed=html.escape(fed['fed_name'], False))
     )
@@ -487,12 +529,15 @@ async def unset_fed_log_chat(message, fed, strings):
 @get_strings_dec("feds")
 async def fed_chat_list(message, fed, strings):
     text = strings['chats_in_fed'].format(name=html.escape(fed['fed_name'], False))
-    if 'chats' not in fed:
+    if not await count_fed_chats(fed):
         return await message.reply(strings['no_chats'].format(name=html.escape(fed['fed_name'], False)))
 
-    for chat_id in fed['chats']:
-        chat = await db.chat_list.find_one({'chat_id': chat_id})
-        text += '* {} (<code>{}</code>)\n'.format(chat["chat_title"], chat_id)
+    async for chat_ids in iter_fed_chats(fed):
+        titles = {x['chat_id']: x['chat_title'] async for x in db.chat_list.find(
+            {'chat_id': {'$in': chat_ids}}, {'chat_id': 1, 'chat_title': 1}
+        )}
+        for chat_id in chat_ids:
+            text += '* {} (<code>{}</code>)\n'.format(titles.get(chat_id), chat_id)
     if len(text) > 4096:
         await message.answer_document(
             InputFile(io.StringIO(text), filename="chatlist.txt"),
@@ -521,12 +566,14 @@ async def fed_admins_list(message, fed, strings):
 @get_strings_dec("feds")
 async def fed_info(message, fed, strings):
     text = strings['finfo_text']
-    banned_num = await db.fed_bans.count_documents({'fed_id': fed['fed_id']})
+    banned_num = await get_counter(
+        f"fed_bans:{fed['fed_id']}", lambda: db.fed_bans.count_documents({'fed_id': fed['fed_id']})
+    )
     text = text.format(
         name=html.escape(fed['fed_name'], False),
         fed_id=fed['fed_id'],
         creator=await get_user_link(fed['creator']),
-        chats=len(fed['chats'] if 'chats' in fed else []),
+        chats=await count_fed_chats(fed),
         fbanned=banned_num
     )
 
@@ -598,23 +645,17 @@ async def fed_ban_user(message, fed, user, reason, strings):
         text += strings['fbanned_reason'].format(reason=reason)
 
     # fban processing msg
-    num = len(fed['chats']) if 'chats' in fed else 0
+    num = await count_fed_chats(fed)
     msg = await message.reply(text + strings['fbanned_process'].format(num=num))
 
-    user = await db.user_list.find_one({'user_id': user_id})
-
     banned_chats = []
 
-    if 'chats' in fed:
-        for chat_id in fed['chats']:
-            # We not found the user or user wasn't detected
-            if not user or 'chats' not in user:
-                continue
-
-            if chat_id in user['chats']:
-                await asyncio.sleep(0)  # Do not slow down other updates
-                if await ban_user(chat_id, user_id):
-                    banned_chats.append(chat_id)
+    async for chat_ids in iter_fed_chats(fed):
+        # Only chats of federation where user was detected
+        for chat_id in await get_user_chats(user_id, chat_ids):
+            await asyncio.sleep(0)  # Do not slow down other updates
+            if await ban_user(chat_id, user_id):
+                banned_chats.append(chat_id)
 
     new = {
         'fed_id': fed['fed_id'],
@@ -628,6 +669,7 @@ async def fed_ban_user(message, fed, user, reason, strings):
         new['reason'] = reason
 
     await db.fed_bans.insert_one(new)
+    await inc_counter(f"fed_bans:{fed['fed_id']}")
 
     channel_text = strings['fban_log_fed_log'].format(
         fed_name=html.escape(fed['fed_name'], False),
@@ -647,8 +689,7 @@ async def fed_ban_user(message, fed, user, reason, strings):
     if get_cmd(message) == 'sfban':
         silent = True
         key = 'leave_silent:' + str(message.chat.id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        await aredis.set(key, user_id, ex=30)
         text += strings['fbanned_silence']
 
     # SubsFeds process
@@ -673,30 +714,23 @@ async def fed_ban_user(message, fed, user, reason, strings):
                 'origin_fed': fed['fed_id'],
                 'by': message.from_user.id
             }
-            for chat_id in s_fed['chats']:
-                if not user:
-                    continue
+            async for chat_ids in iter_fed_chats(s_fed):
+                for chat_id in await get_user_chats(user_id, chat_ids):
+                    if chat_id == user_id:
+                        continue
 
-                elif chat_id == user['user_id']:
-                    continue
+                    # Do not slow down other updates
+                    await asyncio.sleep(0.2)
 
-                elif 'chats' not in user:
-                    continue
+                    if await ban_user(chat_id, user_id):
+                        banned_chats.append(chat_id)
+                        all_banned_chats_count += 1
 
-                elif chat_id not in user['chats']:
-                    continue
-
-                # Do not slow down other updates
-                await asyncio.sleep(0.2)
-
-                if await ban_user(chat_id, user_id):
-                    banned_chats.append(chat_id)
-                    all_banned_chats_count += 1
-
-                    if reason:
-                        new['reason'] = reason
+                        if reason:
+                            new['reason'] = reason
 
             await db.fed_bans.insert_one(new)
+            await inc_counter(f"fed_bans:{s_fed_id}")
 
         await msg.edit_text(text + strings['fbanned_subs_done'].format(
             chats=this_fed_banned_count,
@@ -719,7 +753,7 @@ async def fed_ban_user(message, fed, user, reason, strings):
         if 'reply_to_message' in message and message.reply_to_message.from_user.id == user_id:
             to_del.append(message.reply_to_message.message_id)
         await asyncio.sleep(5)
-        await tbot.delete_messages(message.chat.id, to_del)
+        await purge_messages(message.chat.id, to_del)
 
 
 @decorator.register(cmds=['unfban', 'funban'])
@@ -758,7 +792,8 @@ async def unfed_ban_user(message, fed, user, text, strings):
         if await unban_user(chat_id, user_id):
             counter += 1
 
-    await db.fed_bans.delete_one({'fed_id': fed['fed_id'], 'user_id': user_id})
+    if (await db.fed_bans.delete_one({'fed_id': fed['fed_id'], 'user_id': user_id})).deleted_count:
+        await inc_counter(f"fed_bans:{fed['fed_id']}", -1)
 
     channel_text = strings['un_fban_log_fed_log'].format(
         fed_name=html.escape(fed['fed_name'], False),
@@ -767,7 +802,7 @@ async def unfed_ban_user(message, fed, user, text, strings):
         user_id=user['user_id'],
         by=await get_user_link(message.from_user.id),
         chat_count=len(banned_chats),
-        all_chats=len(fed['chats']) if 'chats' in fed else 0
+        all_chats=await count_fed_chats(fed)
     )
 
     # Subs feds
@@ -795,7 +830,8 @@ async def unfed_ban_user(message, fed, user, text, strings):
                 if await unban_user(chat_id, user_id):
                     all_unbanned_chats_count += 1
 
-                    await db.fed_bans.delete_one({'fed_id': sfed_id, 'user_id': user_id})
+                    if (await db.fed_bans.delete_one({'fed_id': sfed_id, 'user_id': user_id})).deleted_count:
+                        await inc_counter(f"fed_bans:{sfed_id}", -1)
 
         await msg.edit_text(text + strings['un_fbanned_subs_done'].format(
             chats=this_fed_unbanned_count,
@@ -839,7 +875,13 @@ async def del_fed_func(event, strings, callback_data=None, **kwargs):
     if event.from_user.id != int(fed_owner):
         return
 
-    await db.feds.delete_one({'fed_id': fed_id})
+    fed = await db.feds.find_one_and_delete({'fed_id': fed_id}, {'chats': 1})
+    # Legacy
+    for chat_id in (fed or {}).get('chats') or []:
+        await get_fed_id_by_chat.reset_cache(chat_id)
+    async for chat in db.fed_chats.find({'fed_id': fed_id}, {'chat_id': 1}):
+        await get_fed_id_by_chat.reset_cache(chat['chat_id'])
+    await db.fed_chats.delete_many({'fed_id': fed_id})
     await get_fed_by_id.reset_cache(fed_id)
     await get_fed_by_creator.reset_cache(int(fed_owner))
     async for subscribed_fed in db.feds.find({'subscribed': fed_id}):
@@ -851,6 +893,7 @@ async def del_fed_func(event, strings, callback_data=None, **kwargs):
 
     # delete all fbans of it
     await db.fed_bans.delete_many({'fed_id': fed_id})
+    await delete_counter(f"fed_bans:{fed_id}")
 
     await event.message.edit_text(strings['delfed_success'])
 
@@ -894,14 +937,11 @@ async def fed_rename(message, fed, strings):
 async def fban_export(message, fed, strings):
     fed_id = fed['fed_id']
     key = 'fbanlist_lock:' + str(fed_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if ttl := await try_lock(key, 600, force=message.from_user.id in OPERATORS):
+        ttl = format_timedelta(timedelta(seconds=ttl), strings['language_info']['babel'])
         await message.reply(strings['fbanlist_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 600)
-
     msg = await message.reply(strings['creating_fbanlist'])
     fields = ['user_id', 'reason', 'by', 'time', 'banned_chats']
     with io.StringIO() as f:
@@ -942,14 +982,11 @@ async def fban_export(message, fed, strings):
 async def importfbans_cmd(message, fed, strings):
     fed_id = fed['fed_id']
     key = 'importfbans_lock:' + str(fed_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if ttl := await try_lock(key, 600, force=message.from_user.id in OPERATORS):
+        ttl = format_timedelta(timedelta(seconds=ttl), strings['language_info']['babel'])
         await message.reply(strings['importfbans_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 600)
-
     if 'document' in message:
         document = message.document
     else:
@@ -1043,8 +1080,10 @@ async def importfbans_func(message, fed, strings, document=None):
 
             # Make delete operation ordered before inserting.
             if queue_del:
-                await db.fed_bans.bulk_write(queue_del, ordered=False)
-            await db.fed_bans.bulk_write(queue_insert, ordered=False)
+                deleted = (await db.fed_bans.bulk_write(queue_del, ordered=False)).deleted_count
+                await inc_counter(f"fed_bans:{fed['fed_id']}", -deleted)
+            inserted = (await db.fed_bans.bulk_write(queue_insert, ordered=False)).inserted_count
+            await inc_counter(f"fed_bans:{fed['fed_id']}", inserted)
 
             queue_del = []
             queue_insert = []
@@ -1052,9 +1091,11 @@ async def importfbans_func(message, fed, strings, document=None):
     # Process last bans
     real_counter += len(queue_insert)
     if queue_del:
-        await db.fed_bans.bulk_write(queue_del, ordered=False)
+        deleted = (await db.fed_bans.bulk_write(queue_del, ordered=False)).deleted_count
+        await inc_counter(f"fed_bans:{fed['fed_id']}", -deleted)
     if queue_insert:
-        await db.fed_bans.bulk_write(queue_insert, ordered=False)
+        inserted = (await db.fed_bans.bulk_write(queue_insert, ordered=False)).inserted_count
+        await inc_counter(f"fed_bans:{fed['fed_id']}", inserted)
 
     await msg.edit_text(strings['import_done'].format(num=real_counter))
 
@@ -1208,15 +1249,61 @@ async def get_fed_by_creator(creator: int) -> Optional[dict]:
     return await db.feds.find_one({'creator': creator})
 
 
+@cached()
+async def get_fed_id_by_chat(chat_id: int) -> Optional[str]:
+    if fed_chat := await db.fed_chats.find_one({'chat_id': chat_id}):
+        return fed_chat['fed_id']
+
+    # Legacy
+    if fed := await db.feds.find_one({'chats': chat_id}, {'fed_id': 1}):
+        return fed['fed_id']
+
+
+async def migrate_fed_chats():
+    # Move legacy feds.chats arrays into fed_chats, chats are still read from both while it runs
+    count = 0
+    async for fed in db.feds.find({'chats': {'$exists': True}}, {'fed_id': 1, 'chats': 1}):
+        if fed['chats']:
+            await db.fed_chats.bulk_write([
+                UpdateOne({'chat_id': chat_id}, {'$set': {'fed_id': fed['fed_id']}}, upsert=True)
+                for chat_id in set(fed['chats'])
+            ], ordered=False)
+
+        await db.feds.update_one({'_id': fed['_id']}, {'$unset': {'chats': 1}})
+        await get_fed_by_id.reset_cache(fed['fed_id'])
+        count += 1
+        await asyncio.sleep(0)
+
+    if count:
+        log.info(f"Feds: Migrated chats of {count} federations to fed_chats")
+
+
+async def __before_serving__(loop):
+    loop.create_task(migrate_fed_chats())
+
+
 async def __export__(chat_id):
-    if chat_fed := await db.feds.find_one({'chats': [chat_id]}):
-        return {'feds': {'fed_id': chat_fed['fed_id']}}
+    if fed_id := await get_fed_id_by_chat(chat_id):
+        return {'feds': {'fed_id': fed_id}}
 
 
 async def __import__(chat_id, data):
     if fed_id := data['fed_id']:
-        if current_fed := await db.feds.find_one({'chats': [int(chat_id)]}):
-            await db.feds.update_one({'_id': current_fed['_id']}, {'$pull': {'chats': chat_id}})
-            await get_fed_by_id.reset_cache(current_fed['fed_id'])
-        await db.feds.update_one({'fed_id': fed_id}, {'$addToSet': {'chats': chat_id}})
-        await get_fed_by_id.reset_cache(fed_id)
+        await set_chat_fed(int(chat_id), fed_id)
+
+
+__indexes__ = {
+    'feds': [IndexModel('fed_id'), IndexModel('creator'), IndexModel('chats'), IndexModel('subscribed')],
+    'fed_chats': [IndexModel('chat_id', unique=True), IndexModel([('fed_id', 1), ('chat_id', 1)])],
+    'fed_bans': [IndexModel([('fed_id', 1), ('user_id', 1)]), IndexModel('user_id')]
+}
+
+__queries__ = {
+    # iter_fed_chats() pages
+    'fed_chats': [({'fed_id': '', 'chat_id': {'$gt': 0}}, [('chat_id', 1)])],
+    # Bans of the federation and its subscriptions, checked for every new member
+    'fed_bans': [{'fed_id': {'$in': ['']}, 'user_id': 0}, {'fed_id': '', 'origin_fed': '', 'user_id': 0}],
+    'feds': [{'subscribed': {'$in': ['']}}],
+    # /fchatlist titles
+    'chat_list': [{'chat_id': {'$in': [0]}}]
+}
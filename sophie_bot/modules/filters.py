@@ -16,29 +16,28 @@
 
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-import asyncio
-import functools
-import random
-import re
 from contextlib import suppress
-from string import printable
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
 
-import regex
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
 from aiogram.types.inline_keyboard import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import MessageCantBeDeleted, MessageToDeleteNotFound
-from async_timeout import timeout
 from bson.objectid import ObjectId
-from pymongo import UpdateOne
+from pymongo import IndexModel, UpdateOne
+from redis.exceptions import WatchError
 
-from sophie_bot import loop, bot
+from sophie_bot import bot
 from sophie_bot.decorator import register
 from sophie_bot.modules import LOADED_MODULES
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import abredis, aredis, get_value
+from sophie_bot.utils.codec import dumps, versioned_key
 from sophie_bot.utils.logger import log
+from sophie_bot.utils.lru import LRUCache
+from sophie_bot.utils.regex_pool import RegexError, RegexTimeout, regex_pool
 from .utils.connections import chat_connection, get_connected_chat
 from .utils.language import get_strings_dec, get_string
 from .utils.message import need_args_dec, get_args_str
@@ -50,25 +49,74 @@ filter_delall_yes_cb = CallbackData('filter_delall_yes_cb', 'chat_id')
 
 FILTERS_ACTIONS = {}
 
+filters_cache = LRUCache(maxsize=10000, ttl=60, name='filters')
+# Chats without filters are cached as well, so keys of inactive chats have to expire
+FILTERS_CACHE_TTL = 60 * 60 * 24
+
 
 class NewFilter(StatesGroup):
     handler = State()
     setup = State()
 
 
-async def update_handlers_cache(chat_id):
-    redis.delete(f'filters_cache_{chat_id}')
-    filters = db.filters.find({'chat_id': chat_id})
-    handlers = []
-    async for filter in filters:
-        handler = filter['handler']
-        if handler in handlers:
-            continue
+@dataclass
+class ChatFilters:
+    version: int
+    handlers: Tuple[str, ...]
+    # We can have few filters with same handler
+    filters: Dict[str, List[dict]]
+
+
+def _build_chat_filters(version: int, filters: List[dict]) -> ChatFilters:
+    by_handler = {}
+    for filter in filters:
+        by_handler.setdefault(filter['handler'], []).append(filter)
+    return ChatFilters(version=version, handlers=tuple(by_handler), filters=by_handler)
+
+
+def _cache_keys(chat_id) -> Tuple[str, str]:
+    return versioned_key(f'filters_cache:{chat_id}'), versioned_key(f'filters_version:{chat_id}')
+
+
+async def update_handlers_cache(chat_id) -> ChatFilters:
+    cache_key, version_key = _cache_keys(chat_id)
+    # Version is taken before reading, so a rebuild which started later always has the bigger one
+    version = await abredis.incr(version_key)
+    filters = await db.filters.find({'chat_id': chat_id}).to_list(None)
+    chat_filters = _build_chat_filters(version, filters)
+
+    # Filters and their version are written in one transaction, and only if no newer rebuild has started
+    async with abredis.pipeline() as pipe:
+        with suppress(WatchError):
+            await pipe.watch(version_key)
+            if int(await pipe.get(version_key) or 0) == version:
+                pipe.multi()
+                pipe.set(cache_key, dumps({'version': version, 'filters': filters}), ex=FILTERS_CACHE_TTL)
+                pipe.expire(version_key, FILTERS_CACHE_TTL)
+                # Instances of older versions read handlers from this list, make them rebuild it
+                pipe.delete(f'filters_cache_{chat_id}')
+                await pipe.execute()
+                filters_cache.set(chat_id, chat_filters)
+
+    return chat_filters
+
 
-        handlers.append(handler)
-        redis.lpush(f'filters_cache_{chat_id}', handler)
+async def get_chat_filters(chat_id) -> ChatFilters:
+    cache_key, version_key = _cache_keys(chat_id)
 
-    return handlers
+    # Filters could be changed by other instance, the small version key tells if the local copy is still actual
+    if (version := await abredis.get(version_key)) is None:
+        return await update_handlers_cache(chat_id)
+    if (chat_filters := filters_cache.get(chat_id)) is not None and chat_filters.version == int(version):
+        return chat_filters
+
+    # No data of the current version, it's being rebuilt or has expired
+    if not (data := await get_value(cache_key)) or data['version'] != int(version):
+        return await update_handlers_cache(chat_id)
+
+    chat_filters = _build_chat_filters(data['version'], data['filters'])
+    filters_cache.set(chat_id, chat_filters)
+    return chat_filters
 
 
 @register()
@@ -79,10 +127,7 @@ async def check_msg(message):
         return
 
     chat_id = chat['chat_id']
-    if not (filters := redis.lrange(f'filters_cache_{chat_id}', 0, -1)):
-        filters = await update_handlers_cache(chat_id)
-
-    if len(filters) == 0:
+    if not (chat_filters := await get_chat_filters(chat_id)).handlers:
         return
 
     text = message.text
@@ -92,23 +137,12 @@ async def check_msg(message):
         if text[1:].startswith('addfilter') or text[1:].startswith('delfilter'):
             return
 
-    for handler in filters:  # type: str
-        if handler.startswith("re:"):
-            func = functools.partial(regex.search, handler.replace("re:", '', 1), text, timeout=0.1)
-        else:
-            # TODO: Remove this (handler.replace(...)). kept for backward compatibility
-            func = functools.partial(re.search, re.escape(handler).replace('(+)', '(.*)'), text, flags=re.IGNORECASE)
-
-        try:
-            async with timeout(0.1):
-                matched = await loop.run_in_executor(None, func)
-        except (asyncio.TimeoutError, TimeoutError):
-            continue
+    if not (matches := await regex_pool.match(chat_filters.handlers, text)):
+        return
 
+    for handler, matched in zip(chat_filters.handlers, matches):  # type: str, bool
         if matched:
-            # We can have few filters with same handler, that's why we create a new loop.
-            filters = db.filters.find({'chat_id': chat_id, 'handler': handler})
-            async for filter in filters:
+            for filter in chat_filters.filters[handler]:
                 action = filter['action']
                 await FILTERS_ACTIONS[action]['handle'](message, chat, filter)
 
@@ -125,13 +159,14 @@ async def add_handler(message, chat, strings):
     handler = get_args_str(message)
 
     if handler.startswith('re:'):
-        pattern = handler
-        random_text_str = ''.join(random.choice(printable) for i in range(50))
         try:
-            regex.match(pattern, random_text_str, timeout=0.2)
-        except TimeoutError:
+            await regex_pool.validate(handler)
+        except RegexTimeout:
             await message.reply(strings['regex_too_slow'])
             return
+        except RegexError:
+            await message.reply(strings['regex_invalid'])
+            return
     else:
         handler = handler.lower()
 
@@ -150,7 +185,7 @@ async def add_handler(message, chat, strings):
 
     user_id = message.from_user.id
     chat_id = chat['chat_id']
-    redis.set(f'add_filter:{user_id}:{chat_id}', handler)
+    await aredis.set(f'add_filter:{user_id}:{chat_id}', handler)
     if handler is not None:
         await message.reply(text, reply_markup=buttons)
 
@@ -178,7 +213,7 @@ async def register_action(event, chat, strings, callback_data=None, state=None,
     user_id = event.from_user.id
     chat_id = chat['chat_id']
 
-    handler = redis.get(f'add_filter:{user_id}:{chat_id}')
+    handler = await aredis.get(f'add_filter:{user_id}:{chat_id}')
 
     if not handler:
         return await event.answer("Something went wrong! Please try again!", show_alert=True)
@@ -345,6 +380,8 @@ async def delall_filters_no(event: CallbackQuery, strings: dict):
 
 
 async def __before_serving__(loop):
+    regex_pool.start()
+
     log.debug('Adding filters actions')
     for module in LOADED_MODULES:
         if not getattr(module, '__filters__', None):
@@ -376,3 +413,13 @@ async def __import__(chat_id, data):
                              upsert=True))
     await db.filters.bulk_write(new)
     await update_handlers_cache(chat_id)
+
+
+__indexes__ = {
+    'filters': [IndexModel([('chat_id', 1), ('handler', 1)])]
+}
+
+__queries__ = {
+    # Duplicate check on saving
+    'filters': [{'chat_id': 0, 'handler': '', 'action': ''}]
+}
@@ -17,6 +17,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import copy
 import io
 import os
 import random
@@ -36,21 +38,31 @@ from apscheduler.jobstores.base import JobLookupError
 from babel.dates import format_timedelta
 from captcha.image import ImageCaptcha
 from telethon.tl.custom import Button
+from pymongo import IndexModel
 
 from sophie_bot import BOT_USERNAME, BOT_ID, bot, dp
 from sophie_bot.decorator import register
 from sophie_bot.services.apscheduller import scheduler
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis
 from sophie_bot.services.telethon import tbot
 from sophie_bot.stuff.fonts import ALL_FONTS
+from sophie_bot.utils.logger import log
+from .utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from .utils.connections import chat_connection
-from .utils.language import get_strings_dec
+from .utils.language import get_strings, get_strings_dec
 from .utils.message import need_args_dec, convert_time
 from .utils.notes import get_parsed_note_list, unparse_note_item, send_note
+from .utils.purge import purge_messages
 from .utils.restrictions import mute_user, restrict_user, unmute_user, kick_user
 from .utils.user_details import is_user_admin, get_user_link, check_admin_rights
-from ..utils.cached import cached
+from ..utils.metrics import register_queue
+from ..utils.timer_wheel import TimerWheel
+
+
+JOIN_BATCH_WINDOW = float(os.getenv('JOIN_BATCH_WINDOW', 2))
+JOIN_BATCHES = {}
+register_queue('join_batches', lambda: sum(len(x) for x in JOIN_BATCHES.values()))
 
 
 class WelcomeSecurityState(StatesGroup):
@@ -137,7 +149,7 @@ async def set_welcome(message, chat, strings):
     if args[0] in no:
         await db.greetings.update_one({'chat_id': chat_id}, {'$set': {'chat_id': chat_id, 'welcome_disabled': True}},
                                       upsert=True)
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['turnwelcome_disabled'] % chat['chat_title'])
         return
     else:
@@ -152,7 +164,7 @@ async def set_welcome(message, chat, strings):
         else:
             text = strings['saved']
 
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(text % chat['chat_title'])
 
 
@@ -163,11 +175,11 @@ async def reset_welcome(message, chat, strings):
     chat_id = chat['chat_id']
 
     if (await db.greetings.delete_one({'chat_id': chat_id})).deleted_count < 1:
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['not_found'])
         return
 
-    await get_greetings_data.reset_cache(chat_id)
+    invalidate_chat_settings(chat_id)
     await message.reply(strings['deleted'].format(chat=chat['chat_title']))
 
 
@@ -197,11 +209,11 @@ async def clean_welcome(message, chat, strings):
             {'$set': {'chat_id': chat_id, 'clean_welcome': {'enabled': True}}},
             upsert=True
         )
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['cleanwelcome_enabled'] % chat['chat_title'])
     elif args[0] in no:
         await db.greetings.update_one({'chat_id': chat_id}, {'$unset': {'clean_welcome': 1}}, upsert=True)
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['cleanwelcome_disabled'] % chat['chat_title'])
     else:
         await message.reply(strings['bool_invalid_arg'])
@@ -233,11 +245,11 @@ async def clean_service(message, chat, strings):
             {'$set': {'chat_id': chat_id, 'clean_service': {'enabled': True}}},
             upsert=True
         )
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['cleanservice_enabled'] % chat['chat_title'])
     elif args[0] in no:
         await db.greetings.update_one({'chat_id': chat_id}, {'$unset': {'clean_service': 1}}, upsert=True)
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['cleanservice_disabled'] % chat['chat_title'])
     else:
         await message.reply(strings['bool_invalid_arg'])
@@ -268,7 +280,7 @@ async def welcome_mute(message, chat, strings):
             {'$set': {'chat_id': chat_id, 'welcome_mute': {'enabled': True, 'time': args[0]}}},
             upsert=True
         )
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         text = strings['welcomemute_enabled'] % chat['chat_title']
         try:
             await message.reply(text)
@@ -277,7 +289,7 @@ async def welcome_mute(message, chat, strings):
     elif args[0] in no:
         text = strings['welcomemute_disabled'] % chat['chat_title']
         await db.greetings.update_one({'chat_id': chat_id}, {'$unset': {'welcome_mute': 1}}, upsert=True)
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         try:
             await message.reply(text)
         except BadRequest:
@@ -323,7 +335,7 @@ async def welcome_security(message, chat, strings):
         level = args[0].lower()
     elif args[0] in no:
         await db.greetings.update_one({'chat_id': chat_id}, {'$unset': {'welcome_security': 1}}, upsert=True)
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['welcomesecurity_disabled'] % chat['chat_title'])
         return
     else:
@@ -335,7 +347,7 @@ async def welcome_security(message, chat, strings):
         {'$set': {'chat_id': chat_id, 'welcome_security': {'enabled': True, 'level': level}}},
         upsert=True
     )
-    await get_greetings_data.reset_cache(chat_id)
+    invalidate_chat_settings(chat_id)
     buttons = InlineKeyboardMarkup()
     buttons.add(
         InlineKeyboardButton(
@@ -400,7 +412,7 @@ async def wlcm_sec_time_state(message: Message, chat: dict, strings: dict, state
             {"chat_id": chat["chat_id"]},
             {"$set": {"welcome_security.expire": message.text}}
         )
-        await get_greetings_data.reset_cache(chat['chat_id'])
+        invalidate_chat_settings(chat['chat_id'])
         await message.reply(
             strings["welcomesecurity_enabled:customized_time"].format(
                 chat_name=chat['chat_title'], level=level, time=format_timedelta(
@@ -436,10 +448,10 @@ async def set_security_note(message, chat, strings):
 
     if (await db.greetings.update_one({'chat_id': chat_id}, {'$set': {'chat_id': chat_id, 'security_note': note}},
                                       upsert=True)).modified_count > 0:
-        await get_greetings_data.reset_cache(chat_id)
         text = strings['security_note_updated']
     else:
         text = strings['security_note_saved']
+    invalidate_chat_settings(chat_id)
 
     await message.reply(text % chat['chat_title'])
 
@@ -452,7 +464,7 @@ async def reset_security_note(message, chat, strings):
 
     if (await db.greetings.update_one({'chat_id': chat_id}, {'$unset': {'security_note': 1}},
                                       upsert=True)).modified_count > 0:
-        await get_greetings_data.reset_cache(chat_id)
+        invalidate_chat_settings(chat_id)
         text = strings['security_note_updated']
     else:
         text = strings['del_security_note_ok']
@@ -460,21 +472,10 @@ async def reset_security_note(message, chat, strings):
     await message.reply(text % chat['chat_title'])
 
 
-@register(only_groups=True, f='welcome')
-@get_strings_dec('greetings')
-async def welcome_security_handler(message: Message, strings):
-    if len(message.new_chat_members) > 1:
-        # FIXME: Sophie doesnt support adding multiple users currently
-        return
-
-    new_user = message.new_chat_members[0]
+async def welcome_security_handler(message: Message, members: list, strings):
     chat_id = message.chat.id
-    user_id = new_user.id
-
-    if user_id == BOT_ID:
-        return
 
-    db_item = await get_greetings_data(message.chat.id)
+    db_item = await get_greetings_data(chat_id)
     if not db_item or 'welcome_security' not in db_item:
         return
 
@@ -482,56 +483,103 @@ async def welcome_security_handler(message: Message, strings):
         await message.reply(strings['not_admin_ws'])
         return
 
-    user = await message.chat.get_member(user_id)
-    # Check if user was muted before
-    if user['status'] == 'restricted':
-        if user['can_send_messages'] is False:
-            return
+    async def mute_new_user(new_user, join_message):
+        user_id = new_user.id
 
-    # Check on OPs and chat owner
-    if await is_user_admin(chat_id, user_id):
-        return
+        user = await bot.get_chat_member(chat_id, user_id)
+        # Check if user was muted before
+        if user['status'] == 'restricted':
+            if user['can_send_messages'] is False:
+                return
 
-    # check if user added is a bot
-    if new_user.is_bot and await is_user_admin(chat_id, message.from_user.id):
-        return
+        # Check on OPs and chat owner
+        if await is_user_admin(chat_id, user_id):
+            return
+
+        # check if user added is a bot
+        if new_user.is_bot and await is_user_admin(chat_id, join_message.from_user.id):
+            return
 
-    # Mute user
-    try:
         await mute_user(chat_id, user_id)
-    except BadRequest as error:
-        return await message.reply(f'welcome security failed due to {error.args[0]}')
+        return new_user, join_message
+
+    # Mute all users concurrently, users which were muted must get the security message even if others failed
+    muted = []
+    errors = set()
+    for (new_user, _), result in zip(members, await asyncio.gather(
+            *[mute_new_user(*x) for x in members], return_exceptions=True
+    )):
+        if isinstance(result, BadRequest):
+            errors.add(result.args[0])
+        elif isinstance(result, Exception):
+            log.error(f"Welcome security: Can't mute {new_user.id} in {chat_id}", exc_info=result)
+        elif result:
+            muted.append(result)
+
+    if errors:
+        await message.reply(f'welcome security failed due to {", ".join(errors)}')
+
+    if not muted:
+        return
 
     if 'security_note' not in db_item:
         db_item['security_note'] = {}
         db_item['security_note']['text'] = strings['default_security_note']
         db_item['security_note']['parse_mode'] = 'md'
 
-    text, kwargs = await unparse_note_item(message, db_item['security_note'], chat_id)
+    text, kwargs = await unparse_note_item(message, db_item['security_note'], chat_id, users=[x[0] for x in muted])
 
     kwargs['reply_to'] = (None if 'clean_service' in db_item and db_item['clean_service']['enabled'] is True
                           else message.message_id)
 
+    # Button of batch message isn't bound to one user, users are checked in ws_redirecter
+    btn_user_id = muted[0][0].id if len(muted) == 1 else 0
     kwargs['buttons'] = [] if not kwargs['buttons'] else kwargs['buttons']
-    kwargs['buttons'] += [Button.inline(strings['click_here'], f'ws_{chat_id}_{user_id}')]
+    kwargs['buttons'] += [Button.inline(strings['click_here'], f'ws_{chat_id}_{btn_user_id}')]
 
-    msg = await send_note(chat_id, text, **kwargs)
-
-    redis.set(f'welcome_security_users:{user_id}:{chat_id}', msg.id)
+    if not (msgs := await send_note(chat_id, text, **kwargs)):
+        return
+    msg = msgs[-1]
 
     if raw_time := db_item['welcome_security'].get('expire', None):
         time = convert_time(raw_time)
     else:
-        time = convert_time(get_str_key('JOIN_CONFIRM_DURATION'))
-
-    scheduler.add_job(
-        join_expired,
-        "date",
-        id=f"wc_expire:{chat_id}:{user_id}",
-        run_date=datetime.utcnow() + time,
-        kwargs={'chat_id': chat_id, 'user_id': user_id, 'message_id': msg.id, 'wlkm_msg_id': message.message_id},
-        replace_existing=True
-    )
+        time = convert_time(os.getenv('JOIN_CONFIRM_DURATION', '2h'))
+
+    # Rejoined users, forget their previous expiry timer
+    old_msg_ids = await aredis.mget([f'welcome_security_users:{new_user.id}:{chat_id}' for new_user, _ in muted])
+    for (new_user, _), old_msg_id in zip(muted, old_msg_ids):
+        if old_msg_id:
+            await join_expire_timers.remove(f'{chat_id}:{new_user.id}:{old_msg_id}')
+
+    batch_key = _ws_batch.format(chat=chat_id, msg=msg.id)
+    async with aredis.pipeline() as pipe:
+        pipe.sadd(batch_key, *[new_user.id for new_user, _ in muted])
+        pipe.expire(batch_key, int(time.total_seconds()) + 3600)
+        for new_user, _ in muted:
+            pipe.set(f'welcome_security_users:{new_user.id}:{chat_id}', msg.id)
+        await pipe.execute()
+
+    due = datetime.now() + time
+    for new_user, join_message in muted:
+        await join_expire_timers.add(f'{chat_id}:{new_user.id}:{msg.id}', due, payload=join_message.message_id)
+
+
+async def release_security_message(chat_id, message_id, user_id) -> bool:
+    """Removes user from security message's batch, returns True if no one else is waiting on it"""
+    # Message of single user has no batch, so its SCARD is 0 as well
+    async with aredis.pipeline() as pipe:
+        pipe.srem(_ws_batch.format(chat=chat_id, msg=message_id), user_id)
+        pipe.scard(_ws_batch.format(chat=chat_id, msg=message_id))
+        return (await pipe.execute())[1] == 0
+
+
+async def join_expired_timer(member: str, wlkm_msg_id: str):
+    chat_id, user_id, message_id = (int(x) for x in member.split(':'))
+    await join_expired(chat_id, user_id, message_id, int(wlkm_msg_id))
+
+
+join_expire_timers = TimerWheel('wc_expire', join_expired_timer)
 
 
 async def join_expired(chat_id, user_id, message_id, wlkm_msg_id):
@@ -544,11 +592,16 @@ async def join_expired(chat_id, user_id, message_id, wlkm_msg_id):
         return
 
     key = 'leave_silent:' + str(chat_id)
-    redis.set(key, user_id)
+    await aredis.set(key, user_id, ex=30)
 
     await unmute_user(chat_id, user_id)
     await kick_user(chat_id, user_id)
-    await tbot.delete_messages(chat_id, [message_id, wlkm_msg_id])
+
+    await aredis.delete(f'welcome_security_users:{user_id}:{chat_id}')
+    to_delete = [wlkm_msg_id]
+    if await release_security_message(chat_id, message_id, user_id):
+        to_delete.append(message_id)
+    await purge_messages(chat_id, to_delete)
 
 
 @register(regexp=re.compile(r'ws_'), f='cb')
@@ -562,7 +615,7 @@ async def ws_redirecter(message, strings):
     url = f'https://t.me/{BOT_USERNAME}?start=ws_{chat_id}_{called_user_id}_{message.message.message_id}'
     if not called_user_id == real_user_id:
         # The persons which are muted before wont have their signatures registered on cache
-        if not redis.exists(f"welcome_security_users:{called_user_id}:{chat_id}"):
+        if not await aredis.exists(f"welcome_security_users:{called_user_id}:{chat_id}"):
             await message.answer(strings['not_allowed'], show_alert=True)
             return
         else:
@@ -785,14 +838,18 @@ async def welcome_security_passed(message: Union[CallbackQuery, Message], state,
         await bot.delete_message(user_id, verify_msg_id)
     await state.finish()
 
+    message_id = await aredis.get(f"welcome_security_users:{user_id}:{chat_id}")
     with suppress(MessageToDeleteNotFound, MessageCantBeDeleted):
-        message_id = redis.get(f"welcome_security_users:{user_id}:{chat_id}")
-        # Delete the person's real security button if exists!
-        if message_id:
+        # Delete the person's real security button if exists and nobody else from batch still needs it!
+        if message_id and await release_security_message(chat_id, message_id, user_id):
             await bot.delete_message(chat_id, message_id)
 
-    redis.delete(f"welcome_security_users:{user_id}:{chat_id}")
+    await aredis.delete(f"welcome_security_users:{user_id}:{chat_id}")
 
+    if message_id:
+        await join_expire_timers.remove(f'{chat_id}:{user_id}:{message_id}')
+
+    # Jobs scheduled with apscheduler before timer wheel was used
     with suppress(JobLookupError):
         scheduler.remove_job(f"wc_expire:{chat_id}:{user_id}")
 
@@ -844,18 +901,46 @@ async def welcome_security_passed(message: Union[CallbackQuery, Message], state,
 
 # Welcomes
 @register(only_groups=True, f='welcome')
-@get_strings_dec('greetings')
-async def welcome_trigger(message: Message, strings):
-    if len(message.new_chat_members) > 1:
-        # FIXME: Sophie doesnt support adding multiple users currently
+async def join_handler(message: Message):
+    chat_id = message.chat.id
+
+    # Collect joins of the chat for a short window, so join storm is handled by one batch
+    if chat_id in JOIN_BATCHES:
+        JOIN_BATCHES[chat_id].append(message)
         return
 
-    chat_id = message.chat.id
-    user_id = message.new_chat_members[0].id
+    JOIN_BATCHES[chat_id] = [message]
+    # Batch is handled by its own task, so the other handlers of the update don't wait for the window
+    asyncio.ensure_future(flush_join_batch(chat_id))
+
 
-    if user_id == BOT_ID:
+async def flush_join_batch(chat_id: int):
+    try:
+        await asyncio.sleep(JOIN_BATCH_WINDOW)
+    finally:
+        messages = JOIN_BATCHES.pop(chat_id)
+
+    new_users = {}
+    for join_message in messages:
+        for new_user in join_message.new_chat_members:
+            if new_user.id != BOT_ID:
+                new_users[new_user.id] = (new_user, join_message)
+
+    if not new_users:
         return
 
+    strings = await get_strings(chat_id, 'greetings')
+    members = list(new_users.values())
+    try:
+        await welcome_security_handler(messages[-1], members, strings)
+        await welcome_trigger(messages[-1], members, strings)
+    except Exception as err:
+        log.error(f"Greetings: Can't handle joins batch in {chat_id}", exc_info=err)
+
+
+async def welcome_trigger(message: Message, members: list, strings):
+    chat_id = message.chat.id
+
     if not (db_item := await get_greetings_data(message.chat.id)):
         db_item = {}
 
@@ -873,27 +958,27 @@ async def welcome_trigger(message: Message, strings):
         }
     reply_to = (message.message_id if 'clean_welcome' in db_item and db_item['clean_welcome']['enabled'] is not False
                 else None)
-    text, kwargs = await unparse_note_item(message, db_item['note'], chat_id)
-    msg = await send_note(chat_id, text, reply_to=reply_to, **kwargs)
+    text, kwargs = await unparse_note_item(message, db_item['note'], chat_id, users=[x[0] for x in members])
+    msgs = await send_note(chat_id, text, reply_to=reply_to, **kwargs)
     # Clean welcome
-    if 'clean_welcome' in db_item and db_item['clean_welcome']['enabled'] is not False:
-        if 'last_msg' in db_item['clean_welcome']:
-            with suppress(MessageToDeleteNotFound, MessageCantBeDeleted):
-                if value := redis.get(_clean_welcome.format(chat=chat_id)):
-                    await bot.delete_message(chat_id, value)
-        redis.set(_clean_welcome.format(chat=chat_id), msg.id)
+    if msgs and 'clean_welcome' in db_item and db_item['clean_welcome']['enabled'] is not False:
+        if value := await aredis.getset(_clean_welcome.format(chat=chat_id), msgs[-1].id):
+            await purge_messages(chat_id, [value])
 
     # Welcome mute
-    if user_id == BOT_ID:
-        return
     if 'welcome_mute' in db_item and db_item['welcome_mute']['enabled'] is not False:
-        user = await bot.get_chat_member(chat_id, user_id)
-        if 'can_send_messages' not in user or user['can_send_messages'] is True:
-            if not await check_admin_rights(message, chat_id, BOT_ID, ['can_restrict_members']):
-                await message.reply(strings['not_admin_wm'])
-                return
+        if not await check_admin_rights(message, chat_id, BOT_ID, ['can_restrict_members']):
+            await message.reply(strings['not_admin_wm'])
+            return
 
-            await restrict_user(chat_id, user_id, until_date=convert_time(db_item['welcome_mute']['time']))
+        until_date = convert_time(db_item['welcome_mute']['time'])
+
+        async def welcome_mute(user_id):
+            user = await bot.get_chat_member(chat_id, user_id)
+            if 'can_send_messages' not in user or user['can_send_messages'] is True:
+                await restrict_user(chat_id, user_id, until_date=until_date)
+
+        await asyncio.gather(*[welcome_mute(new_user.id) for new_user, _ in members])
 
 
 # Clean service trigger
@@ -920,11 +1005,16 @@ async def clean_service_trigger(message, strings):
 
 
 _clean_welcome = 'cleanwelcome:{chat}'
+_ws_batch = 'welcome_security_batch:{chat}:{msg}'
 
 
-@cached()
 async def get_greetings_data(chat: int) -> Optional[dict]:
-    return await db.greetings.find_one({'chat_id': chat})
+    if greetings := (await get_chat_settings(chat)).greetings:
+        return copy.deepcopy(greetings)
+
+
+async def __before_serving__(loop):
+    loop.create_task(join_expire_timers.poll())
 
 
 async def __export__(chat_id):
@@ -937,4 +1027,9 @@ async def __export__(chat_id):
 
 async def __import__(chat_id, data):
     await db.greetings.update_one({'chat_id': chat_id}, {'$set': data}, upsert=True)
-    await get_greetings_data.reset_cache(chat_id)
+    invalidate_chat_settings(chat_id)
+
+
+__indexes__ = {
+    'greetings': [IndexModel('chat_id')]
+}
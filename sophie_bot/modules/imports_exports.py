@@ -37,7 +37,7 @@ from sophie_bot.decorator import register
 from sophie_bot.models.imports_exports import ExportModel, GeneralData, ExportInfo
 from sophie_bot.modules.utils.message import get_arg
 from sophie_bot.modules.utils.text import SanTeXDoc, Section, Code, KeyValue, VList
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import try_lock
 from . import LOADED_MODULES
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
@@ -59,14 +59,11 @@ class ImportFileWait(StatesGroup):
 async def export_chat_data(message, chat, strings):
     chat_id = chat['chat_id']
     key = 'export_lock:' + str(chat_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if ttl := await try_lock(key, 7200, force=message.from_user.id in OPERATORS):
+        ttl = format_timedelta(timedelta(seconds=ttl), strings['language_info']['babel'])
         await message.reply(strings['exports_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 7200)
-
     msg = await message.reply(strings['started_exporting'])
     modules = {}
 
@@ -127,14 +124,11 @@ async def import_state(message, state=None, **kwargs):
 async def import_fun(message, document, chat, strings):
     chat_id = chat['chat_id']
     key = 'import_lock:' + str(chat_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if ttl := await try_lock(key, 7200, force=message.from_user.id in OPERATORS):
+        ttl = format_timedelta(timedelta(seconds=ttl), strings['language_info']['babel'])
         await message.reply(strings['imports_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 7200)
-
     arg = get_arg(message)
     overwrite = False
     if arg in ('overwrite', 'replace'):
@@ -22,9 +22,9 @@ from contextlib import suppress
 from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import MessageNotModified
+from pymongo import IndexModel
 
 from sophie_bot.decorator import register
-from sophie_bot.services.mongo import db
 from .utils.language import LANGUAGES, get_strings_dec, change_chat_lang, get_chat_lang_info, get_strings
 from .utils.message import get_arg
 
@@ -129,4 +129,9 @@ async def __export__(chat_id):
 async def __import__(chat_id, data):
     if data not in LANGUAGES:
         return
-    await db.lang.update_one({'chat_id': chat_id}, {"$set": {'lang': data}}, upsert=True)
+    await change_chat_lang(chat_id, data)
+
+
+__indexes__ = {
+    'lang': [IndexModel('chat_id')]
+}
@@ -17,15 +17,68 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import itertools
+from dataclasses import dataclass
+from typing import Dict
 
+from aiogram.types import ChatMemberUpdated
 from aiogram.types.chat_permissions import ChatPermissions
 
-from sophie_bot import bot
+from sophie_bot import bot, dp
 from sophie_bot.decorator import register
+from sophie_bot.utils.lru import LRUCache
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
 
+LOCK_TYPES = {
+    'all': 'can_send_messages',
+    'media': 'can_send_media_messages',
+    'polls': 'can_send_polls',
+    'others': 'can_send_other_messages'
+}
+
+# Telegram doesn't notify about permissions changed by others, so keep them only for a while and only to show
+# them in /locks, changing locks always starts from the current permissions
+permissions_cache = LRUCache(maxsize=5000, ttl=300, name='chat_permissions')
+
+
+@dataclass(frozen=True)
+class LockState:
+    chat_id: int
+    permissions: ChatPermissions
+
+    def is_locked(self, lock: str) -> bool:
+        return not getattr(self.permissions, LOCK_TYPES[lock])
+
+    @property
+    def locks(self) -> Dict[str, bool]:
+        return {lock: self.is_locked(lock) for lock in LOCK_TYPES}
+
+    def merge(self, locks: Dict[str, bool]) -> ChatPermissions:
+        """Returns full chat permissions with the given locks applied"""
+        permissions = self.permissions.to_python()
+        permissions.update({LOCK_TYPES[lock]: not locked for lock, locked in locks.items()})
+        return ChatPermissions(**permissions)
+
+
+async def get_lock_state(chat_id: int, fresh: bool = False) -> LockState:
+    if fresh or (permissions := permissions_cache.get(chat_id)) is None:
+        permissions = (await bot.get_chat(chat_id)).permissions
+        permissions_cache.set(chat_id, permissions)
+
+    return LockState(chat_id, permissions)
+
+
+async def set_locks(state: LockState, locks: Dict[str, bool]) -> LockState:
+    permissions = state.merge(locks)
+    await bot.set_chat_permissions(state.chat_id, permissions)
+    permissions_cache.set(state.chat_id, permissions)
+    return LockState(state.chat_id, permissions)
+
+
+async def reset_chat_permissions(update: ChatMemberUpdated):
+    # Bot's rights were changed, the chat could be changed too while we weren't able to see it
+    permissions_cache.pop(update.chat.id)
+
 
 @register(cmds=["locks", "locktypes"], user_admin=True)
 @chat_connection(only_groups=True)
@@ -35,76 +88,47 @@ async def lock_types(message, chat, strings):
     chat_title = chat['chat_title']
     text = strings['locks_header'].format(chat_title=chat_title)
 
-    async for lock, status in lock_parser(chat_id):
+    for lock, status in (await get_lock_state(chat_id)).locks.items():
         text += f"- {lock} = {status} \n"
     await message.reply(text)
 
 
-@register(cmds="lock", user_can_restrict_members=True, bot_can_restrict_members=True)
-@chat_connection(only_groups=True)
-@get_strings_dec('locks')
-async def lock_cmd(message, chat, strings):
+async def toggle_locks(message, chat, strings, lock):
     chat_id = chat['chat_id']
     chat_title = chat['chat_title']
 
-    if (args := message.get_args().split(' ', 1)) == ['']:
-        await message.reply(strings['no_lock_args'])
+    if not (args := message.get_args().split()):
+        await message.reply(strings['no_lock_args' if lock else 'no_unlock_args'])
+        return
+
+    if any(arg not in LOCK_TYPES for arg in args):
+        await message.reply(strings['no_such_lock'])
         return
 
-    async for lock, status in lock_parser(chat_id, rev=True):
-        if args[0] == lock[0]:
-            if status is True:
-                await message.reply(strings['already_locked'])
-                continue
+    # Cached permissions could be outdated and setting them would revert changes made in the Telegram UI
+    state = await get_lock_state(chat_id, fresh=True)
+    if not (to_change := [arg for arg in dict.fromkeys(args) if state.is_locked(arg) is not lock]):
+        await message.reply(strings['already_locked' if lock else 'not_locked'])
+        return
 
-            to_lock = {lock[1]: False}
-            new_perm = ChatPermissions(
-                **to_lock
-            )
-            await bot.set_chat_permissions(chat_id, new_perm)
-            await message.reply(strings['locked_successfully'].format(lock=lock[0], chat=chat_title))
+    await set_locks(state, {arg: lock for arg in to_change})
+    text = strings['locked_successfully' if lock else 'unlocked_successfully']
+    await message.reply(text.format(lock=', '.join(to_change), chat=chat_title))
+
+
+@register(cmds="lock", user_can_restrict_members=True, bot_can_restrict_members=True)
+@chat_connection(only_groups=True)
+@get_strings_dec('locks')
+async def lock_cmd(message, chat, strings):
+    await toggle_locks(message, chat, strings, True)
 
 
 @register(cmds="unlock", user_can_restrict_members=True, bot_can_restrict_members=True)
 @chat_connection(only_groups=True)
 @get_strings_dec('locks')
 async def unlock_cmd(message, chat, strings):
-    chat_id = chat['chat_id']
-    chat_title = chat['chat_title']
+    await toggle_locks(message, chat, strings, False)
 
-    if (args := message.get_args().split(' ', 1)) == ['']:
-        await message.reply(strings['no_unlock_args'])
-        return
 
-    async for lock, status in lock_parser(chat_id, rev=True):
-        if args[0] == lock[0]:
-            if status is False:
-                await message.reply(strings['not_locked'])
-                continue
-
-            to_unlock = {lock[1]: True}
-            new_perm = ChatPermissions(
-                **to_unlock
-            )
-            await bot.set_chat_permissions(chat_id, new_perm)
-            await message.reply(strings['unlocked_successfully'].format(lock=lock[0], chat=chat_title))
-
-
-async def lock_parser(chat_id, rev=False):
-    keywords = {
-        'all': 'can_send_messages',
-        'media': 'can_send_media_messages',
-        'polls': 'can_send_polls',
-        'others': 'can_send_other_messages'
-    }
-    current_lock = (await bot.get_chat(chat_id)).permissions
-
-    for lock, keyword in itertools.zip_longest(dict(current_lock).keys(), keywords.items()):
-        if keyword is not None and lock in keyword:
-            if rev:
-                lock = list([keyword[0], keyword[1]])
-                status = not current_lock[keyword[1]]
-            else:
-                status = not current_lock[lock]
-                lock = keyword[0]
-            yield lock, status
+async def __before_serving__(loop):
+    dp.register_my_chat_member_handler(reset_chat_permissions)
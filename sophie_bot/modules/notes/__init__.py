@@ -3,4 +3,6 @@ from .handlers.config import *
 from .handlers.get import *
 from .handlers.info import *
 from .handlers.saving import *
-from .handlers.utils import __stats__, __import_data__, __export_data__, __data_model__
+from .handlers.utils import (  # noqa: F401
+    __before_serving__, __stats__, __import_data__, __export_data__, __data_model__, __indexes__, __queries__
+)
@@ -27,7 +27,7 @@ from aiogram.utils.exceptions import MessageCantBeDeleted
 from sophie_bot.decorator import register
 from sophie_bot.modules.utils.notes import BUTTONS
 from sophie_bot.services.mongo import engine
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis, get_hash
 from ..models import SavedNote
 from ..utils.get import get_note
 from ...utils.language import get_strings_dec
@@ -73,7 +73,7 @@ async def note_start(message, strings, regexp=None, **kwargs):
 @get_strings_dec('connections')
 async def btn_note_start_state(message, strings):
     key = 'btn_note_start_state:' + str(message.from_user.id)
-    if not (cached := redis.hgetall(key)):
+    if not (cached := await get_hash(key)):
         return
 
     chat_id = int(cached['chat_id'])
@@ -83,4 +83,4 @@ async def btn_note_start_state(message, strings):
     note = await engine.find_one(SavedNote, (SavedNote.chat_id == chat_id) & (SavedNote.names.in_([note_name])))
     await get_note(message, note.note, chat_id=chat_id, send_id=user_id, rpl_id=None)
 
-    redis.delete(key)
+    await aredis.delete(key)
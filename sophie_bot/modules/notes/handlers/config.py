@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from sophie_bot.decorator import register
+from sophie_bot.modules.utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from sophie_bot.modules.utils.connections import chat_connection
 from sophie_bot.modules.utils.language import get_strings_dec
 from sophie_bot.modules.utils.message import get_arg, ENABLE_KEYWORDS, DISABLE_KEYWORDS
@@ -30,7 +31,7 @@ from ..models import CleanNotes, PrivateNotes
 @chat_connection(admin=True)
 @get_strings_dec('notes')
 async def private_notes_cmd_status(message, chat, strings):
-    if await engine.find_one(PrivateNotes, PrivateNotes.chat_id == chat['chat_id']):
+    if (await get_chat_settings(chat['chat_id'])).private_notes:
         state = strings['enabled']
     else:
         state = strings['disabled']
@@ -53,12 +54,14 @@ async def private_notes_cmd(message, chat, strings):
 
     if arg in ENABLE_KEYWORDS:
         await engine.save(PrivateNotes(chat_id=chat_id))
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['enabled_successfully'].format(chat_name=chat_name))
     elif arg in DISABLE_KEYWORDS:
         if not data:
             return await message.reply(strings['not_enabled'])
 
         await engine.delete(data)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['disabled_successfully'].format(chat_name=chat_name))
     else:
         return await message.reply(strings['wrong_keyword'])
@@ -68,7 +71,7 @@ async def private_notes_cmd(message, chat, strings):
 @chat_connection(admin=True)
 @get_strings_dec('notes')
 async def clean_notes_status(message, chat, strings):
-    if await engine.find_one(CleanNotes, CleanNotes.chat_id == chat['chat_id']):
+    if (await get_chat_settings(chat['chat_id'])).clean_notes:
         return await message.reply(strings['clean_notes_enabled'].format(chat_name=chat['chat_title']))
     else:
         return await message.reply(strings['clean_notes_disabled'].format(chat_name=chat['chat_title']))
@@ -97,4 +100,5 @@ async def clean_notes(message, chat, strings):
     else:
         return await message.reply(strings['wrong_keyword'])
 
+    invalidate_chat_settings(chat_id)
     await message.reply(text)
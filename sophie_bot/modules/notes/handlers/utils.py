@@ -21,29 +21,56 @@
 from contextlib import suppress
 
 from aiogram.utils.exceptions import MessageNotModified
-from pymongo import UpdateOne
+from pymongo import IndexModel, UpdateOne
 
+from sophie_bot.modules.utils.chat_settings import get_chat_settings
 from sophie_bot.modules.utils.language import get_string
 from sophie_bot.services.mongo import db, engine
-from ..models import SavedNote, PrivateNotes, CleanNotes, ExportModel, MAX_NOTES_PER_CHAT
+from ..models import SavedNote, ExportModel, MAX_NOTES_PER_CHAT
+from ..utils.clean_notes import migrate_clean_notes_msgs
 from ..utils.get import get_note
 from ..utils.saving import get_notes_count
 
 __data_model__ = ExportModel
 
+__indexes__ = {
+    'saved_note': [IndexModel([('chat_id', 1), ('names', 1)])],
+    'notes': [IndexModel([('chat_id', 1), ('names', 1)])],
+    'clean_notes': [IndexModel('chat_id')],
+    'private_notes': [IndexModel('chat_id')]
+}
+
+__queries__ = {
+    # get_note(), /get and #note
+    'saved_note': [
+        {'chat_id': 0, 'names': {'$in': ['']}},
+        # Group name check on saving
+        {'chat_id': 0, 'group': {'$in': ['']}},
+        # /notes list
+        ({'chat_id': 0}, [('group', 1), ('names', 1)])
+    ],
+    # Notes of the old format
+    'notes': [{'chat_id': 0, 'names': {'$in': ['']}}]
+}
+
+
+async def __before_serving__(loop):
+    loop.create_task(migrate_clean_notes_msgs())
+
 
 async def __stats__():
     text = "* <code>{}</code> total notes\n".format(
-        await db.notes.count_documents({})
+        await db.notes.estimated_document_count()
     )
     return text
 
 
 async def __export_data__(chat_id) -> ExportModel:
+    settings = await get_chat_settings(chat_id)
     return ExportModel(
         notes=await engine.find(SavedNote, SavedNote.chat_id == chat_id),
-        private_notes=True if await engine.find_one(PrivateNotes, PrivateNotes.chat_id == chat_id) else False,
-        clean_notes=True if await engine.find_one(CleanNotes, CleanNotes.chat_id == chat_id) else False
+        private_notes=settings.private_notes,
+        clean_notes=settings.clean_notes
     )
 
 
@@ -1,11 +1,13 @@
-from contextlib import suppress
 from functools import wraps
 
-from telethon.errors.rpcerrorlist import MessageDeleteForbiddenError
+from sophie_bot.modules.utils.chat_settings import get_chat_settings
+from sophie_bot.modules.utils.purge import queue_purge
+from sophie_bot.services.mongo import db
+from sophie_bot.services.redis import aredis
+from sophie_bot.utils.logger import log
 
-from sophie_bot.services.mongo import engine
-from sophie_bot.services.telethon import tbot
-from ..models import CleanNotes
+# Bots can't delete messages older than 48 hours, no need to keep them longer
+CLEAN_NOTES_TTL = 48 * 60 * 60
 
 
 def clean_notes(func):
@@ -22,23 +24,42 @@ def clean_notes(func):
         if event.chat.type == 'private':
             return
 
-        if not (data := await engine.find_one(CleanNotes, CleanNotes.chat_id == chat_id)):
+        if not (await get_chat_settings(chat_id)).clean_notes:
             return
 
-        if data.msgs:
-            with suppress(MessageDeleteForbiddenError):
-                await tbot.delete_messages(chat_id, data.msgs)
+        msgs = [msg.message_id if hasattr(msg, 'message_id') else msg.id for msg in messages]
+        msgs.append(event.message_id)
 
-        data.msgs = []
+        key = _clean_notes_key(chat_id)
+        async with aredis.pipeline() as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            pipe.rpush(key, *msgs)
+            pipe.expire(key, CLEAN_NOTES_TTL)
+            old_msgs = (await pipe.execute())[0]
 
-        for msg in messages:
-            if hasattr(msg, 'message_id'):
-                data.msgs.append(msg.message_id)
-            else:
-                data.msgs.append(msg.id)
+        if old_msgs:
+            queue_purge(chat_id, map(int, old_msgs))
 
-        data.msgs.append(event.message_id)
+    return wrapped_1
 
-        await engine.save(data)
 
-    return wrapped_1
+def _clean_notes_key(chat_id):
+    return f'clean_notes:{chat_id}'
+
+
+async def migrate_clean_notes_msgs():
+    # Messages were kept in CleanNotes.msgs before, move them to Redis to be deleted with the next note
+    count = 0
+    async for item in db.clean_notes.find({'msgs.0': {'$exists': True}}, {'chat_id': 1, 'msgs': 1}):
+        key = _clean_notes_key(item['chat_id'])
+        async with aredis.pipeline() as pipe:
+            pipe.rpush(key, *item['msgs'])
+            pipe.expire(key, CLEAN_NOTES_TTL)
+            await pipe.execute()
+
+        await db.clean_notes.update_one({'_id': item['_id']}, {'$unset': {'msgs': 1}})
+        count += 1
+
+    if count:
+        log.info(f"Notes: Moved clean notes messages of {count} chats to Redis")
@@ -1,7 +1,6 @@
 from functools import wraps
 
-from sophie_bot.services.mongo import engine
-from ..models import PrivateNotes
+from sophie_bot.modules.utils.chat_settings import get_chat_settings
 
 
 def privat_notes(func):
@@ -10,7 +9,7 @@ def privat_notes(func):
         event = args[0]
         chat_id = event.chat.id
 
-        if event.chat.type == 'private' or not await engine.find_one(PrivateNotes, PrivateNotes.chat_id == chat_id):
+        if event.chat.type == 'private' or not (await get_chat_settings(chat_id)).private_notes:
             return await func(*args, **kwargs)
 
     return wrapped_1
@@ -17,18 +17,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import html
+import io
 import os
 
 import requests
 import ujson
+from aiogram.types import InputFile
 
 from sophie_bot import OWNER_ID, OPERATORS, SOPHIE_VERSION, dp
 from sophie_bot.decorator import REGISTRED_COMMANDS, COMMANDS_ALIASES, register
 from sophie_bot.modules import LOADED_MODULES
 from sophie_bot.services.mongo import db, mongodb
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis
 from sophie_bot.services.telethon import tbot
+from sophie_bot.utils.metrics import HANDLERS_LATENCY, UPDATES_LATENCY
+from sophie_bot.utils.profiler import SamplingProfiler
 from .utils.covert import convert_size
 from .utils.language import get_strings_dec
 from .utils.message import need_args_dec
@@ -130,7 +135,7 @@ async def check_message_for_smartbroadcast(message):
 
 @register(cmds="purgecache", is_owner=True)
 async def purge_caches(message):
-    redis.flushdb()
+    await aredis.flushdb()
     await message.reply("Redis cache was cleaned.")
 
 
@@ -179,6 +184,37 @@ async def get_event(message):
     await message.reply(event)
 
 
+PROFILE_MAX_SECONDS = 300
+profile_lock = asyncio.Lock()
+
+
+@register(cmds="profile", is_op=True)
+async def profile(message):
+    arg = message.get_args()
+    if arg and not arg.isdigit():
+        return await message.reply("Usage: /profile (seconds)")
+    seconds = min(int(arg or 30), PROFILE_MAX_SECONDS)
+
+    if profile_lock.locked():
+        return await message.reply("Profiler is already running!")
+
+    async with profile_lock:
+        msg = await message.reply(f"Profiling for <code>{seconds}</code> sec...")
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+
+    await message.answer_document(
+        InputFile(io.StringIO(profiler.collapsed()), filename="profile.collapsed.txt"),
+        caption="Collapsed stacks, open with flamegraph.pl or speedscope.app"
+    )
+    await message.answer_document(InputFile(io.StringIO(profiler.summary()), filename="profile_summary.txt"))
+    await msg.delete()
+
+
 @register(cmds="stats", is_op=True)
 async def stats(message):
     text = f"<b>Sophie {SOPHIE_VERSION} stats</b>\n"
@@ -207,9 +243,16 @@ async def __stats__():
             convert_size(536870912 - local_db['storageSize'])
         )
 
-    text += "* <code>{}</code> total keys in Redis database\n".format(len(redis.keys()))
+    text += "* <code>{}</code> total keys in Redis database\n".format(await aredis.dbsize())
     text += "* <code>{}</code> total commands registred, in <code>{}</code> modules\n".format(
         len(REGISTRED_COMMANDS), len(LOADED_MODULES))
+
+    text += "* <code>{}</code> updates handled, p95 is <code>{:.3f}</code> sec\n".format(
+        UPDATES_LATENCY.count, UPDATES_LATENCY.percentile(95))
+    slowest = sorted(HANDLERS_LATENCY.items(), key=lambda x: x[1].percentile(95), reverse=True)[:3]
+    for name, histogram in slowest:
+        text += "  - <code>{}</code>: p95 <code>{:.3f}</code> sec, <code>{}</code> calls\n".format(
+            name, histogram.percentile(95), histogram.count)
     return text
 
 
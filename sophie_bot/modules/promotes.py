@@ -22,7 +22,7 @@ from telethon.errors import AdminRankEmojiNotAllowedError
 from sophie_bot import BOT_ID, bot
 from sophie_bot.decorator import register
 from sophie_bot.services.telethon import tbot
-from .utils.connections import chat_connection
+from .utils.connections import chat_connection, reset_chat_connections_cache
 from .utils.language import get_strings_dec
 from .utils.user_details import (
     get_user_dec, get_user_and_text_dec,
@@ -72,6 +72,7 @@ async def promote(message, chat, user, args, strings):
     except AdminRankEmojiNotAllowedError:
         return await message.reply(strings['emoji_not_allowed'])
     await get_admins_rights(chat_id, force_update=True)  # Reset a cache
+    await reset_chat_connections_cache(chat_id)
     await message.reply(text)
 
 
@@ -93,6 +94,7 @@ async def demote(message, chat, user, strings):
         return await message.reply(strings['demote_failed'])
 
     await get_admins_rights(chat_id, force_update=True)  # Reset a cache
+    await reset_chat_connections_cache(chat_id)
     await message.reply(strings['demote_success'].format(
         user=await get_user_link(user['user_id']),
         chat_name=chat['chat_title']
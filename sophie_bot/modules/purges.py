@@ -19,13 +19,11 @@
 
 import asyncio
 
-from telethon.errors.rpcerrorlist import MessageDeleteForbiddenError
-
 from sophie_bot import bot
 from sophie_bot.decorator import register
-from sophie_bot.services.telethon import tbot
 from .utils.language import get_strings_dec
 from .utils.notes import BUTTONS
+from .utils.purge import purge_messages
 
 
 @register(cmds="del", bot_can_delete_messages=True, user_can_delete_messages=True)
@@ -35,7 +33,7 @@ async def del_message(message, strings):
         await message.reply(strings['reply_to_msg'])
         return
     msgs = [message.message_id, message.reply_to_message.message_id]
-    await tbot.delete_messages(message.chat.id, msgs)
+    await purge_messages(message.chat.id, msgs)
 
 
 @register(cmds="purge", no_args=True, bot_can_delete_messages=True, user_can_delete_messages=True)
@@ -48,16 +46,8 @@ async def fast_purge(message, strings):
     delete_to = message.message_id
 
     chat_id = message.chat.id
-    msgs = []
-    for m_id in range(int(delete_to), msg_id - 1, -1):
-        msgs.append(m_id)
-        if len(msgs) == 100:
-            await tbot.delete_messages(chat_id, msgs)
-            msgs = []
-
-    try:
-        await tbot.delete_messages(chat_id, msgs)
-    except MessageDeleteForbiddenError:
+    result = await purge_messages(chat_id, range(msg_id, delete_to + 1))
+    if result.failed and not result.deleted:
         await message.reply(strings['purge_error'])
         return
 
@@ -18,8 +18,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from sophie_bot.decorator import register
-from sophie_bot.services.mongo import db
 
+from .utils.chat_settings import get_chat_settings
 from .utils.connections import chat_connection
 from .utils.disable import disableable_dec
 from .utils.language import get_strings_dec
@@ -31,10 +31,8 @@ from .utils.user_details import get_admins_rights, get_user_link, is_user_admin
 @get_strings_dec('reports')
 async def report1_cmd(message, chat, strings):
     # Checking whether report is disabled in chat!
-    check = await db.disabled.find_one({'chat_id': chat['chat_id']})
-    if check:
-        if 'report' in check['cmds']:
-            return
+    if (await get_chat_settings(chat['chat_id'])).is_disabled('report'):
+        return
     await report(message, chat, strings)
 
 
@@ -26,12 +26,12 @@ from babel.dates import format_datetime, format_timedelta
 
 from sophie_bot import BOT_ID, bot
 from sophie_bot.decorator import register
-from sophie_bot.services.redis import redis
-from sophie_bot.services.telethon import tbot
+from sophie_bot.services.redis import aredis
 from .misc import customise_reason_finish, customise_reason_start
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
 from .utils.message import InvalidTimeUnit, get_cmd, convert_time
+from .utils.purge import purge_messages
 from .utils.restrictions import kick_user, mute_user, unmute_user, ban_user, unban_user
 from .utils.user_details import get_user_dec, get_user_link, is_user_admin, get_user_and_text_dec
 
@@ -71,8 +71,7 @@ async def kick_user_cmd(message, chat, user, args, strings):
     if get_cmd(message) == 'skick':
         silent = True
         key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        await aredis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await kick_user(chat_id, user_id)
@@ -85,7 +84,7 @@ async def kick_user_cmd(message, chat, user, args, strings):
         if 'reply_to_message' in message and message.reply_to_message.from_user.id == user_id:
             to_del.append(message.reply_to_message.message_id)
         await asyncio.sleep(5)
-        await tbot.delete_messages(chat_id, to_del)
+        await purge_messages(chat_id, to_del)
 
 
 @register(cmds=['mute', 'smute', 'tmute', 'stmute'], bot_can_restrict_members=True, user_can_restrict_members=True)
@@ -144,8 +143,7 @@ async def mute_user_cmd(message, chat, user, args, strings):
     if curr_cmd in ('smute', 'stmute'):
         silent = True
         key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        await aredis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await mute_user(chat_id, user_id, until_date=until_date)
@@ -158,7 +156,7 @@ async def mute_user_cmd(message, chat, user, args, strings):
         if 'reply_to_message' in message and message.reply_to_message.from_user.id == user_id:
             to_del.append(message.reply_to_message.message_id)
         await asyncio.sleep(5)
-        await tbot.delete_messages(chat_id, to_del)
+        await purge_messages(chat_id, to_del)
 
 
 @register(cmds='unmute', bot_can_restrict_members=True, user_can_restrict_members=True)
@@ -248,8 +246,7 @@ async def ban_user_cmd(message, chat, user, args, strings):
     if curr_cmd in ('sban', 'stban'):
         silent = True
         key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        await aredis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await ban_user(chat_id, user_id, until_date=until_date)
@@ -262,7 +259,7 @@ async def ban_user_cmd(message, chat, user, args, strings):
         if 'reply_to_message' in message and message.reply_to_message.from_user.id == user_id:
             to_del.append(message.reply_to_message.message_id)
         await asyncio.sleep(5)
-        await tbot.delete_messages(chat_id, to_del)
+        await purge_messages(chat_id, to_del)
 
 
 @register(cmds='unban', bot_can_restrict_members=True, user_can_restrict_members=True)
@@ -301,7 +298,7 @@ async def leave_silent(message):
     if not message.from_user.id == BOT_ID:
         return
 
-    if redis.get('leave_silent:' + str(message.chat.id)) == message.left_chat_member.id:
+    if await aredis.get('leave_silent:' + str(message.chat.id)) == str(message.left_chat_member.id):
         await message.delete()
 
 
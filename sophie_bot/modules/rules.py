@@ -20,9 +20,11 @@
 import re
 
 from aiogram.dispatcher.filters import CommandStart
+from pymongo import IndexModel
 
 from sophie_bot.decorator import register
 from sophie_bot.services.mongo import db
+from .utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from .utils.connections import chat_connection
 from .utils.disable import disableable_dec
 from .utils.language import get_strings_dec
@@ -46,6 +48,7 @@ async def set_rules(message, chat, strings):
         text = strings['updated']
     else:
         text = strings['saved']
+    invalidate_chat_settings(chat_id)
 
     await message.reply(text % chat['chat_title'])
 
@@ -69,7 +72,7 @@ async def rules(message, chat, strings):
         arg1 = None
     noformat = arg1 in ('noformat', 'raw')
 
-    if not (db_item := await db.rules.find_one({'chat_id': chat_id})):
+    if not (db_item := (await get_chat_settings(chat_id)).rules):
         await message.reply(strings['not_found'])
         return
 
@@ -88,6 +91,7 @@ async def reset_rules(message, chat, strings):
     if (await db.rules.delete_one({'chat_id': chat_id})).deleted_count < 1:
         await message.reply(strings['not_found'])
         return
+    invalidate_chat_settings(chat_id)
 
     await message.reply(strings['deleted'])
 
@@ -100,7 +104,7 @@ BUTTONS.update({'rules': 'btn_rules'})
 async def rules_btn(message, strings):
     chat_id = (message.get_args().split('_'))[2]
     user_id = message.chat.id
-    if not (db_item := await db.rules.find_one({'chat_id': int(chat_id)})):
+    if not (db_item := (await get_chat_settings(int(chat_id))).rules):
         await message.answer(strings['not_found'])
         return
 
@@ -109,8 +113,8 @@ async def rules_btn(message, strings):
 
 
 async def __export__(chat_id):
-    rules = await db.rules.find_one({'chat_id': chat_id})
-    if rules:
+    if rules := (await get_chat_settings(chat_id)).rules:
+        rules = dict(rules)
         del rules['_id']
         del rules['chat_id']
 
@@ -124,3 +128,9 @@ async def __import__(chat_id, data):
 
     rules['chat_id'] = chat_id
     await db.rules.replace_one({'chat_id': rules['chat_id']}, rules, upsert=True)
+    invalidate_chat_settings(chat_id)
+
+
+__indexes__ = {
+    'rules': [IndexModel('chat_id')]
+}
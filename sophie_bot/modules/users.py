@@ -17,20 +17,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
 import html
 
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from sophie_bot import dp
 from sophie_bot.decorator import register
 from sophie_bot.modules import LOADED_MODULES
+from sophie_bot.services.apscheduller import scheduler
 from sophie_bot.services.mongo import db
 from sophie_bot.utils.logger import log
-from .utils.connections import chat_connection
+from .utils.connections import chat_connection, reset_chat_connections_cache
 from .utils.disable import disableable_dec
 from .utils.language import get_strings_dec
-from .utils.user_details import get_user_dec, get_user_link, is_user_admin, get_admins_rights
+from .utils.stats import backfill_hourly, inc_hourly, rollup_stats, sum_hourly
+from .utils.user_details import (
+    add_user_chat, count_user_chats, get_user_dec, get_user_link, is_user_admin, get_admins_rights
+)
 
 
 async def update_users_handler(message):
@@ -52,21 +59,24 @@ async def update_users_handler(message):
             "chat_id": chat_id,
             "chat_title": html.escape(new_chat.title, quote=False),
             "chat_nick": chatnick,
+            "chat_nick_lc": chatnick.lower() if chatnick else None,
             "type": new_chat.type,
             "first_detected_date": first_detected_date
         }
 
         # Check on old chat in DB with same username
         find_old_chat = {
-            'chat_nick': chat_new['chat_nick'],
+            'chat_nick_lc': chat_new['chat_nick_lc'],
             'chat_id': {'$ne': chat_new['chat_id']}
         }
-        if chat_new['chat_nick'] and (check := await db.chat_list.find_one(find_old_chat)):
+        if chat_new['chat_nick_lc'] and (check := await db.chat_list.find_one(find_old_chat)):
             await db.chat_list.delete_one({'_id': check['_id']})
             log.info(
                 f"Found chat ({check['chat_id']}) with same username as ({chat_new['chat_id']}), old chat was deleted.")
 
         await db.chat_list.update_one({'chat_id': chat_id}, {"$set": chat_new}, upsert=True)
+        if not old_chat:
+            await inc_hourly('new_chats')
 
         log.debug(f"Users: Chat {chat_id} updated")
 
@@ -83,21 +93,6 @@ async def update_users_handler(message):
 
 
 async def update_user(chat_id, new_user):
-    old_user = await db.user_list.find_one({'user_id': new_user.id})
-
-    new_chat = [chat_id]
-
-    if old_user and 'chats' in old_user:
-        if old_user['chats']:
-            new_chat = old_user['chats']
-        if not new_chat or chat_id not in new_chat:
-            new_chat.append(chat_id)
-
-    if old_user and 'first_detected_date' in old_user:
-        first_detected_date = old_user['first_detected_date']
-    else:
-        first_detected_date = datetime.datetime.now()
-
     if new_user.username:
         username = new_user.username.lower()
     else:
@@ -115,9 +110,7 @@ async def update_user(chat_id, new_user):
         'first_name': first_name,
         'last_name': last_name,
         'username': username,
-        'user_lang': new_user.language_code,
-        'chats': new_chat,
-        'first_detected_date': first_detected_date
+        'user_lang': new_user.language_code
     }
 
     # Check on old user in DB with same username
@@ -130,7 +123,13 @@ async def update_user(chat_id, new_user):
         log.info(
             f"Found user ({check['user_id']}) with same username as ({user_new['user_id']}), old user was deleted.")
 
-    await db.user_list.update_one({'user_id': new_user.id}, {"$set": user_new}, upsert=True)
+    if (await db.user_list.update_one(
+        {'user_id': new_user.id},
+        {'$set': user_new, '$setOnInsert': {'first_detected_date': datetime.datetime.now()}},
+        upsert=True
+    )).upserted_id is not None:
+        await inc_hourly('new_users')
+    await add_user_chat(new_user.id, chat_id)
 
     log.debug(f"Users: User {new_user.id} updated")
 
@@ -165,7 +164,7 @@ async def user_info(message, user, strings):
         if txt := await module.__user_info__(message, user['user_id']):
             text += txt
 
-    text += strings['info_saw'].format(num=len(user['chats']) if 'chats' in user else 0)
+    text += strings['info_saw'].format(num=await count_user_chats(user['user_id']))
 
     await message.reply(text)
 
@@ -175,6 +174,7 @@ async def user_info(message, user, strings):
 @get_strings_dec("users")
 async def reset_admins_cache(message, chat, strings):
     await get_admins_rights(chat['chat_id'], force_update=True)  # Reset a cache
+    await reset_chat_connections_cache(chat['chat_id'])
     await message.reply(strings['upd_cache_done'])
 
 
@@ -229,23 +229,82 @@ class SaveUser(BaseMiddleware):
         await update_users_handler(message)
 
 
+async def fill_chat_nick_lc():
+    # Chats saved before chat_nick_lc was introduced
+    result = await db.chat_list.update_many(
+        {'chat_nick': {'$type': 'string'}, 'chat_nick_lc': {'$exists': False}},
+        [{'$set': {'chat_nick_lc': {'$toLower': '$chat_nick'}}}]
+    )
+    if result.modified_count:
+        log.info(f"Users: Filled chat_nick_lc for {result.modified_count} chats")
+
+
+async def migrate_user_chats():
+    # Move legacy user_list.chats arrays into user_chats, users are still read from both while it runs
+    count = 0
+    async for user in db.user_list.find({'chats': {'$exists': True}}, {'user_id': 1, 'chats': 1}):
+        if user['chats']:
+            requests = [
+                UpdateOne(
+                    {'user_id': user['user_id'], 'chat_id': chat_id},
+                    {'$setOnInsert': {'user_id': user['user_id'], 'chat_id': chat_id}},
+                    upsert=True
+                ) for chat_id in set(user['chats'])
+            ]
+            try:
+                await db.user_chats.bulk_write(requests, ordered=False)
+            except BulkWriteError as err:
+                # Duplicates could be inserted concurrently by update_user
+                if any(x['code'] != 11000 for x in err.details['writeErrors']):
+                    log.error(f"Users: Can't migrate chats of user {user['user_id']}: {err.details['writeErrors']}")
+                    continue
+
+        await db.user_list.update_one({'_id': user['_id']}, {'$unset': {'chats': 1}})
+        count += 1
+        await asyncio.sleep(0)
+
+    if count:
+        log.info(f"Users: Migrated chats of {count} users to user_chats")
+
+
 async def __before_serving__(loop):
     dp.middleware.setup(SaveUser())
+    loop.create_task(fill_chat_nick_lc())
+    loop.create_task(migrate_user_chats())
+    loop.create_task(backfill_hourly('new_users', 'user_list', 'first_detected_date'))
+    loop.create_task(backfill_hourly('new_chats', 'chat_list', 'first_detected_date'))
+    scheduler.add_job(rollup_stats, 'cron', hour=3, id='stats_rollup', replace_existing=True)
 
 
 async def __stats__():
+    # Estimated counts are taken from collections' metadata, the exact ones scan whole collections
     text = "* <code>{}</code> total users, in <code>{}</code> chats\n".format(
-        await db.user_list.count_documents({}),
-        await db.chat_list.count_documents({})
+        await db.user_list.estimated_document_count(),
+        await db.chat_list.estimated_document_count()
     )
 
     text += "* <code>{}</code> new users and <code>{}</code> new chats in the last 48 hours\n".format(
-        await db.user_list.count_documents({
-            'first_detected_date': {'$gte': datetime.datetime.now() - datetime.timedelta(days=2)}
-        }),
-        await db.chat_list.count_documents({
-            'first_detected_date': {'$gte': datetime.datetime.now() - datetime.timedelta(days=2)}
-        })
+        await sum_hourly('new_users'),
+        await sum_hourly('new_chats')
     )
 
     return text
+
+
+__indexes__ = {
+    'user_list': [IndexModel('user_id'), IndexModel('username')],
+    'chat_list': [IndexModel('chat_id'), IndexModel('chat_nick_lc')],
+    'user_chats': [IndexModel([('user_id', 1), ('chat_id', 1)], unique=True)],
+    'stats_hourly': [IndexModel([('name', 1), ('hour', 1)], unique=True)],
+    'stats_daily': [IndexModel([('name', 1), ('day', 1)], unique=True)]
+}
+
+__queries__ = {
+    # Other chat/user which had the same username, on every update
+    'chat_list': [{'chat_nick_lc': '', 'chat_id': {'$ne': 0}}],
+    'user_list': [{'username': '', 'user_id': {'$ne': 0}}],
+    # is_user_in_chat()
+    'user_chats': [{'user_id': 0, 'chat_id': {'$in': [0]}}],
+    # sum_hourly()
+    'stats_hourly': [{'name': '', 'hour': {'$gte': datetime.datetime.now()}}]
+}
@@ -0,0 +1,49 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+
+from pymongo.errors import PyMongoError
+
+from sophie_bot.services.mongo import db
+from sophie_bot.utils.logger import log
+
+REFRESH_INTERVAL = int(os.getenv('BLACKLIST_REFRESH_INTERVAL', 60))
+
+BLACKLISTED_USERS = set()
+
+
+def is_user_blacklisted(user_id: int) -> bool:
+    return user_id in BLACKLISTED_USERS
+
+
+async def load_blacklist():
+    global BLACKLISTED_USERS
+    # Swap whole set so checks never see a half loaded list
+    BLACKLISTED_USERS = {x['user'] async for x in db.blacklisted_users.find({}, {'user': 1, '_id': 0})}
+    log.debug(f"Blacklist: loaded {len(BLACKLISTED_USERS)} users")
+
+
+async def blacklist_refresher():
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            await load_blacklist()
+        except PyMongoError as err:
+            log.error(f"Blacklist: can't refresh blacklisted users: {err}")
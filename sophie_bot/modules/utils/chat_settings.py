@@ -0,0 +1,159 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sophie_bot.services.mongo import db
+from sophie_bot.services.redis import aredis
+from sophie_bot.utils.logger import log
+from sophie_bot.utils.lru import LRUCache
+
+CACHE_SIZE = int(os.getenv('CHAT_SETTINGS_CACHE_SIZE', 20000))
+CACHE_TTL = int(os.getenv('CHAT_SETTINGS_CACHE_TTL', 120))
+
+# Invalidations are broadcasted to all bot instances over this channel
+INVALIDATE_CHANNEL = 'chat_settings_invalidate'
+
+
+@dataclass
+class ChatSettings:
+    """
+    All per-chat configuration, loaded at once and shared between handlers.
+    Raw documents (greetings, antiflood, rules...) are shared too, copy them before changing.
+    """
+    chat_id: int
+    greetings: Optional[dict] = None
+    antiflood: Optional[dict] = None
+    warn_limit: int = 3
+    warn_mode: Optional[dict] = None
+    disabled_cmds: List[str] = field(default_factory=list)
+    lang: Optional[str] = None
+    user_lang: Optional[str] = None
+    rules: Optional[dict] = None
+    allow_users_connect: bool = True
+    clean_notes: bool = False
+    private_notes: bool = False
+
+    def is_disabled(self, cmd: str) -> bool:
+        return cmd in self.disabled_cmds
+
+
+class _Invalidated:
+    """Cache entry of just invalidated settings, every invalidation puts a new one"""
+    __slots__ = ()
+
+
+_cache = LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL, name='chat_settings')
+_listener: Optional[asyncio.Task] = None
+
+
+async def load_chat_settings(chat_id: int) -> ChatSettings:
+    query = {'chat_id': chat_id}
+    (
+        greetings, antiflood, warnlimit, warnmode, disabled, lang, rules, connection, clean_notes, private_notes, user
+    ) = await asyncio.gather(
+        db.greetings.find_one(query),
+        db.antiflood.find_one(query),
+        db.warnlimit.find_one(query),
+        db.warnmode.find_one(query),
+        db.disabled.find_one(query),
+        db.lang.find_one(query),
+        db.rules.find_one(query),
+        db.chat_connection_settings.find_one(query),
+        db.clean_notes.find_one(query, {'_id': 1}),
+        db.private_notes.find_one(query, {'_id': 1}),
+        # Private chats fallback to user's telegram language
+        db.user_list.find_one({'user_id': chat_id}, {'user_lang': 1}) if chat_id > 0 else asyncio.sleep(0)
+    )
+
+    return ChatSettings(
+        chat_id=chat_id,
+        greetings=greetings,
+        antiflood=antiflood,
+        warn_limit=int(warnlimit['num']) if warnlimit else 3,
+        warn_mode=warnmode,
+        disabled_cmds=disabled.get('cmds', []) if disabled else [],
+        lang=lang['lang'] if lang else None,
+        user_lang=user.get('user_lang') if user else None,
+        rules=rules,
+        allow_users_connect=connection.get('allow_users_connect', True) is not False if connection else True,
+        clean_notes=bool(clean_notes),
+        private_notes=bool(private_notes)
+    )
+
+
+def get_cached_chat_settings(chat_id: int) -> Optional[ChatSettings]:
+    """Returns settings only if they are already cached, never loads them"""
+    if isinstance(settings := _cache.peek(chat_id), ChatSettings):
+        return settings
+    return None
+
+
+async def get_chat_settings(chat_id: int) -> ChatSettings:
+    if _listener is None:
+        start_invalidation_listener()
+
+    if isinstance(marker := _cache.peek(chat_id), ChatSettings):
+        return _cache.get(chat_id, marker)
+    # Markers of invalidated settings are kept in the cache, but they are misses
+    _cache.misses += 1
+
+    settings = await load_chat_settings(chat_id)
+
+    # Settings were changed while loading (marker was replaced), the loaded ones could be outdated already
+    if _cache.peek(chat_id) is marker:
+        _cache.set(chat_id, settings)
+
+    return settings
+
+
+def _invalidate(chat_id: int):
+    _cache.set(chat_id, _Invalidated())
+
+
+def invalidate_chat_settings(chat_id: int):
+    """Should be called after every change of chat's settings"""
+    _invalidate(chat_id)
+    asyncio.ensure_future(aredis.publish(INVALIDATE_CHANNEL, chat_id))
+
+
+async def _listen_invalidations():
+    while True:
+        pubsub = aredis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            async for message in pubsub.listen():
+                if message and message['type'] == 'message':
+                    _invalidate(int(message['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            log.error(f'Chat settings invalidation listener failed: {err}')
+            # Invalidations could be missed while disconnected
+            _cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
+
+
+def start_invalidation_listener():
+    global _listener
+    _listener = asyncio.ensure_future(_listen_invalidations())
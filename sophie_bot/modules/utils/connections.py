@@ -15,12 +15,84 @@
 
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import html
+import time
+
 from aiogram.utils.exceptions import Unauthorized
 
-from sophie_bot.modules.utils.user_details import is_user_admin
+from sophie_bot.modules.utils.chat_settings import get_chat_settings
+from sophie_bot.modules.utils.user_details import is_user_admin, is_user_in_chat
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis, get_hash, get_set
 from sophie_bot.utils.cached import cached
+from sophie_bot.utils.lru import LRUCache
+
+chat_titles = LRUCache(maxsize=10000, ttl=3600, name='chat_titles')
+
+
+async def get_chat_title(chat_id):
+    if (chat_title := chat_titles.get(chat_id)) is None:
+        _chat = await db.chat_list.find_one({'chat_id': chat_id}, {'chat_title': 1})
+        chat_title = _chat['chat_title'] if _chat is not None else str(chat_id)
+        chat_titles.set(chat_id, chat_title)
+    return chat_title
+
+
+CONNECTION_CACHE_TTL = 900
+
+
+def _connection_key(user_id):
+    return f'connection_cache_{user_id}'
+
+
+def _chat_connections_key(chat_id):
+    return f'connection_cache_users:{chat_id}'
+
+
+async def reset_connection_cache(user_id):
+    await aredis.delete(_connection_key(user_id))
+
+
+async def reset_chat_connections_cache(chat_id):
+    """Drops cached connections of all users connected to the chat, e.g. when admins or chat settings changed"""
+    key = _chat_connections_key(chat_id)
+    users = await get_set(key)
+    await aredis.delete(key, *[_connection_key(user_id) for user_id in users])
+
+
+async def resolve_connection(user_id):
+    # Get chats where user was detected and check if user in connected chat
+    # TODO: Really get the user and check on banned
+    if not (connected := await get_connection_data(user_id)) or 'chat_id' not in connected:
+        return None
+
+    chat_id = connected['chat_id']
+    if not await is_user_in_chat(user_id, chat_id):
+        return {'err_msg': 'not_in_chat'}
+
+    try:
+        user_admin = await is_user_admin(chat_id, user_id)
+    except Unauthorized:
+        return {'err_msg': 'bot_not_in_chat, please /disconnect'}
+
+    data = {
+        'chat_id': chat_id,
+        'chat_title': await get_chat_title(chat_id),
+        'command': ','.join(connected['command']) if 'command' in connected else '',
+        'user_admin': int(user_admin),
+        'allowed': int((await get_chat_settings(chat_id)).allow_users_connect),
+        'time': int(time.time())
+    }
+
+    # Only working connections are cached, the errors above can be fixed by user at any moment
+    async with aredis.pipeline() as pipe:
+        pipe.hset(_connection_key(user_id), mapping=data)
+        pipe.expire(_connection_key(user_id), CONNECTION_CACHE_TTL)
+        pipe.sadd(_chat_connections_key(chat_id), user_id)
+        pipe.expire(_chat_connections_key(chat_id), CONNECTION_CACHE_TTL)
+        await pipe.execute()
+
+    return data
 
 
 async def get_connected_chat(message, admin=False, only_groups=False, from_id=None, command=None):
@@ -28,73 +100,50 @@ async def get_connected_chat(message, admin=False, only_groups=False, from_id=No
     # only_in_groups - disable command when bot's pm not connected to any chat
     real_chat_id = message.chat.id
     user_id = from_id or message.from_user.id
-    key = 'connection_cache_' + str(user_id)
 
     if not message.chat.type == 'private':
-        _chat = await db.chat_list.find_one({'chat_id': real_chat_id})
-        chat_title = _chat['chat_title'] if _chat is not None else message.chat.title
-        # On some strange cases such as Database is fresh or new ; it doesn't contain chat data
-        # Only to "handle" the error, we do the above workaround - getting chat title from the update
+        # Title is escaped the same way as it's saved in chat_list
+        if message.chat.title:
+            chat_title = html.escape(message.chat.title, quote=False)
+            chat_titles.set(real_chat_id, chat_title)
+        else:
+            chat_title = await get_chat_title(real_chat_id)
         return {'status': 'chat', 'chat_id': real_chat_id, 'chat_title': chat_title}
 
-    # Cached
-    if cached := redis.hgetall(key):
-        cached['status'] = True
-        cached['chat_id'] = int(cached['chat_id'])
-        # return cached
+    if not (connection := await get_hash(_connection_key(user_id))):
+        connection = await resolve_connection(user_id)
 
     # if pm and not connected
-    if not (connected := await get_connection_data(user_id)) or 'chat_id' not in connected:
+    if not connection:
         if only_groups:
             return {'status': None, 'err_msg': 'usage_only_in_groups'}
         else:
             return {'status': 'private', 'chat_id': user_id, 'chat_title': 'Local chat'}
 
-    chat_id = connected['chat_id']
-
-    # Get chats where user was detected and check if user in connected chat
-    # TODO: Really get the user and check on banned
-    user_chats = (await db.user_list.find_one({'user_id': user_id}))['chats']
-    if chat_id not in user_chats:
-        return {'status': None, 'err_msg': 'not_in_chat'}
+    if 'err_msg' in connection:
+        return {'status': None, 'err_msg': connection['err_msg']}
 
-    chat_title = (await db.chat_list.find_one({'chat_id': chat_id}))['chat_title']
+    chat_id = int(connection['chat_id'])
+    chat_title = connection['chat_title']
+    user_admin = bool(int(connection['user_admin']))
 
     # Admin rights check if admin=True
-    try:
-        user_admin = await is_user_admin(chat_id, user_id)
-    except Unauthorized:
-        return {'status': None, 'err_msg': 'bot_not_in_chat, please /disconnect'}
-
     if admin:
         if not user_admin:
             return {'status': None, 'err_msg': 'u_should_be_admin'}
 
-    if 'command' in connected:
-        if command in connected['command']:
+    if connection['command']:
+        if command in connection['command'].split(','):
             return {'status': True, 'chat_id': chat_id, 'chat_title': chat_title}
         else:
             # Return local chat if user is accessing non connected command
             return {'status': 'private', 'chat_id': user_id, 'chat_title': 'Local chat'}
 
     # Check on /allowusersconnect enabled
-    if settings := await db.chat_connection_settings.find_one({'chat_id': chat_id}):
-        if 'allow_users_connect' in settings and settings['allow_users_connect'] is False and not user_admin:
-            return {'status': None, 'err_msg': 'conn_not_allowed'}
+    if not int(connection['allowed']) and not user_admin:
+        return {'status': None, 'err_msg': 'conn_not_allowed'}
 
-    data = {
-        'status': True,
-        'chat_id': chat_id,
-        'chat_title': chat_title
-    }
-
-    # Cache connection status for 15 minutes
-    cached = data
-    cached['status'] = 1
-    redis.hmset(key, cached)
-    redis.expire(key, 900)
-
-    return data
+    return {'status': True, 'chat_id': chat_id, 'chat_title': chat_title}
 
 
 def chat_connection(**dec_kwargs):
@@ -119,23 +168,21 @@ def chat_connection(**dec_kwargs):
 
 
 async def set_connected_chat(user_id, chat_id):
-    key = f'connection_cache_{user_id}'
-    redis.delete(key)
     if not chat_id:
         await db.connections.update_one({'user_id': user_id}, {"$unset": {'chat_id': 1, 'command': 1}}, upsert=True)
-        await get_connection_data.reset_cache(user_id)
-        return
+    else:
+        await db.connections.update_one(
+            {'user_id': user_id},
+            {
+                "$set": {'user_id': user_id, 'chat_id': chat_id},
+                "$unset": {'command': 1},
+                "$addToSet": {'history': {'$each': [chat_id]}}
+            },
+            upsert=True
+        )
 
-    await db.connections.update_one(
-        {'user_id': user_id},
-        {
-            "$set": {'user_id': user_id, 'chat_id': chat_id},
-            "$unset": {'command': 1},
-            "$addToSet": {'history': {'$each': [chat_id]}}
-        },
-        upsert=True
-    )
-    return await get_connection_data.reset_cache(user_id)
+    await get_connection_data.reset_cache(user_id)
+    await reset_connection_cache(user_id)
 
 
 async def set_connected_command(user_id, chat_id, command):
@@ -147,7 +194,8 @@ async def set_connected_command(user_id, chat_id, command):
         },
         upsert=True
     )
-    return await get_connection_data.reset_cache(user_id)
+    await get_connection_data.reset_cache(user_id)
+    await reset_connection_cache(user_id)
 
 
 @cached()
@@ -18,8 +18,8 @@
 
 from contextlib import suppress
 
+from sophie_bot.modules.utils.chat_settings import get_chat_settings
 from sophie_bot.modules.utils.user_details import is_user_admin
-from sophie_bot.services.mongo import db
 from sophie_bot.utils.logger import log
 
 DISABLABLE_COMMANDS = []
@@ -43,8 +43,8 @@ def disableable_dec(command):
                 if command in (aliases := message.conf['cmds']):
                     cmd = aliases[0]
 
-            check = await db.disabled.find_one({'chat_id': chat_id, 'cmds': {'$in': [cmd]}})
-            if check and not await is_user_admin(chat_id, user_id):
+            settings = await get_chat_settings(chat_id)
+            if settings.is_disabled(cmd) and not await is_user_admin(chat_id, user_id):
                 return
             return await func(*args, **kwargs)
 
@@ -21,8 +21,9 @@ import os
 import yaml
 from babel.core import Locale
 
+from sophie_bot.modules.utils.chat_settings import get_cached_chat_settings, invalidate_chat_settings
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import redis
+from sophie_bot.services.redis import aredis
 from sophie_bot.utils.logger import log
 
 LANGUAGES = {}
@@ -44,27 +45,36 @@ log.info("Languages loaded: {}".format(
 
 
 async def get_chat_lang(chat_id):
-    r = redis.get('lang_cache_{}'.format(chat_id))
-    if r:
+    if chat_id is None:
+        return 'en'
+
+    # Language is needed for almost every message, so it doesn't load all chat's settings
+    if settings := get_cached_chat_settings(chat_id):
+        if settings.lang:
+            return settings.lang
+        # Telegram language of user in private chat
+        return settings.user_lang if settings.user_lang in LANGUAGES else 'en'
+
+    if r := await aredis.get('lang_cache_{}'.format(chat_id)):
         return r
-    else:
-        db_lang = await db.lang.find_one({'chat_id': chat_id})
-        if db_lang:
-            # Rebuild lang cache
-            redis.set('lang_cache_{}'.format(chat_id), db_lang['lang'])
-            return db_lang['lang']
-        user_lang = await db.user_list.find_one({'user_id': chat_id})
-        if user_lang and user_lang['user_lang'] in LANGUAGES:
-            # Add telegram language in lang cache
-            redis.set('lang_cache_{}'.format(chat_id), user_lang['user_lang'])
-            return user_lang['user_lang']
-        else:
-            return 'en'
+
+    db_lang = await db.lang.find_one({'chat_id': chat_id})
+    if db_lang:
+        # Rebuild lang cache
+        await aredis.set('lang_cache_{}'.format(chat_id), db_lang['lang'])
+        return db_lang['lang']
+    user_lang = await db.user_list.find_one({'user_id': chat_id})
+    if user_lang and user_lang.get('user_lang') in LANGUAGES:
+        # Add telegram language in lang cache
+        await aredis.set('lang_cache_{}'.format(chat_id), user_lang['user_lang'])
+        return user_lang['user_lang']
+    return 'en'
 
 
 async def change_chat_lang(chat_id, lang):
-    redis.set('lang_cache_{}'.format(chat_id), lang)
+    await aredis.set('lang_cache_{}'.format(chat_id), lang)
     await db.lang.update_one({'chat_id': chat_id}, {"$set": {'chat_id': chat_id, 'lang': lang}}, upsert=True)
+    invalidate_chat_settings(chat_id)
 
 
 async def get_strings(chat_id, module, mas_name="STRINGS"):
@@ -3,7 +3,7 @@ import re
 from random import choice
 from typing import Optional, List, Dict, Tuple
 
-from aiogram.types import Message
+from aiogram.types import Message, User
 from aiogram.utils.text_decorations import HtmlDecoration
 from telethon.errors import (
     ButtonUrlInvalidError, MessageEmptyError, MediaEmptyError
@@ -17,7 +17,7 @@ from sophie_bot.types.chat import ChatId
 from sophie_bot.utils.logger import log
 from .message import get_args
 from .smarkdown import SDecoration
-from .user_details import get_user_link
+from .user_details import get_user_link, user_link
 
 BUTTONS: Dict[str, str] = {}
 RANDOM_REGEXP = re.compile(r'{([^{}]+)}')
@@ -181,7 +181,7 @@ async def get_parsed_note_list(message: Message, allow_reply_message=True, split
 
 
 async def unparse_note_item(message: Message, note: BaseNote, chat_id: ChatId, 
-                            raw=None, event=None, user=None) -> Tuple[str, dict]:
+                            raw=None, event=None, user=None, users: List[User] = None) -> Tuple[str, dict]:
     """Unparses BaseNote and prepares args for send_message method"""
     text = note.text or ''
     file_id = None
@@ -214,7 +214,8 @@ async def unparse_note_item(message: Message, note: BaseNote, chat_id: ChatId,
                 message,
                 md=True if note.parse_mode == 'md' else False,
                 event=event,
-                user=user or message.from_user
+                user=user or message.from_user,
+                users=users
             )
             text = random_parser(text)
 
@@ -319,7 +320,8 @@ def button_parser(chat_id: ChatId, texts: str, pm=False) -> Tuple[str, Optional[
     return text, buttons or None  # None not needed for aiogram
 
 
-async def vars_parser(text: str, message: Message, md=False, event: Message = None, user=None) -> str:
+async def vars_parser(text: str, message: Message, md=False, event: Message = None, user=None,
+                      users: List[User] = None) -> str:
     if event is None:
         event = message
 
@@ -339,12 +341,26 @@ async def vars_parser(text: str, message: Message, md=False, event: Message = No
     else:
         username = mention
 
+    # Batch of new members, mention all of them
+    if users:
+        first_name = ', '.join(html.escape(x.first_name, quote=False) for x in users)
+        last_name = ', '.join(html.escape(x.last_name, quote=False) for x in users if x.last_name)
+        full_name = ', '.join(html.escape(x.full_name, quote=False) for x in users)
+        user_id = ', '.join(str(x.id) for x in users)
+        mention = ', '.join(user_link(x.id, html.escape(x.first_name, quote=False), md=md) for x in users)
+        username = ', '.join('@' + x.username if x.username else user_link(
+            x.id, html.escape(x.first_name, quote=False), md=md
+        ) for x in users)
+
+    else:
+        full_name = first_name + " " + last_name
+
     chat_id = message.chat.id
     chat_name = html.escape(message.chat.title or 'Local', quote=False)
 
     return text.replace('{first}', first_name) \
         .replace('{last}', last_name) \
-        .replace('{fullname}', first_name + " " + last_name) \
+        .replace('{fullname}', full_name) \
         .replace('{id}', str(user_id).replace('{userid}', str(user_id))) \
         .replace('{mention}', mention) \
         .replace('{username}', username) \
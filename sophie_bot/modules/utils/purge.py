@@ -0,0 +1,108 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Set
+
+from telethon.errors.rpcerrorlist import FloodWaitError, RPCError
+
+from sophie_bot.services.telethon import tbot
+from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import register_queue
+
+PURGE_CONCURRENCY = int(os.getenv('PURGE_CONCURRENCY', 3))
+# Telegram accepts up to 100 message ids per request
+CHUNK_SIZE = 100
+# Longer flood waits aren't worth to wait, the rest of messages counts as failed
+MAX_FLOOD_WAIT = 300
+# Seconds to collect queued messages of the chat before deleting them by one purge
+QUEUE_FLUSH_INTERVAL = 1
+
+PURGE_QUEUES: Dict[int, Set[int]] = {}
+register_queue('purge', lambda: sum(len(x) for x in PURGE_QUEUES.values()))
+
+
+@dataclass
+class PurgeResult:
+    requested: int = 0
+    deleted: int = 0
+    failed: int = 0
+
+
+async def purge_messages(chat_id: int, message_ids: Iterable[int]) -> PurgeResult:
+    """Deletes messages by chunks concurrently, one failed chunk doesn't stop the others"""
+    message_ids = sorted({int(x) for x in message_ids}, reverse=True)
+    result = PurgeResult(requested=len(message_ids))
+    if not message_ids:
+        return result
+
+    semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+    # Flood wait applies to the whole chat, so all chunks wait for it together
+    flood_until = 0.0
+
+    async def delete_chunk(chunk):
+        nonlocal flood_until
+
+        async with semaphore:
+            while True:
+                if (wait := flood_until - time.monotonic()) > 0:
+                    await asyncio.sleep(wait)
+
+                try:
+                    affected = await tbot.delete_messages(chat_id, chunk)
+                except FloodWaitError as err:
+                    if err.seconds > MAX_FLOOD_WAIT:
+                        result.failed += len(chunk)
+                        return
+                    flood_until = max(flood_until, time.monotonic() + err.seconds)
+                    continue
+                except RPCError as err:
+                    log.debug(f"Purge: Can't delete {len(chunk)} messages in {chat_id}: {err}")
+                    result.failed += len(chunk)
+                    return
+
+                # Already deleted messages aren't counted by Telegram
+                result.deleted += sum(x.pts_count for x in affected)
+                return
+
+    await asyncio.gather(*[
+        delete_chunk(message_ids[i:i + CHUNK_SIZE]) for i in range(0, len(message_ids), CHUNK_SIZE)
+    ])
+    return result
+
+
+def queue_purge(chat_id: int, message_ids: Iterable[int]):
+    """Deletes messages later, together with the others queued for the chat in the meantime"""
+    if chat_id in PURGE_QUEUES:
+        PURGE_QUEUES[chat_id].update(message_ids)
+        return
+
+    PURGE_QUEUES[chat_id] = set(message_ids)
+    asyncio.ensure_future(_flush_purge_queue(chat_id))
+
+
+async def _flush_purge_queue(chat_id: int):
+    try:
+        await asyncio.sleep(QUEUE_FLUSH_INTERVAL)
+    finally:
+        message_ids = PURGE_QUEUES.pop(chat_id)
+
+    await purge_messages(chat_id, message_ids)
@@ -0,0 +1,111 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from typing import Awaitable, Callable
+
+from sophie_bot.services.mongo import db
+from sophie_bot.utils.logger import log
+
+# Hourly buckets are rolled into daily ones after this time
+HOURLY_KEEP_DAYS = 7
+
+
+async def inc_counter(name: str, value: int = 1):
+    # Not seeded counters are left alone, get_counter() will count them from scratch
+    await db.stats.update_one({'_id': name}, {'$inc': {'count': value}})
+
+
+async def delete_counter(name: str):
+    await db.stats.delete_one({'_id': name})
+
+
+async def get_counter(name: str, seed: Callable[[], Awaitable[int]]) -> int:
+    """Returns counter maintained by inc_counter(), seed is used to count it first time"""
+    if data := await db.stats.find_one({'_id': name}):
+        return data['count']
+
+    count = await seed()
+    await db.stats.update_one({'_id': name}, {'$setOnInsert': {'count': count}}, upsert=True)
+    return count
+
+
+def _current_hour() -> datetime.datetime:
+    return datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+
+
+async def inc_hourly(name: str, value: int = 1):
+    await db.stats_hourly.update_one({'name': name, 'hour': _current_hour()}, {'$inc': {'count': value}}, upsert=True)
+
+
+async def sum_hourly(name: str, hours: int = 48) -> int:
+    since = _current_hour() - datetime.timedelta(hours=hours)
+    result = await db.stats_hourly.aggregate([
+        {'$match': {'name': name, 'hour': {'$gte': since}}},
+        {'$group': {'_id': None, 'count': {'$sum': '$count'}}}
+    ]).to_list(1)
+    return result[0]['count'] if result else 0
+
+
+async def backfill_hourly(name: str, collection: str, date_field: str, hours: int = 48):
+    """Fills hourly buckets of a new counter from documents' creation date, runs only once"""
+    # Buckets themselves can't tell it, inc_hourly() could create them before the backfill.
+    # Marker is claimed atomically, so only one instance backfills and only documents created before it,
+    # the later ones are already counted live.
+    until = datetime.datetime.now()
+    result = await db.stats.update_one(
+        {'_id': f'backfill:{name}'}, {'$setOnInsert': {'date': until}}, upsert=True
+    )
+    if result.upserted_id is None:
+        return
+
+    since = _current_hour() - datetime.timedelta(hours=hours)
+    async for bucket in db[collection].aggregate([
+        {'$match': {date_field: {'$gte': since, '$lt': until}}},
+        {'$group': {
+            '_id': {'$dateFromParts': {
+                'year': {'$year': f'${date_field}'}, 'month': {'$month': f'${date_field}'},
+                'day': {'$dayOfMonth': f'${date_field}'}, 'hour': {'$hour': f'${date_field}'}
+            }},
+            'count': {'$sum': 1}
+        }}
+    ]):
+        await db.stats_hourly.update_one(
+            {'name': name, 'hour': bucket['_id']}, {'$inc': {'count': bucket['count']}}, upsert=True
+        )
+    log.info(f"Stats: Backfilled hourly {name} counter")
+
+
+async def rollup_stats():
+    """Daily job, moves old hourly buckets into daily ones"""
+    until = _current_hour().replace(hour=0) - datetime.timedelta(days=HOURLY_KEEP_DAYS)
+    async for bucket in db.stats_hourly.aggregate([
+        {'$match': {'hour': {'$lt': until}}},
+        {'$group': {
+            '_id': {'name': '$name', 'day': {'$dateFromParts': {
+                'year': {'$year': '$hour'}, 'month': {'$month': '$hour'}, 'day': {'$dayOfMonth': '$hour'}
+            }}},
+            'count': {'$sum': '$count'}
+        }}
+    ]):
+        await db.stats_daily.update_one(
+            {'name': bucket['_id']['name'], 'day': bucket['_id']['day']},
+            {'$inc': {'count': bucket['count']}},
+            upsert=True
+        )
+    await db.stats_hourly.delete_many({'hour': {'$lt': until}})
@@ -17,23 +17,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle
-import re
 from contextlib import suppress
 from typing import Union
 
 from aiogram.dispatcher.handler import SkipHandler
 from aiogram.types import CallbackQuery, Message
 from aiogram.utils.exceptions import BadRequest, Unauthorized, ChatNotFound
+from pymongo.errors import DuplicateKeyError
 from telethon.tl.functions.users import GetFullUserRequest
 
 from sophie_bot import OPERATORS, bot
 from sophie_bot.services.mongo import db
-from sophie_bot.services.redis import bredis
+from sophie_bot.services.redis import get_value, set_value
+from sophie_bot.utils.codec import versioned_key
 from sophie_bot.services.telethon import tbot
+from sophie_bot.utils.lru import LRUCache
 from .language import get_string
 from .message import get_arg
 
+# Memberships which are already saved, update_user() is called for every message
+known_user_chats = LRUCache(maxsize=50000, name='user_chats')
+
 
 async def add_user_to_db(user):
     if hasattr(user, 'user'):
@@ -50,8 +54,6 @@ async def add_user_to_db(user):
     if not user or user is None:
         user = new_user
 
-    if 'chats' not in user:
-        new_user['chats'] = []
     if 'user_lang' not in user:
         new_user['user_lang'] = 'en'
         if hasattr(user, 'user_lang'):
@@ -65,6 +67,53 @@ async def add_user_to_db(user):
     return new_user
 
 
+async def add_user_chat(user_id: int, chat_id: int):
+    if known_user_chats.get((user_id, chat_id)):
+        return
+
+    with suppress(DuplicateKeyError):
+        await db.user_chats.update_one(
+            {'user_id': user_id, 'chat_id': chat_id},
+            {'$setOnInsert': {'user_id': user_id, 'chat_id': chat_id}},
+            upsert=True
+        )
+    known_user_chats.set((user_id, chat_id), True)
+
+
+async def get_user_chats(user_id: int, chat_ids: list = None) -> set:
+    """Returns chats where user was detected, only from chat_ids if given"""
+    query = {'user_id': user_id}
+    if chat_ids is not None:
+        if not chat_ids:
+            return set()
+        query['chat_id'] = {'$in': chat_ids}
+
+    chats = {x['chat_id'] async for x in db.user_chats.find(query, {'chat_id': 1})}
+
+    # Users which weren't migrated from user_list.chats yet
+    legacy = {'$ifNull': ['$chats', []]}
+    if chat_ids is not None:
+        legacy = {'$setIntersection': [legacy, chat_ids]}
+    async for user in db.user_list.aggregate([{'$match': {'user_id': user_id}}, {'$project': {'chats': legacy}}]):
+        chats.update(user['chats'])
+
+    return chats
+
+
+async def count_user_chats(user_id: int) -> int:
+    # Users which weren't migrated from user_list.chats yet, their chats can be in user_chats too
+    user = await db.user_list.find_one({'user_id': user_id}, {'chats': 1})
+    legacy = user.get('chats', []) if user else []
+    query = {'user_id': user_id}
+    if legacy:
+        query['chat_id'] = {'$nin': legacy}
+    return await db.user_chats.count_documents(query) + len(set(legacy))
+
+
+async def is_user_in_chat(user_id: int, chat_id: int) -> bool:
+    return bool(await get_user_chats(user_id, [chat_id]))
+
+
 async def get_user_by_id(user_id: int):
     if not user_id <= 2147483647:
         return None
@@ -127,6 +176,10 @@ async def get_user_link(user_id, custom_name=None, md=False):
     if custom_name:
         user_name = custom_name
 
+    return user_link(user_id, user_name, md=md)
+
+
+def user_link(user_id, user_name, md=False):
     if md:
         return "[{name}](tg://user?id={id})".format(name=user_name, id=user_id)
     else:
@@ -134,9 +187,9 @@ async def get_user_link(user_id, custom_name=None, md=False):
 
 
 async def get_admins_rights(chat_id, force_update=False):
-    key = 'admin_cache:' + str(chat_id)
-    if (alist := bredis.get(key)) and not force_update:
-        return pickle.loads(alist)
+    key = versioned_key('admin_cache:' + str(chat_id))
+    if not force_update and (alist := await get_value(key)):
+        return alist
     else:
         alist = {}
         admins = await bot.get_chat_administrators(chat_id)
@@ -158,8 +211,7 @@ async def get_admins_rights(chat_id, force_update=False):
             with suppress(KeyError):  # Optional permissions
                 alist[user_id]['can_post_messages'] = admin['can_post_messages']
 
-        bredis.set(key, pickle.dumps(alist))
-        bredis.expire(key, 900)
+        await set_value(key, alist, ttl=900)
     return alist
 
 
@@ -417,7 +469,7 @@ def get_chat_dec(allow_self=False, fed=False):
                     except Unauthorized:
                         return await message.reply("I couldn't access chat/channel! Maybe I was kicked from there!")
             elif arg.startswith('@'):
-                chat = await db.chat_list.find_one({'chat_nick': re.compile(arg.strip('@'), re.IGNORECASE)})
+                chat = await db.chat_list.find_one({'chat_nick_lc': arg.strip('@').lower()})
             elif allow_self is True:
                 chat = await db.chat_list.find_one({'chat_id': message.chat.id})
             else:
@@ -16,6 +16,7 @@
 
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
 import functools
 import re
 from contextlib import suppress
@@ -29,11 +30,13 @@ from aiogram.utils.deep_linking import get_start_link
 from aiogram.utils.exceptions import MessageNotModified
 from babel.dates import format_timedelta
 from bson.objectid import ObjectId
+from pymongo import IndexModel, ReturnDocument
 
 from sophie_bot import BOT_ID, bot
 from sophie_bot.decorator import register
 from sophie_bot.services.mongo import db
 from .misc import customise_reason_start, customise_reason_finish
+from .utils.chat_settings import get_chat_settings, invalidate_chat_settings
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
 from .utils.message import convert_time, InvalidTimeUnit
@@ -80,28 +83,28 @@ async def warn_func(message: Message, chat, user, text, strings, filter_action=F
         'by': by_id
     })).inserted_id)
 
-    admin = await get_user_link(by_id)
-    member = await get_user_link(user_id)
+    warns_count, settings, admin, member = await asyncio.gather(
+        inc_warns_count(chat_id, user_id),
+        get_chat_settings(chat_id),
+        get_user_link(by_id),
+        get_user_link(user_id)
+    )
+
     text = strings['warn'].format(admin=admin, user=member, chat_name=chat_title)
 
     if reason:
         text += strings['warn_rsn'].format(reason=reason)
 
-    warns_count = await db.warns.count_documents({'chat_id': chat_id, 'user_id': user_id})
-
     buttons = InlineKeyboardMarkup().add(InlineKeyboardButton(
         "⚠️ Remove warn", callback_data='remove_warn_{}'.format(warn_id)
     ))
 
-    if await db.rules.find_one({'chat_id': chat_id}):
+    if settings.rules:
         buttons.insert(InlineKeyboardButton(
             "📝 Rules", url=await get_start_link(f'btn_rules_{chat_id}')
         ))
 
-    if warn_limit := await db.warnlimit.find_one({'chat_id': chat_id}):
-        max_warn = int(warn_limit['num'])
-    else:
-        max_warn = 3
+    max_warn = settings.warn_limit
 
     if filter_action:
         action = functools.partial(bot.send_message, chat_id=chat_id)
@@ -112,9 +115,8 @@ async def warn_func(message: Message, chat, user, text, strings, filter_action=F
 
     if warns_count >= max_warn:
         if await max_warn_func(chat_id, user_id):
-            await db.warns.delete_many({'user_id': user_id, 'chat_id': chat_id})
-            data = await db.warnmode.find_one({'chat_id': chat_id})
-            if data is not None:
+            await delete_warns(chat_id, user_id)
+            if (data := settings.warn_mode) is not None:
                 if data['mode'] == 'tmute':
                     text = strings['max_warn_exceeded:tmute'].format(
                         user=member, time=format_timedelta(
@@ -137,7 +139,8 @@ async def rmv_warn_btn(event, strings, regexp=None, **kwargs):
     warn_id = ObjectId(re.search(r'remove_warn_(.*)', str(regexp)).group(1)[:-2])
     user_id = event.from_user.id
     admin_link = await get_user_link(user_id)
-    await db.warns.delete_one({'_id': warn_id})
+    if warn := await db.warns.find_one_and_delete({'_id': warn_id}):
+        await inc_warns_count(warn['chat_id'], warn['user_id'], -1)
     with suppress(MessageNotModified):
         await event.message.edit_text(strings['warn_btn_rmvl_success'].format(admin=admin_link))
 
@@ -178,10 +181,7 @@ async def warnlimit(message, chat, strings):
     arg = message.get_args().split()
 
     if not arg:
-        if current_limit := await db.warnlimit.find_one({'chat_id': chat_id}):
-            num = current_limit['num']
-        else:
-            num = 3  # Default value
+        num = (await get_chat_settings(chat_id)).warn_limit
         await message.reply(strings['warn_limit'].format(chat_name=chat_title, num=num))
     elif not arg[0].isdigit():
         return await message.reply(strings['not_digit'])
@@ -198,6 +198,7 @@ async def warnlimit(message, chat, strings):
         }
 
         await db.warnlimit.update_one({'chat_id': chat_id}, {'$set': new}, upsert=True)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['warnlimit_updated'].format(num=int(arg[0])))
 
 
@@ -216,9 +217,7 @@ async def reset_warn(message, chat, user, strings):
         await message.reply(strings['rst_wrn_sofi'])
         return
 
-    if await db.warns.find_one({'chat_id': chat_id, 'user_id': user_id}):
-        deleted = await db.warns.delete_many({'chat_id': chat_id, 'user_id': user_id})
-        purged = deleted.deleted_count
+    if purged := await delete_warns(chat_id, user_id):
         await message.reply(strings['purged_warns'].format(
             admin=admin_link, num=purged, user=user_link, chat_title=chat_title))
     else:
@@ -236,7 +235,7 @@ async def warnmode(message, chat, strings):
 
     if arg and arg[0] in acceptable_args:
         option = ''.join(arg[0])
-        if (data := await db.warnmode.find_one({'chat_id': chat_id})) is not None and data['mode'] == option:
+        if (data := (await get_chat_settings(chat_id)).warn_mode) is not None and data['mode'] == option:
             return await message.reply(strings['same_mode'])
         if arg[0] == acceptable_args[0]:
             new['mode'] = option
@@ -262,10 +261,11 @@ async def warnmode(message, chat, strings):
             new['mode'] = option
             await db.warnmode.update_one({'chat_id': chat_id},
                                          {'$set': new}, upsert=True)
+        invalidate_chat_settings(chat_id)
         await message.reply(strings['warnmode_success'] % (chat['chat_title'], option))
     else:
         text = ''
-        if (curr_mode := await db.warnmode.find_one({'chat_id': chat_id})) is not None:
+        if (curr_mode := (await get_chat_settings(chat_id)).warn_mode) is not None:
             mode = curr_mode['mode']
             text += strings['mode_info'] % mode
         text += strings['wrng_args']
@@ -273,8 +273,31 @@ async def warnmode(message, chat, strings):
         await message.reply(text)
 
 
+async def inc_warns_count(chat_id, user_id, value=1) -> int:
+    """Changes user's warns counter and returns the new value"""
+    query = {'chat_id': chat_id, 'user_id': user_id}
+    if data := await db.warn_counters.find_one_and_update(
+            query, {'$inc': {'count': value}}, return_document=ReturnDocument.AFTER
+    ):
+        return data['count']
+
+    # No counter yet, seed it from warns given before counters were introduced
+    count = await db.warns.count_documents(query)
+    data = await db.warn_counters.find_one_and_update(
+        query, {'$max': {'count': count}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return data['count']
+
+
+async def delete_warns(chat_id, user_id) -> int:
+    query = {'chat_id': chat_id, 'user_id': user_id}
+    deleted = await db.warns.delete_many(query)
+    await db.warn_counters.delete_one(query)
+    return deleted.deleted_count
+
+
 async def max_warn_func(chat_id, user_id):
-    if (data := await db.warnmode.find_one({'chat_id': chat_id})) is not None:
+    if (data := (await get_chat_settings(chat_id)).warn_mode) is not None:
         if data['mode'] == 'ban':
             return await ban_user(chat_id, user_id)
         elif data['mode'] == 'tmute':
@@ -287,17 +310,13 @@ async def max_warn_func(chat_id, user_id):
 
 
 async def __export__(chat_id):
-    if data := await db.warnlimit.find_one({'chat_id': chat_id}):
-        number = data['num']
-    else:
-        number = 3
+    settings = await get_chat_settings(chat_id)
 
-    if warnmode_data := await db.warnmode.find_one({'chat_id': chat_id}):
-        del data['chat_id'], data['_id']
-    else:
-        warnmode_data = None
+    if warnmode_data := settings.warn_mode:
+        warnmode_data = dict(warnmode_data)
+        del warnmode_data['chat_id'], warnmode_data['_id']
 
-    return {'warns': {'warns_limit': number, 'warn_mode': warnmode_data}}
+    return {'warns': {'warns_limit': settings.warn_limit, 'warn_mode': warnmode_data}}
 
 
 async def __import__(chat_id, data):
@@ -314,6 +333,8 @@ async def __import__(chat_id, data):
     if (data := data['warn_mode']) is not None:
         await db.warnmode.update_one({'chat_id': chat_id}, {'$set': data}, upsert=True)
 
+    invalidate_chat_settings(chat_id)
+
 
 @get_strings_dec('warns')
 async def filter_handle(message, chat, data, string=None):
@@ -334,3 +355,11 @@ __filters__ = {
         'handle': filter_handle
     }
 }
+
+
+__indexes__ = {
+    'warns': [IndexModel([('chat_id', 1), ('user_id', 1)])],
+    'warn_counters': [IndexModel([('chat_id', 1), ('user_id', 1)], unique=True)],
+    'warnlimit': [IndexModel('chat_id')],
+    'warnmode': [IndexModel('chat_id')]
+}
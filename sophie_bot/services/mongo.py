@@ -22,18 +22,33 @@ import sys
 
 from motor import motor_asyncio
 from odmantic import AIOEngine
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
+from pymongo import MongoClient, monitoring
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
 
 from sophie_bot import log
+from sophie_bot.utils.metrics import PoolMetrics, record_io
 
 MONGO_URI = os.getenv("MONGO_URI", "localhost")
 MONGO_PORT = int(os.getenv("MONGO_PORT", 27017))
 MONGO_DB = os.getenv("MONGO_DB", "sophie")
 
+
+class CommandMetrics(monitoring.CommandListener):
+    """Reports MongoDB commands to metrics, Motor runs them with the caller's context"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_io('mongo', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_io('mongo', event.duration_micros / 1e6)
+
+
 # Init MongoDB
-mongodb = MongoClient(MONGO_URI, MONGO_PORT)[MONGO_DB]
-motor = motor_asyncio.AsyncIOMotorClient(MONGO_URI, MONGO_PORT)
+mongodb = MongoClient(MONGO_URI, MONGO_PORT, event_listeners=[CommandMetrics(), PoolMetrics()])[MONGO_DB]
+motor = motor_asyncio.AsyncIOMotorClient(MONGO_URI, MONGO_PORT, event_listeners=[CommandMetrics(), PoolMetrics()])
 db = motor[MONGO_DB]
 
 engine = AIOEngine(motor, MONGO_DB)
@@ -42,3 +57,54 @@ try:
     asyncio.get_event_loop().run_until_complete(motor.server_info())
 except ServerSelectionTimeoutError:
     sys.exit(log.critical("Can't connect to mongodb! Exiting..."))
+
+
+async def create_indexes(modules):
+    """Creates indexes declared in modules' __indexes__, MongoDB skips already existing ones"""
+    for module in [m for m in modules if hasattr(m, '__indexes__')]:
+        for collection, indexes in module.__indexes__.items():
+            for index in indexes:
+                try:
+                    await db[collection].create_indexes([index])
+                except OperationFailure as err:
+                    log.error(f"Can't create index {index.document['key']} on {collection}: {err}")
+
+
+def _find_stage(plan, stage: str) -> bool:
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            return True
+        return any(_find_stage(x, stage) for x in plan.values())
+    if isinstance(plan, list):
+        return any(_find_stage(x, stage) for x in plan)
+    return False
+
+
+async def explain_indexes(modules):
+    """
+    Runs queries registered in modules' __queries__ through explain() and reports collection scans and
+    in-memory sorts. Query is a filter or a (filter, sort) pair.
+    """
+    scans = 0
+    for module in [m for m in modules if hasattr(m, '__queries__')]:
+        for collection, queries in module.__queries__.items():
+            for query in queries:
+                query, sort = query if isinstance(query, tuple) else (query, None)
+                cursor = db[collection].find(query)
+                if sort:
+                    cursor = cursor.sort(sort)
+
+                try:
+                    plan = (await cursor.explain())['queryPlanner']['winningPlan']
+                except OperationFailure as err:
+                    log.error(f"Explain: can't explain {collection} {query} ({module.__name__}): {err}")
+                    continue
+
+                if _find_stage(plan, 'COLLSCAN'):
+                    scans += 1
+                    log.warning(f"Explain: {collection} {query} is a collection scan! ({module.__name__})")
+                elif sort and _find_stage(plan, 'SORT'):
+                    log.warning(f"Explain: {collection} {query} is sorted in memory by {sort} ({module.__name__})")
+                else:
+                    log.debug(f"Explain: {collection} {query} uses index")
+    log.info(f"Explain: audit finished, {scans} collection scans found")
@@ -18,20 +18,139 @@
 
 import os
 import sys
+import time
+from datetime import timedelta
+from typing import Any, Dict, Iterable, Mapping, Optional, Set, Union
 
 import redis as redis_lib
+import redis.asyncio as aredis_lib
+from redis.client import Pipeline
 
 from sophie_bot import log
+from sophie_bot.utils.codec import dumps, safe_loads
+from sophie_bot.utils.metrics import record_io
 
 HOST = os.getenv("REDIS_URI", "localhost")
 PORT = int(os.getenv("REDIS_PORT", 6379))
 DB = int(os.getenv("REDIS_DB_FSM", 1))
+POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 50))
+
+
+class MeteredPipeline(Pipeline):
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            record_io('redis', time.perf_counter() - start)
+
+
+class MeteredRedis(redis_lib.StrictRedis):
+    """Redis client which reports its calls to metrics"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            record_io('redis', time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class MeteredAsyncPipeline(aredis_lib.client.Pipeline):
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            record_io('redis', time.perf_counter() - start)
+
+
+class MeteredAsyncRedis(aredis_lib.StrictRedis):
+    """Async Redis client which reports its calls to metrics"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            record_io('redis', time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeteredAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 
 # Init Redis
-redis = redis_lib.StrictRedis(host=HOST, port=PORT, db=DB, decode_responses=True)
-bredis = redis_lib.StrictRedis(host=HOST, port=PORT, db=DB)
+redis = MeteredRedis(host=HOST, port=PORT, db=DB, decode_responses=True)
+bredis = MeteredRedis(host=HOST, port=PORT, db=DB)
+
+# Async clients mirror the sync ones (same responses decoding), so code is migrated just by
+# replacing `redis.get(...)` with `await aredis.get(...)`.
+# When all POOL_SIZE connections are busy commands wait for a free one instead of opening new ones.
+aredis = MeteredAsyncRedis(connection_pool=aredis_lib.BlockingConnectionPool(
+    host=HOST, port=PORT, db=DB, decode_responses=True, max_connections=POOL_SIZE
+))
+abredis = MeteredAsyncRedis(connection_pool=aredis_lib.BlockingConnectionPool(
+    host=HOST, port=PORT, db=DB, max_connections=POOL_SIZE
+))
 
 try:
     redis.ping()
 except redis_lib.ConnectionError:
     sys.exit(log.critical("Can't connect to RedisDB! Exiting..."))
+
+
+async def try_lock(key: str, ttl: int, force: bool = False) -> Optional[int]:
+    """
+    Takes a lock which expires in `ttl` seconds, atomically and in one round trip.
+    Returns None if the lock was taken, otherwise seconds left until the current one expires.
+    `force` takes the lock even if it's already held.
+    """
+    async with aredis.pipeline() as pipe:
+        pipe.set(key, 1, ex=ttl, nx=not force)
+        pipe.ttl(key)
+        taken, left = await pipe.execute()
+    return None if taken else left
+
+
+# Typed helpers over the async clients.
+# Values are packed by sophie_bot.utils.codec, the ones which can't be decoded (e.g. written by other
+# codec version) are returned as default.
+# Writes with TTL are single SET ... PX or MULTI transactions, so a key is never left without expiration.
+
+async def get_value(key: str, default: Any = None) -> Any:
+    return safe_loads(await abredis.get(key), default)
+
+
+async def set_value(key: str, value: Any, ttl: Optional[Union[int, float, timedelta]] = None) -> bool:
+    if isinstance(ttl, timedelta):
+        ttl = ttl.total_seconds()
+    return await abredis.set(key, dumps(value), px=int(ttl * 1000) if ttl else None)
+
+
+async def get_hash(key: str) -> Dict[str, str]:
+    return await aredis.hgetall(key)
+
+
+async def set_hash(key: str, mapping: Mapping[str, Union[str, int, float]], ttl: Optional[int] = None):
+    async with aredis.pipeline() as pipe:
+        pipe.hset(key, mapping=mapping)
+        if ttl:
+            pipe.expire(key, ttl)
+        await pipe.execute()
+
+
+async def get_set(key: str) -> Set[str]:
+    return await aredis.smembers(key)
+
+
+async def add_to_set(key: str, members: Iterable[Union[str, int]], ttl: Optional[int] = None):
+    if not (members := list(members)):
+        return
+    async with aredis.pipeline() as pipe:
+        pipe.sadd(key, *members)
+        if ttl:
+            pipe.expire(key, ttl)
+        await pipe.execute()
@@ -18,18 +18,12 @@
 
 import asyncio
 import functools
-import pickle
 from typing import Optional, Union
 
-from sophie_bot.services.redis import bredis
+from sophie_bot.services.redis import abredis, get_value, set_value
+from sophie_bot.utils.codec import MISSING, versioned_key
 from sophie_bot.utils.logger import log
-
-
-async def set_value(key, value, ttl):
-    value = pickle.dumps(value)
-    bredis.set(key, value)
-    if ttl:
-        bredis.expire(key, ttl)
+from sophie_bot.utils.metrics import register_cache
 
 
 class cached:
@@ -38,29 +32,32 @@ class cached:
         self.ttl = ttl
         self.key = key
         self.no_self = no_self
+        self.hits = 0
+        self.misses = 0
 
     def __call__(self, *args, **kwargs):
         if not hasattr(self, 'func'):
             self.func = args[0]
             # wrap
             functools.update_wrapper(self, self.func)
+            register_cache(self.key or (self.func.__module__ or "") + '.' + self.func.__name__, self)
             # return ``cached`` object when function is not being called
             return self
         return self._set(*args, **kwargs)
 
     async def _set(self, *args: dict, **kwargs: dict):
-        key = self.__build_key(*args, **kwargs)
+        key = versioned_key(self.__build_key(*args, **kwargs))
 
-        if bredis.exists(key):
-            value = pickle.loads(bredis.get(key))
-            return value if type(value) is not _NotSet else value.real_value
+        # None results are cached too
+        if (value := await get_value(key, default=MISSING)) is not MISSING:
+            self.hits += 1
+            return value
 
+        self.misses += 1
         result = await self.func(*args, **kwargs)
-        if result is None:
-            result = _NotSet()
         asyncio.ensure_future(set_value(key, result, ttl=self.ttl))
         log.debug(f'Cached: writing new data for key - {key}')
-        return result if type(result) is not _NotSet else result.real_value
+        return result
 
     def __build_key(self, *args: dict, **kwargs: dict) -> str:
         ordered_kwargs = sorted(kwargs.items())
@@ -87,13 +84,8 @@ class cached:
         """
 
         key = self.__build_key(*args, **kwargs)
+        # Pickled value under the unversioned key is still used by instances of older versions
         if new_value:
-            return set_value(key, new_value, ttl=self.ttl)
-        return bredis.delete(key)
-
-
-class _NotSet:
-    real_value = None
-
-    def __repr__(self) -> str:
-        return 'NotSet'
+            await abredis.delete(key)
+            return await set_value(versioned_key(key), new_value, ttl=self.ttl)
+        return await abredis.delete(key, versioned_key(key))
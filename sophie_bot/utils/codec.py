@@ -0,0 +1,139 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import zlib
+from typing import Any
+
+import msgpack
+from bson import ObjectId
+
+# Cached values are packed by msgpack, types it doesn't know are stored as extension types.
+# Unlike pickle, data doesn't reference our classes, so it's readable by other bot versions during rolling deploys
+# and loading it can't run code.
+# First byte is the format version, data of other versions (or pickles) is treated as a cache miss.
+# Bump it when encoding of any type changes.
+CODEC_VERSION = 1
+# msgpack repeats dict keys, so lists of documents are compressed. High bit of the first byte marks it.
+COMPRESSED = 0x80
+COMPRESS_THRESHOLD = 512
+
+EXT_OBJECT_ID = 1
+EXT_DATETIME = 2
+EXT_TUPLE = 3
+EXT_SET = 4
+EXT_TIMEDELTA = 5
+
+
+def versioned_key(key: str) -> str:
+    """
+    Redis key for data written by this codec version.
+    Instances running other versions (e.g. during rolling deploys) use other keys, so they never read our data.
+    """
+    return f'v{CODEC_VERSION}:{key}'
+
+
+class CodecError(ValueError):
+    pass
+
+
+class _Missing:
+    def __repr__(self) -> str:
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return msgpack.ExtType(EXT_OBJECT_ID, obj.binary)
+    elif isinstance(obj, datetime.datetime):
+        # Naive datetimes (as returned by pymongo) are kept naive
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+    elif isinstance(obj, datetime.timedelta):
+        return msgpack.ExtType(EXT_TIMEDELTA, _pack([obj.days, obj.seconds, obj.microseconds]))
+    elif isinstance(obj, tuple):
+        return msgpack.ExtType(EXT_TUPLE, _pack(list(obj)))
+    elif isinstance(obj, (set, frozenset)):
+        return msgpack.ExtType(EXT_SET, _pack(list(obj)))
+    # Subclasses, e.g. SON, Int64 or Binary
+    elif isinstance(obj, dict):
+        return dict(obj)
+    elif isinstance(obj, list):
+        return list(obj)
+    elif isinstance(obj, bool):
+        return bool(obj)
+    elif isinstance(obj, int):
+        return int(obj)
+    elif isinstance(obj, str):
+        return str(obj)
+    elif isinstance(obj, bytes):
+        return bytes(obj)
+    raise TypeError(f"Can't encode {type(obj).__name__}")
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == EXT_OBJECT_ID:
+        return ObjectId(data)
+    elif code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    elif code == EXT_TIMEDELTA:
+        return datetime.timedelta(*_unpack(data))
+    elif code == EXT_TUPLE:
+        return tuple(_unpack(data))
+    elif code == EXT_SET:
+        return set(_unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def _pack(value) -> bytes:
+    # strict_types makes tuples and subclasses go through _default instead of being packed as their base types
+    return msgpack.packb(value, default=_default, strict_types=True, use_bin_type=True)
+
+
+def _unpack(data: bytes):
+    # Dicts can have integer keys, e.g. admins cache
+    return msgpack.unpackb(data, ext_hook=_ext_hook, strict_map_key=False, raw=False)
+
+
+def dumps(value: Any) -> bytes:
+    if len(data := _pack(value)) < COMPRESS_THRESHOLD:
+        return bytes((CODEC_VERSION,)) + data
+    return bytes((CODEC_VERSION | COMPRESSED,)) + zlib.compress(data, 1)
+
+
+def loads(data: bytes) -> Any:
+    if not data or data[0] & ~COMPRESSED != CODEC_VERSION:
+        raise CodecError('Unknown format version')
+    try:
+        if data[0] & COMPRESSED:
+            return _unpack(zlib.decompress(data[1:]))
+        return _unpack(data[1:])
+    except (ValueError, zlib.error, msgpack.UnpackException) as err:
+        raise CodecError(str(err)) from err
+
+
+def safe_loads(data: bytes, default: Any = None) -> Any:
+    """Returns default if there is no data or it was written in other format"""
+    if data is None:
+        return default
+    try:
+        return loads(data)
+    except CodecError:
+        return default
@@ -20,9 +20,9 @@ from aiogram import types
 from aiogram.dispatcher.filters import BoundFilter
 
 from sophie_bot import OPERATORS, dp, OWNER_ID
+from sophie_bot.modules.utils.blacklist import is_user_blacklisted
 from sophie_bot.modules.utils.language import get_strings_dec
 from sophie_bot.modules.utils.user_details import is_user_admin
-from sophie_bot.services.mongo import mongodb
 
 
 class IsAdmin(BoundFilter):
@@ -75,8 +75,7 @@ class NotGbanned(BoundFilter):
         self.not_gbanned = not_gbanned
 
     async def check(self, message: types.Message):
-        check = mongodb.blacklisted_users.find_one({'user': message.from_user.id})
-        if not check:
+        if not is_user_blacklisted(message.from_user.id):
             return True
 
 
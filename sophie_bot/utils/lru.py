@@ -0,0 +1,68 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Union
+
+from sophie_bot.utils.metrics import register_cache
+
+
+class LRUCache:
+    """In-process LRU cache with optional TTL, for hot data which is too expensive to take from Redis each time"""
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[Union[int, float]] = None, name: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+        if name:
+            register_cache(name, self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if (item := self._data.get(key)) is None or (self.ttl and item[1] < time.monotonic()):
+            self._data.pop(key, None)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Like get(), but isn't counted in hits and misses and doesn't make the item recently used"""
+        if (item := self._data.get(key)) is None or (self.ttl and item[1] < time.monotonic()):
+            return default
+        return item[0]
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (value, time.monotonic() + self.ttl if self.ttl else None)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,369 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+
+from aiogram.dispatcher.middlewares import BaseMiddleware, MiddlewareManager
+from aiohttp import web
+from pymongo import monitoring
+
+from sophie_bot.utils.logger import log
+
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 1))
+
+# HDR-style buckets: every power of two (from ~0.24ms to ~64s) is split by 4 linear sub-buckets
+BUCKETS = sorted({round(2 ** exp * (1 + i / 4), 6) for exp in range(-12, 6) for i in range(4)})
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket which contains q-th percentile"""
+        if not self.count:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[idx] if idx < len(BUCKETS) else float('inf')
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+
+@dataclass
+class IOStat:
+    calls: int = 0
+    time: float = 0.0
+
+
+@dataclass
+class BlockStat:
+    count: int = 0
+    time: float = 0.0
+
+
+@dataclass
+class UpdateStats:
+    start: float = field(default_factory=time.perf_counter)
+    handlers: List[Tuple[str, float]] = field(default_factory=list)
+    io: Dict[str, IOStat] = field(default_factory=dict)
+
+
+HANDLERS_LATENCY: Dict[str, Histogram] = {}
+MIDDLEWARES_LATENCY: Dict[str, Histogram] = {}
+UPDATES_LATENCY = Histogram()
+IO_TOTAL: Dict[str, IOStat] = {}
+IO_PER_UPDATE: Dict[str, Histogram] = {}
+UPDATES_TOTAL: Dict[str, int] = {}
+API_CALLS: Dict[str, int] = {}
+API_ERRORS: Dict[Tuple[str, str], int] = {}
+LOOP_LAG = Histogram()
+# Loop blocks caught by the watchdog, by (handler, call site)
+LOOP_BLOCKS: Dict[Tuple[str, str], BlockStat] = {}
+# Objects with hits and misses attributes
+CACHES: Dict[str, Any] = {}
+# Functions returning current size of in-process queues
+QUEUES: Dict[str, Callable[[], int]] = {}
+
+UPDATE_TYPES = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query', 'chosen_inline_result',
+    'callback_query', 'shipping_query', 'pre_checkout_query', 'poll', 'poll_answer', 'my_chat_member',
+    'chat_member', 'chat_join_request'
+)
+
+current_stats = ContextVar('current_stats', default=None)
+# Mongo calls and loop blocks are recorded from other threads
+_io_lock = threading.Lock()
+
+
+def _observe(histograms: Dict[str, Histogram], name: str, value: float):
+    if (histogram := histograms.get(name)) is None:
+        histogram = histograms[name] = Histogram()
+    histogram.observe(value)
+
+
+def observe_handler(name: str, duration: float):
+    _observe(HANDLERS_LATENCY, name, duration)
+    if (stats := current_stats.get()) is not None:
+        stats.handlers.append((name, duration))
+
+
+def observe_middleware(name: str, duration: float):
+    _observe(MIDDLEWARES_LATENCY, name, duration)
+
+
+def record_io(kind: str, duration: float):
+    """Counts an outgoing call (mongo, redis, bot_api...) globally and for the update being handled"""
+    stats = current_stats.get()
+    with _io_lock:
+        for storage in (IO_TOTAL, stats.io if stats is not None else None):
+            if storage is None:
+                continue
+            if (stat := storage.get(kind)) is None:
+                stat = storage[kind] = IOStat()
+            stat.calls += 1
+            stat.time += duration
+
+
+def record_api_call(method: str, error: Exception = None):
+    API_CALLS[method] = API_CALLS.get(method, 0) + 1
+    if error is not None:
+        key = (method, error.__class__.__name__)
+        API_ERRORS[key] = API_ERRORS.get(key, 0) + 1
+
+
+def register_cache(name: str, cache):
+    CACHES[name] = cache
+
+
+def register_queue(name: str, size: Callable[[], int]):
+    QUEUES[name] = size
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """MongoDB connection pool state, both clients are counted together"""
+    opened = 0
+    checked_out = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with _io_lock:
+            PoolMetrics.opened += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with _io_lock:
+            PoolMetrics.opened -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        with _io_lock:
+            PoolMetrics.checked_out += 1
+
+    def connection_checked_in(self, event):
+        with _io_lock:
+            PoolMetrics.checked_out -= 1
+
+
+def record_loop_block(handler: str, site: str, duration: float):
+    with _io_lock:
+        stat = LOOP_BLOCKS.setdefault((handler, site), BlockStat())
+        stat.count += 1
+        stat.time += duration
+
+
+def start_update(update):
+    update_type = next((x for x in UPDATE_TYPES if getattr(update, x, None) is not None), 'unknown')
+    UPDATES_TOTAL[update_type] = UPDATES_TOTAL.get(update_type, 0) + 1
+    current_stats.set(UpdateStats())
+
+
+def finish_update(update):
+    if (stats := current_stats.get()) is None:
+        return
+    current_stats.set(None)
+
+    duration = time.perf_counter() - stats.start
+    UPDATES_LATENCY.observe(duration)
+    for kind, stat in stats.io.items():
+        _observe(IO_PER_UPDATE, kind, stat.calls)
+
+    if duration >= SLOW_UPDATE_THRESHOLD:
+        handlers = ', '.join(f'{name} {took:.3f}s' for name, took in stats.handlers) or 'no handlers'
+        io = ', '.join(f'{kind} {stat.calls}x {stat.time:.3f}s' for kind, stat in stats.io.items()) or 'no I/O'
+        log.warning(f"Slow update {update.update_id}: {duration:.3f}s; handlers: {handlers}; I/O: {io}")
+
+
+def snapshot() -> dict:
+    with _io_lock:
+        io_total = {kind: {'calls': stat.calls, 'time': round(stat.time, 6)} for kind, stat in IO_TOTAL.items()}
+        loop_blocks = [
+            {'handler': handler, 'site': site, 'count': stat.count, 'time': round(stat.time, 6)}
+            for (handler, site), stat in LOOP_BLOCKS.items()
+        ]
+
+    return {
+        'updates': UPDATES_LATENCY.to_dict(),
+        'handlers': {name: x.to_dict() for name, x in HANDLERS_LATENCY.items()},
+        'middlewares': {name: x.to_dict() for name, x in MIDDLEWARES_LATENCY.items()},
+        'io': io_total,
+        'io_per_update': {kind: x.to_dict() for kind, x in IO_PER_UPDATE.items()},
+        'caches': {name: {'hits': x.hits, 'misses': x.misses} for name, x in CACHES.items()},
+        'queues': {name: size() for name, size in QUEUES.items()},
+        'loop_lag': LOOP_LAG.to_dict(),
+        'loop_blocks': loop_blocks
+    }
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        start_update(update)
+
+    async def on_post_process_update(self, update, result, data):
+        finish_update(update)
+
+
+class TimedMiddlewareManager(MiddlewareManager):
+    """Middleware manager which measures every middleware's action"""
+
+    async def trigger(self, action, args):
+        for app in self.applications:
+            if not hasattr(app, 'on_' + action):
+                await app.trigger(action, args)
+                continue
+
+            start = time.perf_counter()
+            try:
+                await app.trigger(action, args)
+            finally:
+                observe_middleware(f'{app.__class__.__name__}.{action}', time.perf_counter() - start)
+
+
+def _prometheus_histogram(lines: List[str], name: str, histogram: Histogram, labels: str = ''):
+    # Only powers of two are exposed, it's detailed enough for dashboards and keeps the scrape small
+    cumulative = 0
+    for idx, count in enumerate(histogram.counts[:-1]):
+        cumulative += count
+        if idx % 4 == 0:
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{BUCKETS[idx]}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+def prometheus() -> str:
+    lines = ['# TYPE sophie_updates_total counter']
+    lines += [f'sophie_updates_total{{type="{name}"}} {count}' for name, count in UPDATES_TOTAL.items()]
+
+    lines.append('# TYPE sophie_update_seconds histogram')
+    _prometheus_histogram(lines, 'sophie_update_seconds', UPDATES_LATENCY)
+
+    lines.append('# TYPE sophie_handler_seconds histogram')
+    for name, histogram in HANDLERS_LATENCY.items():
+        _prometheus_histogram(lines, 'sophie_handler_seconds', histogram, f'handler="{name}"')
+
+    lines.append('# TYPE sophie_middleware_seconds histogram')
+    for name, histogram in MIDDLEWARES_LATENCY.items():
+        _prometheus_histogram(lines, 'sophie_middleware_seconds', histogram, f'middleware="{name}"')
+
+    with _io_lock:
+        io_total = list(IO_TOTAL.items())
+    lines.append('# TYPE sophie_io_calls_total counter')
+    lines += [f'sophie_io_calls_total{{backend="{kind}"}} {stat.calls}' for kind, stat in io_total]
+    lines.append('# TYPE sophie_io_seconds_total counter')
+    lines += [f'sophie_io_seconds_total{{backend="{kind}"}} {stat.time}' for kind, stat in io_total]
+
+    lines.append('# TYPE sophie_api_calls_total counter')
+    lines += [f'sophie_api_calls_total{{method="{method}"}} {count}' for method, count in API_CALLS.items()]
+    lines.append('# TYPE sophie_api_errors_total counter')
+    lines += [
+        f'sophie_api_errors_total{{method="{method}",error="{error}"}} {count}'
+        for (method, error), count in API_ERRORS.items()
+    ]
+
+    lines.append('# TYPE sophie_cache_hits_total counter')
+    lines += [f'sophie_cache_hits_total{{cache="{name}"}} {cache.hits}' for name, cache in CACHES.items()]
+    lines.append('# TYPE sophie_cache_misses_total counter')
+    lines += [f'sophie_cache_misses_total{{cache="{name}"}} {cache.misses}' for name, cache in CACHES.items()]
+
+    lines.append('# TYPE sophie_queue_size gauge')
+    lines += [f'sophie_queue_size{{queue="{name}"}} {size()}' for name, size in QUEUES.items()]
+
+    lines.append('# TYPE sophie_loop_lag_seconds histogram')
+    _prometheus_histogram(lines, 'sophie_loop_lag_seconds', LOOP_LAG)
+
+    with _io_lock:
+        loop_blocks = list(LOOP_BLOCKS.items())
+    lines.append('# TYPE sophie_loop_blocks_total counter')
+    lines += [
+        f'sophie_loop_blocks_total{{handler="{handler}",site="{site}"}} {stat.count}'
+        for (handler, site), stat in loop_blocks
+    ]
+    lines.append('# TYPE sophie_loop_blocked_seconds_total counter')
+    lines += [
+        f'sophie_loop_blocked_seconds_total{{handler="{handler}",site="{site}"}} {stat.time}'
+        for (handler, site), stat in loop_blocks
+    ]
+
+    lines.append('# TYPE sophie_mongo_connections gauge')
+    lines.append(f'sophie_mongo_connections{{state="open"}} {PoolMetrics.opened}')
+    lines.append(f'sophie_mongo_connections{{state="checked_out"}} {PoolMetrics.checked_out}')
+
+    return '\n'.join(lines) + '\n'
+
+
+async def stats_handler(request):
+    return web.json_response(snapshot())
+
+
+async def metrics_handler(request):
+    return web.Response(text=prometheus(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(port: int):
+    app = web.Application()
+    app.router.add_get('/stats', stats_handler)
+    app.router.add_get('/metrics', metrics_handler)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    log.info(f"Metrics: Listening on port {port}")
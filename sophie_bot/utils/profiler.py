@@ -0,0 +1,125 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+
+def frame_name(code) -> str:
+    module = code.co_filename.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+    return f'{module}:{code.co_name}:{code.co_firstlineno}'
+
+
+def frame_stack(frame) -> List[str]:
+    # Outermost call first, as in collapsed stacks
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def coroutine_chain(task: asyncio.Task) -> List[str]:
+    # Coroutines awaited by the task, outermost first
+    chain = []
+    coro = task.get_coro()
+    while coro is not None and (code := getattr(coro, 'cr_code', None)) is not None:
+        chain.append(frame_name(code))
+        coro = coro.cr_await
+    return chain
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the running event loop.
+    A separate thread wakes up every `interval` seconds and records the loop thread's stack (on-CPU time)
+    and the coroutine chains of all pending tasks (wall time, including time spent awaiting).
+    Samples which end in the selector are the loop's idle time.
+    Nothing is hooked into the loop itself, so the overhead does not depend on the load.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.coroutines = Counter()
+        self.samples = 0
+        self.duration = 0.0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        # Must be called from the loop's thread
+        self._loop = asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        started = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self.sample()
+        self.duration = time.monotonic() - started
+
+    def sample(self):
+        if (frame := sys._current_frames().get(self._thread_id)) is not None:
+            self.stacks[';'.join(frame_stack(frame))] += 1
+        del frame
+
+        try:
+            tasks = asyncio.all_tasks(self._loop)
+        except RuntimeError:
+            # Set of tasks changed during iteration, skip the sample
+            tasks = ()
+        for task in tasks:
+            # Count each coroutine once per sample, even if it is recursive
+            self.coroutines.update(set(coroutine_chain(task)))
+
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        # Brendan Gregg's collapsed stacks format, accepted by flamegraph.pl and speedscope
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 20) -> str:
+        text = f'{self.samples} samples in {self.duration:.1f} sec, every {self.interval * 1000:.0f} ms\n\n'
+
+        text += 'Top coroutines by wall time:\n'
+        for name, count in self.coroutines.most_common(top):
+            text += f'{count * self.interval:9.3f} sec  {name}\n'
+
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            functions[stack.rsplit(';', 1)[-1]] += count
+        text += '\nTop functions of the loop thread:\n'
+        for name, count in functions.most_common(top):
+            text += f'{count / (self.samples or 1) * 100:6.2f}%  {name}\n'
+
+        return text
@@ -0,0 +1,186 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Set, Tuple
+
+from sophie_bot.utils import regex_worker
+from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import register_queue
+
+WORKERS = int(os.getenv('REGEX_WORKERS', 2))
+# Seconds given to a worker for every message of the batch
+TIMEOUT = float(os.getenv('REGEX_TIMEOUT', 0.1))
+# Patterns which timed out and are not run anymore
+POISONED_CACHE_SIZE = 10000
+
+
+class RegexError(Exception):
+    pass
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+class RegexWorker:
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        # Worker is a new interpreter (fork + exec), a forked copy of the bot could deadlock on locks
+        # held by its threads (motor, executor) at the moment of fork
+        self.process = subprocess.Popen(
+            [sys.executable, regex_worker.__file__, str(child_conn.fileno())],
+            pass_fds=(child_conn.fileno(),), stdin=subprocess.DEVNULL
+        )
+        child_conn.close()
+
+    async def call(self, job: tuple, timeout: float):
+        loop = asyncio.get_event_loop()
+        ready = loop.create_future()
+        fd = self.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            self.conn.send(job)
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            loop.remove_reader(fd)
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+
+
+class RegexPool:
+    """
+    Pre-started processes to run user patterns away from the event loop.
+    A batch which doesn't finish in time is stopped by killing its worker, which is replaced by a new one.
+    The batch is then split in halves to find the slow pattern, which is poisoned: it's reported as not matching
+    and never run again, so the other filters of the chat keep working.
+    """
+
+    def __init__(self, size: int = WORKERS, timeout: float = TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._idle: Optional[asyncio.Queue] = None
+        self._pending: Dict[Tuple[str, ...], List[Tuple[str, asyncio.Future]]] = {}
+        self.poisoned: Set[str] = set()
+
+    def start(self):
+        if self._idle is not None:
+            return
+
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._idle.put_nowait(RegexWorker())
+
+    def _respawn(self, worker: RegexWorker) -> RegexWorker:
+        worker.kill()
+        return RegexWorker()
+
+    async def _replace(self, worker: RegexWorker):
+        # Killing and starting are blocking, keep them off the loop
+        self._idle.put_nowait(await asyncio.get_event_loop().run_in_executor(None, self._respawn, worker))
+
+    async def _run(self, job: tuple, timeout: float):
+        self.start()
+        worker = await self._idle.get()
+        try:
+            result = await worker.call(job, timeout)
+        except BaseException as err:
+            # Worker can still send a reply to the unfinished job, which would be read by the next one
+            asyncio.ensure_future(self._replace(worker))
+            if isinstance(err, asyncio.TimeoutError):
+                raise RegexTimeout
+            elif isinstance(err, (EOFError, OSError)):
+                log.error(f"Regex pool: Worker died, restarting it: {err}")
+                raise RegexError(err)
+            raise
+
+        self._idle.put_nowait(worker)
+        return result
+
+    def _poison(self, handler: str):
+        log.warning(f"Regex pool: Pattern {handler!r} timed out, it won't be checked anymore")
+        if len(self.poisoned) >= POISONED_CACHE_SIZE:
+            self.poisoned.clear()
+        self.poisoned.add(handler)
+
+    async def _match_bisect(self, handlers: Tuple[str, ...], texts: List[str]) -> List[List[bool]]:
+        if not handlers:
+            return [[] for _ in texts]
+
+        try:
+            return await self._run(('match', handlers, texts), self.timeout * len(texts))
+        except RegexTimeout:
+            if len(handlers) == 1:
+                self._poison(handlers[0])
+                return [[False] for _ in texts]
+
+        middle = len(handlers) // 2
+        left = await self._match_bisect(handlers[:middle], texts)
+        right = await self._match_bisect(handlers[middle:], texts)
+        return [x + y for x, y in zip(left, right)]
+
+    async def match(self, handlers: Tuple[str, ...], text: str) -> Optional[List[bool]]:
+        """Returns which of handlers match the text, or None if they couldn't be checked in time"""
+        future = asyncio.get_event_loop().create_future()
+
+        # Messages of the chat that came at the same time are checked by one batch
+        if handlers not in self._pending:
+            self._pending[handlers] = []
+            asyncio.ensure_future(self._flush(handlers))
+        self._pending[handlers].append((text, future))
+
+        return await future
+
+    async def _flush(self, handlers: Tuple[str, ...]):
+        batch = self._pending.pop(handlers)
+        active = tuple(x for x in handlers if x not in self.poisoned)
+        results = [None] * len(batch)
+        try:
+            active_results = await self._match_bisect(active, [x[0] for x in batch])
+        except RegexError:
+            log.warning(f"Regex pool: Batch of {len(batch)} messages wasn't checked by {len(handlers)} handlers")
+        except Exception as err:
+            log.error(f"Regex pool: Batch of {len(batch)} messages failed", exc_info=err)
+        else:
+            # Poisoned handlers don't match anything
+            results = []
+            for row in active_results:
+                matched = dict(zip(active, row))
+                results.append([matched.get(handler, False) for handler in handlers])
+        finally:
+            # Waiting messages are never left hanging, even if the batch was cancelled
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def validate(self, handler: str, timeout: float = 0.5):
+        """Raises RegexError for invalid patterns and RegexTimeout for the slow ones"""
+        if error := await self._run(('validate', handler), timeout):
+            raise RegexError(error)
+
+
+regex_pool = RegexPool()
+register_queue('regex_pool', lambda: sum(len(x) for x in regex_pool._pending.values()))
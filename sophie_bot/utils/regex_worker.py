@@ -0,0 +1,82 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs user patterns for sophie_bot.utils.regex_pool.
+# It's started as a script by a new interpreter, so it must not import anything from the bot.
+
+import random
+import re
+import sys
+from multiprocessing.connection import Connection
+from string import printable
+
+import regex
+
+# Compiled patterns kept by every worker
+COMPILED_CACHE_SIZE = 10000
+
+# Strings which are known to trigger catastrophic backtracking
+PROBE_TEXTS = ['a' * 64 + '!', '1' * 64 + 'x', ' ' * 64 + 'x', 'ab' * 32 + '!']
+
+
+def compile_handler(handler: str):
+    if handler.startswith('re:'):
+        return regex.compile(handler.replace('re:', '', 1))
+
+    # TODO: Remove this (handler.replace(...)). kept for backward compatibility
+    return re.compile(re.escape(handler).replace('(+)', '(.*)'), flags=re.IGNORECASE)
+
+
+def worker_main(conn: Connection):
+    compiled = {}
+
+    def get_pattern(handler):
+        if (pattern := compiled.get(handler)) is None:
+            try:
+                pattern = compile_handler(handler)
+            except (re.error, regex.error):
+                pattern = False
+            if len(compiled) >= COMPILED_CACHE_SIZE:
+                compiled.clear()
+            compiled[handler] = pattern
+        return pattern
+
+    while True:
+        try:
+            job, *args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        if job == 'match':
+            handlers, texts = args
+            patterns = [get_pattern(handler) for handler in handlers]
+            conn.send([[bool(pattern and pattern.search(text or '')) for pattern in patterns] for text in texts])
+        elif job == 'validate':
+            try:
+                pattern = compile_handler(args[0])
+            except (re.error, regex.error) as err:
+                conn.send(str(err))
+                continue
+
+            for text in [''.join(random.choice(printable) for _ in range(50)), *PROBE_TEXTS]:
+                pattern.search(text)
+            conn.send(None)
+
+
+if __name__ == '__main__':
+    # Socket of the connection is passed by its file descriptor
+    worker_main(Connection(int(sys.argv[1])))
@@ -21,16 +21,28 @@ import os
 import sentry_sdk
 from sentry_sdk.integrations.redis import RedisIntegration
 
+from sophie_bot.decorator import current_update
+from sophie_bot.modules.error import parse_update
 from sophie_bot.utils.logger import log
 
 SENTRY_API_KEY = os.getenv('SENTRY_API_KEY', None)
+SENTRY_TRACES_SAMPLE_RATE = float(os.getenv('SENTRY_TRACES_SAMPLE_RATE', 0))
+
+
+def before_send(event, hint):
+    if (update := current_update.get()) is not None:
+        event.setdefault('extra', {})['update'] = str(parse_update(dict(update)))
+    return event
+
 
 if SENTRY_API_KEY:
     log.info("Starting sentry.io integraion...")
 
     sentry_sdk.init(
         SENTRY_API_KEY,
-        integrations=[RedisIntegration()]
+        integrations=[RedisIntegration()],
+        before_send=before_send,
+        traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE
     )
 else:
     log.warn("sentry.io API key not found! Skipping.")
@@ -0,0 +1,95 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from redis.exceptions import RedisError
+
+from sophie_bot.services.redis import aredis
+from sophie_bot.utils.logger import log
+
+
+class TimerWheel:
+    """
+    Scheduler for short-lived timers which are created in big amounts (e.g. join expiry)
+    Timers are stored in Redis sorted set scored by due timestamp, so adding or removing one is a single command.
+    Use apscheduler for rare or long-living jobs.
+
+    >>> wheel = TimerWheel('some_timers', callback)
+    >>> await wheel.add('chat:user', datetime_or_timestamp, payload='something')
+    >>> loop.create_task(wheel.poll())
+    """
+
+    def __init__(self, name: str, callback: Callable[[str, Optional[str]], Awaitable], interval: float = 1,
+                 batch_size: int = 100):
+        self.key = f'timer_wheel:{name}'
+        self.payload_key = f'timer_wheel:{name}:payload'
+        self.callback = callback
+        self.interval = interval
+        self.batch_size = batch_size
+
+    async def add(self, member: str, due, payload: Optional[str] = None):
+        if isinstance(due, datetime):
+            due = due.timestamp()
+
+        async with aredis.pipeline() as pipe:
+            pipe.zadd(self.key, {member: due})
+            if payload is not None:
+                pipe.hset(self.payload_key, member, payload)
+            await pipe.execute()
+
+    async def remove(self, member: str) -> bool:
+        async with aredis.pipeline() as pipe:
+            pipe.zrem(self.key, member)
+            pipe.hdel(self.payload_key, member)
+            return bool((await pipe.execute())[0])
+
+    async def pop_due(self) -> list:
+        members = await aredis.zrangebyscore(self.key, 0, time.time(), start=0, num=self.batch_size)
+        if not members:
+            return []
+
+        # Only timers removed by us are ours, other instance could pop the same batch
+        async with aredis.pipeline() as pipe:
+            for member in members:
+                pipe.zrem(self.key, member)
+            pipe.hmget(self.payload_key, members)
+            pipe.hdel(self.payload_key, *members)
+            *removed, payloads, _ = await pipe.execute()
+
+        return [(member, payload) for member, payload, ok in zip(members, payloads, removed) if ok]
+
+    async def poll(self):
+        while True:
+            try:
+                due = await self.pop_due()
+            except RedisError as err:
+                log.error(f"TimerWheel: can't pop {self.key}: {err}")
+                due = None
+
+            if not due:
+                await asyncio.sleep(self.interval)
+                continue
+
+            results = await asyncio.gather(*[self.callback(*x) for x in due], return_exceptions=True)
+            for (member, _), result in zip(due, results):
+                if isinstance(result, Exception):
+                    log.error(f"TimerWheel: {self.key} callback failed for {member}", exc_info=result)
@@ -0,0 +1,111 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from sophie_bot.utils.logger import log
+from sophie_bot.utils.metrics import LOOP_LAG, record_loop_block
+
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', 0.1))
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES_DIR = os.path.join(PACKAGE_DIR, 'modules')
+# Metering wrappers, the real call site is the frame above them
+WRAPPER_FILES = {os.path.join(PACKAGE_DIR, 'services', 'redis.py'), os.path.join(PACKAGE_DIR, 'utils', 'metrics.py')}
+
+
+def attribute_stack(frame) -> Tuple[str, str, List[str]]:
+    """
+    Returns handler (outermost function in modules), call site (innermost SophieBot frame) and the formatted stack
+    """
+    handler = site = None
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        path = code.co_filename
+        stack.append(f'  {path}:{frame.f_lineno} in {code.co_name}')
+
+        if path.startswith(PACKAGE_DIR) and path not in WRAPPER_FILES:
+            if site is None:
+                site = f'{os.path.relpath(path, PACKAGE_DIR)}:{frame.f_lineno}'
+            if path.startswith(MODULES_DIR):
+                handler = f'{os.path.splitext(os.path.basename(path))[0]}.{code.co_name}'
+        frame = frame.f_back
+    stack.reverse()
+
+    return handler or 'unknown', site or 'unknown', stack
+
+
+class LoopWatchdog:
+    """
+    Finds the code which blocks the event loop (sync I/O, heavy computations).
+    The loop bumps a heartbeat every `interval` seconds, a separate thread checks it and, if the loop was not seen
+    for longer than `threshold`, takes the loop thread's stack while it is still blocked.
+    Blocks are logged once the loop is back and counted in metrics by handler and call site.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+
+        self._thread_id: Optional[int] = None
+
+    async def beat(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(loop.time() - start - self.interval, 0))
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        # Must be called from the loop's thread
+        self._thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        loop.create_task(self.beat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def _watch(self):
+        blocked = None
+        since = 0.0
+        while True:
+            time.sleep(self.interval)
+            lag = time.monotonic() - self.heartbeat - self.interval
+
+            if lag > self.threshold and blocked is None:
+                since = self.heartbeat
+                if (frame := sys._current_frames().get(self._thread_id)) is not None:
+                    blocked = attribute_stack(frame)
+                del frame
+            elif lag <= self.threshold and blocked is not None:
+                # Loop is back, the first beat after the block tells how long it was
+                self.report(*blocked, self.heartbeat - since - self.interval)
+                blocked = None
+
+    @staticmethod
+    def report(handler: str, site: str, stack: List[str], duration: float):
+        record_loop_block(handler, site, duration)
+        log.warning(
+            f"Event loop was blocked for {duration:.3f}s in {handler} at {site}:\n" + '\n'.join(stack)
+        )
@@ -0,0 +1,144 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Importing sophie_bot starts the bot (config, Telegram and DB connections), so tests get bare packages
+# which load utils from their files, and services are replaced by in-memory ones.
+
+import asyncio
+import logging
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', 'sophie_bot')
+
+
+def _package(name: str, path: str) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__path__ = [path]
+    sys.modules[name] = module
+    return module
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        self.redis.subscribers.setdefault(channel, []).append(self)
+
+    async def listen(self):
+        while True:
+            yield await self.messages.get()
+
+    async def close(self):
+        for subscribers in self.redis.subscribers.values():
+            if self in subscribers:
+                subscribers.remove(self)
+
+
+class FakeRedis:
+    """Async Redis with just the commands used by tested code"""
+
+    def __init__(self):
+        self.zsets = {}
+        self.hashes = {}
+        self.subscribers = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    async def publish(self, channel, message):
+        for subscriber in self.subscribers.get(channel, []):
+            subscriber.messages.put_nowait({'type': 'message', 'channel': channel, 'data': str(message)})
+        return len(self.subscribers.get(channel, []))
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    async def zrangebyscore(self, key, min_score, max_score, start=None, num=None):
+        members = sorted(
+            (score, member) for member, score in self.zsets.get(key, {}).items() if min_score <= score <= max_score
+        )
+        members = [member for _, member in members]
+        return members[start:start + num] if num is not None else members
+
+    async def zrem(self, key, *members):
+        zset = self.zsets.get(key, {})
+        return sum(zset.pop(member, None) is not None for member in members)
+
+    async def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    async def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    async def hdel(self, key, *fields):
+        data = self.hashes.get(key, {})
+        return sum(data.pop(field, None) is not None for field in fields)
+
+
+_package('sophie_bot', ROOT)
+_package('sophie_bot.services', os.path.join(ROOT, 'services'))
+_package('sophie_bot.modules', os.path.join(ROOT, 'modules'))
+_module('sophie_bot.utils.logger', log=logging.getLogger('sophie_bot'))
+_module('sophie_bot.services.mongo', db=None)
+_module('sophie_bot.services.redis', aredis=FakeRedis())
+_module('sophie_bot.services.telethon', tbot=None)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    from sophie_bot.utils import timer_wheel
+
+    redis = FakeRedis()
+    monkeypatch.setattr(timer_wheel, 'aredis', redis)
+    return redis
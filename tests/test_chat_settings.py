@@ -0,0 +1,120 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+import pytest
+
+from conftest import FakeRedis
+from sophie_bot.modules.utils import chat_settings
+from sophie_bot.modules.utils.chat_settings import (
+    ChatSettings, get_cached_chat_settings, get_chat_settings, invalidate_chat_settings
+)
+from sophie_bot.utils.lru import LRUCache
+
+
+class Loads(list):
+    gate = None
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Chat ids passed to the loader, which is stopped by setting `loads.gate` to an unset event"""
+    loads = Loads()
+
+    async def load_chat_settings(chat_id):
+        loads.append(chat_id)
+        if loads.gate:
+            await loads.gate.wait()
+        return ChatSettings(chat_id=chat_id, lang=f'lang{len(loads)}')
+
+    monkeypatch.setattr(chat_settings, 'load_chat_settings', load_chat_settings)
+    monkeypatch.setattr(chat_settings, 'aredis', FakeRedis())
+    monkeypatch.setattr(chat_settings, '_cache', LRUCache(maxsize=100))
+    # Listener is started by tests which need it
+    monkeypatch.setattr(chat_settings, '_listener', False)
+    return loads
+
+
+def test_cached_until_invalidated(loads):
+    async def run():
+        assert (await get_chat_settings(1)).lang == 'lang1'
+        assert (await get_chat_settings(1)).lang == 'lang1'
+        assert get_cached_chat_settings(1).lang == 'lang1'
+
+        invalidate_chat_settings(1)
+        assert get_cached_chat_settings(1) is None
+        assert (await get_chat_settings(1)).lang == 'lang2'
+        assert get_cached_chat_settings(1).lang == 'lang2'
+
+    asyncio.run(run())
+    assert loads == [1, 1]
+
+
+def test_invalidated_while_loading(loads):
+    async def run():
+        loads.gate = asyncio.Event()
+        task = asyncio.ensure_future(get_chat_settings(1))
+        await asyncio.sleep(0)
+
+        invalidate_chat_settings(1)
+        loads.gate.set()
+        # Loaded settings are returned, but not cached as they could miss the change
+        assert (await task).lang == 'lang1'
+        assert get_cached_chat_settings(1) is None
+
+        loads.gate = None
+        assert (await get_chat_settings(1)).lang == 'lang2'
+        assert get_cached_chat_settings(1).lang == 'lang2'
+
+    asyncio.run(run())
+
+
+def test_invalidated_by_other_instance(loads):
+    async def run():
+        chat_settings.start_invalidation_listener()
+        await get_chat_settings(1)
+        await get_chat_settings(2)
+        await asyncio.sleep(0)
+
+        await chat_settings.aredis.publish(chat_settings.INVALIDATE_CHANNEL, 1)
+        await asyncio.sleep(0)
+
+        assert get_cached_chat_settings(1) is None
+        assert get_cached_chat_settings(2) is not None
+        chat_settings._listener.cancel()
+
+    asyncio.run(run())
+
+
+def test_cache_stats(loads):
+    async def run():
+        cache = chat_settings._cache
+        await get_chat_settings(1)
+        await get_chat_settings(1)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Peeking by get_chat_lang() isn't counted
+        get_cached_chat_settings(1)
+        get_cached_chat_settings(2)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        invalidate_chat_settings(1)
+        await get_chat_settings(1)
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    asyncio.run(run())
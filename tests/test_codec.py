@@ -0,0 +1,74 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import pickle
+
+import pytest
+from bson import ObjectId
+
+from sophie_bot.utils import codec
+
+
+def test_round_trip():
+    value = {
+        '_id': ObjectId(),
+        'date': datetime.datetime(2020, 5, 17, 12, 30, 15),
+        'expire': datetime.timedelta(days=1, seconds=5),
+        'pair': (1, 'a'),
+        'tags': {'a', 'b'},
+        'nested': [{'x': None, 'y': 1.5, 'z': b'bin'}],
+        # Admins cache is keyed by user id
+        1234567: {'can_restrict_members': True}
+    }
+
+    assert codec.loads(codec.dumps(value)) == value
+
+
+def test_big_values_are_compressed():
+    value = [{'chat_id': -1001234567890, 'text': 'some text'} for _ in range(100)]
+    data = codec.dumps(value)
+
+    assert data[0] & codec.COMPRESSED
+    assert codec.loads(data) == value
+
+
+def test_other_version_is_rejected():
+    data = bytearray(codec.dumps({'a': 1}))
+    data[0] = codec.CODEC_VERSION + 1
+
+    with pytest.raises(codec.CodecError):
+        codec.loads(bytes(data))
+    assert codec.safe_loads(bytes(data), default='default') == 'default'
+
+
+def test_pickles_are_rejected():
+    data = pickle.dumps({'a': 1})
+
+    with pytest.raises(codec.CodecError):
+        codec.loads(data)
+    assert codec.safe_loads(data) is None
+    assert codec.safe_loads(None, default=codec.MISSING) is codec.MISSING
+
+
+def test_unknown_type():
+    with pytest.raises(TypeError):
+        codec.dumps(object())
+
+
+def test_versioned_key():
+    assert codec.versioned_key('filters_cache:1') == f'v{codec.CODEC_VERSION}:filters_cache:1'
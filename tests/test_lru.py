@@ -0,0 +1,93 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sophie_bot.utils import lru
+from sophie_bot.utils.lru import LRUCache
+
+
+def test_get_set():
+    cache = LRUCache(maxsize=10)
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 'default') == 'default'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Reading makes it recently used
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(lru.time, 'monotonic', lambda: now)
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+
+    now += 9
+    assert cache.get('a') == 1
+    now += 2
+    assert cache.get('a') is None
+    # Expired items are dropped on read
+    assert len(cache) == 0
+
+
+def test_pop_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.pop('a')
+    cache.pop('missing')
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_falsy_values_are_cached():
+    cache = LRUCache()
+    cache.set('a', 0)
+    cache.set('b', [])
+
+    assert cache.get('a', 'default') == 0
+    assert cache.get('b', 'default') == []
+
+
+def test_peek():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.peek('a') == 1
+    assert cache.peek('missing', 'default') == 'default'
+    assert (cache.hits, cache.misses) == (0, 0)
+    # Peeked item isn't made recently used
+    cache.set('c', 3)
+    assert cache.peek('a') is None
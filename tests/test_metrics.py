@@ -0,0 +1,48 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sophie_bot.utils.metrics import BUCKETS, Histogram
+
+
+def test_empty():
+    histogram = Histogram()
+
+    assert histogram.percentile(50) == 0.0
+    assert histogram.to_dict() == {'count': 0, 'sum': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+
+
+def test_percentiles():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.01)
+    for _ in range(10):
+        histogram.observe(2)
+
+    assert histogram.count == 100
+    assert round(histogram.sum, 6) == 20.9
+    # Percentiles are upper bounds of buckets, so never below the observed value
+    assert 0.01 <= histogram.percentile(50) < 0.0125
+    assert histogram.percentile(90) == histogram.percentile(50)
+    assert histogram.percentile(95) == 2
+    assert histogram.percentile(99) == 2
+
+
+def test_values_over_last_bucket():
+    histogram = Histogram()
+    histogram.observe(BUCKETS[-1] * 2)
+
+    assert histogram.percentile(50) == float('inf')
@@ -0,0 +1,99 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from types import SimpleNamespace
+
+from telethon.errors.rpcerrorlist import FloodWaitError, RPCError
+
+from sophie_bot.modules.utils import purge
+
+
+class FakeClient:
+    def __init__(self, errors=None):
+        self.calls = []
+        # Errors raised by calls, in order
+        self.errors = list(errors or [])
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls.append(list(message_ids))
+        if self.errors and (error := self.errors.pop(0)):
+            raise error
+        return [SimpleNamespace(pts_count=len(message_ids))]
+
+
+def test_chunks(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(purge, 'tbot', client)
+
+    result = asyncio.run(purge.purge_messages(1, [*range(1, 251), 5, '7']))
+
+    assert sorted(len(x) for x in client.calls) == [50, 100, 100]
+    # Duplicates are dropped, newest messages go first
+    assert client.calls[0] == list(range(250, 150, -1))
+    assert sorted(x for chunk in client.calls for x in chunk) == list(range(1, 251))
+    assert result == purge.PurgeResult(requested=250, deleted=250, failed=0)
+
+
+def test_failed_chunk_doesnt_stop_others(monkeypatch):
+    client = FakeClient(errors=[RPCError(None, 'MESSAGE_DELETE_FORBIDDEN')])
+    monkeypatch.setattr(purge, 'tbot', client)
+    monkeypatch.setattr(purge, 'PURGE_CONCURRENCY', 1)
+
+    result = asyncio.run(purge.purge_messages(1, range(1, 151)))
+
+    assert len(client.calls) == 2
+    assert result == purge.PurgeResult(requested=150, deleted=50, failed=100)
+
+
+def test_flood_wait(monkeypatch):
+    client = FakeClient(errors=[
+        FloodWaitError(None, capture=0), FloodWaitError(None, capture=purge.MAX_FLOOD_WAIT + 1)
+    ])
+    monkeypatch.setattr(purge, 'tbot', client)
+    monkeypatch.setattr(purge, 'PURGE_CONCURRENCY', 1)
+
+    result = asyncio.run(purge.purge_messages(1, range(1, 11)))
+
+    # Short wait is retried, too long one gives up the chunk
+    assert len(client.calls) == 2
+    assert result == purge.PurgeResult(requested=10, deleted=0, failed=10)
+
+
+def test_empty(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(purge, 'tbot', client)
+
+    assert asyncio.run(purge.purge_messages(1, [])) == purge.PurgeResult()
+    assert not client.calls
+
+
+def test_queue_purge_merges_messages(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(purge, 'tbot', client)
+    monkeypatch.setattr(purge, 'QUEUE_FLUSH_INTERVAL', 0)
+
+    async def run():
+        purge.queue_purge(1, [1, 2])
+        purge.queue_purge(1, [3])
+        purge.queue_purge(2, [4])
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    assert sorted(client.calls) == [[3, 2, 1], [4]]
+    assert not purge.PURGE_QUEUES
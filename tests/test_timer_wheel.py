@@ -0,0 +1,85 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+from sophie_bot.utils.timer_wheel import TimerWheel
+
+
+async def _callback(member, payload):
+    pass
+
+
+def test_pop_due_returns_only_due_timers(fake_redis):
+    async def run():
+        wheel = TimerWheel('test', _callback)
+        await wheel.add('due', time.time() - 1, payload='x')
+        await wheel.add('due_no_payload', time.time() - 2)
+        await wheel.add('later', time.time() + 60, payload='y')
+
+        assert await wheel.pop_due() == [('due_no_payload', None), ('due', 'x')]
+        # Popped timers are gone together with their payloads
+        assert await wheel.pop_due() == []
+        assert fake_redis.hashes[wheel.payload_key] == {'later': 'y'}
+        assert list(fake_redis.zsets[wheel.key]) == ['later']
+
+    asyncio.run(run())
+
+
+def test_pop_due_batch_size(fake_redis):
+    async def run():
+        wheel = TimerWheel('test', _callback, batch_size=2)
+        for idx in range(3):
+            await wheel.add(f'timer{idx}', time.time() - 10 + idx)
+
+        assert [x for x, _ in await wheel.pop_due()] == ['timer0', 'timer1']
+        assert [x for x, _ in await wheel.pop_due()] == ['timer2']
+
+    asyncio.run(run())
+
+
+def test_pop_due_skips_timers_popped_by_other_instance(fake_redis, monkeypatch):
+    async def run():
+        wheel = TimerWheel('test', _callback)
+        await wheel.add('a', time.time() - 1, payload='x')
+        await wheel.add('b', time.time() - 1, payload='y')
+
+        # Other instance pops 'a' between our read and removal
+        zrangebyscore = fake_redis.zrangebyscore
+
+        async def racing_zrangebyscore(*args, **kwargs):
+            members = await zrangebyscore(*args, **kwargs)
+            await fake_redis.zrem(wheel.key, 'a')
+            return members
+
+        monkeypatch.setattr(fake_redis, 'zrangebyscore', racing_zrangebyscore)
+        assert await wheel.pop_due() == [('b', 'y')]
+
+    asyncio.run(run())
+
+
+def test_remove(fake_redis):
+    async def run():
+        wheel = TimerWheel('test', _callback)
+        await wheel.add('a', time.time() - 1, payload='x')
+
+        assert await wheel.remove('a') is True
+        assert await wheel.remove('a') is False
+        assert await wheel.pop_due() == []
+
+    asyncio.run(run())
@@ -0,0 +1,121 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of SophieBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares cache codec with pickle on shapes of our real cached values.
+# Usage: python tools/codec_benchmark.py [--redis]
+# With --redis values are also written to Redis (REDIS_URI, REDIS_PORT, REDIS_DB_FSM env) to get MEMORY USAGE.
+
+import datetime
+import importlib.util
+import os
+import pickle
+import sys
+import timeit
+
+from bson import ObjectId
+
+# Codec is loaded by path, importing sophie_bot package would start the bot
+_spec = importlib.util.spec_from_file_location(
+    'codec', os.path.join(os.path.dirname(__file__), '..', 'sophie_bot', 'utils', 'codec.py')
+)
+codec = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(codec)
+
+NOW = datetime.datetime.now().replace(microsecond=0)
+
+ADMIN = {
+    'status': 'administrator', 'admin': True, 'title': None, 'anonymous': False, 'can_change_info': True,
+    'can_delete_messages': True, 'can_invite_users': True, 'can_restrict_members': True, 'can_pin_messages': True,
+    'can_promote_members': False
+}
+
+SAMPLES = {
+    # get_fed_by_id()
+    'fed': {
+        '_id': ObjectId(), 'fed_name': 'Some federation', 'fed_id': '2ad1ffd0-5ac2-4b56-9c4e-2e4a08f2ec8c',
+        'creator': 483808054, 'admins': [1234567, 7654321], 'chats': list(range(-1001000000000, -1001000000030)),
+        'subscribed': ['a0b3b5e2-3d0b-4c4e-8b3b-3e5c3b3b3b3b'], 'log_chat_id': -1001111111111, 'created': NOW
+    },
+    # get_connection_data()
+    'connection': {
+        '_id': ObjectId(), 'user_id': 483808054, 'chat_id': -1001234567890, 'command': ['notes', 'disconnect'],
+        'history': [-1001234567890, -1009876543210, -1001111111111]
+    },
+    # get_admins_rights()
+    'admin_cache': {1000000 + i: dict(ADMIN) for i in range(20)},
+    # antiflood middleware
+    'antiflood': {'count': 3},
+    # filters cache of a chat
+    'filters': {
+        'version': 1634567890123456789,
+        'filters': [
+            {
+                '_id': ObjectId(), 'chat_id': -1001234567890, 'handler': f'word{i}', 'action': 'delete_message',
+                'time': NOW
+            }
+            for i in range(50)
+        ]
+    }
+}
+
+NUMBER = 20000
+
+
+def bench(func):
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+
+def redis_memory():
+    import redis
+
+    client = redis.StrictRedis(
+        host=os.getenv('REDIS_URI', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=int(os.getenv('REDIS_DB_FSM', 1))
+    )
+    print(f"\n{'shape':<14}{'pickle, B':>12}{'codec, B':>12}")
+    for name, value in SAMPLES.items():
+        sizes = []
+        for prefix, data in (('pickle', pickle.dumps(value)), ('codec', codec.dumps(value))):
+            key = f'codec_benchmark:{prefix}:{name}'
+            client.set(key, data)
+            sizes.append(client.memory_usage(key))
+            client.delete(key)
+        print(f'{name:<14}{sizes[0]:>12}{sizes[1]:>12}')
+
+
+def main():
+    print(f"{'shape':<14}{'size pickle':>12}{'size codec':>12}"
+          f"{'dumps pickle':>14}{'dumps codec':>13}{'loads pickle':>14}{'loads codec':>13}  (bytes, us)")
+    for name, value in SAMPLES.items():
+        pickled = pickle.dumps(value)
+        packed = codec.dumps(value)
+        assert codec.loads(packed) == value, name
+
+        print(
+            f'{name:<14}{len(pickled):>12}{len(packed):>12}'
+            f'{bench(lambda: pickle.dumps(value)):>14.2f}{bench(lambda: codec.dumps(value)):>13.2f}'
+            f'{bench(lambda: pickle.loads(pickled)):>14.2f}{bench(lambda: codec.loads(packed)):>13.2f}'
+        )
+
+    if '--redis' in sys.argv:
+        redis_memory()
+
+
+if __name__ == '__main__':
+    main()